@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Benchmark of the stats processing of the exporter on synthetic
+# CaptureInternalStats output, no vCenter or host needed.
+#
+# Usage: python3 tests/benchmark_stats.py [--hosts N] [--rounds N]
+#           [--disks N] [--worlds N] [--vms N]
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tracemalloc
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import prometheus
+import vsanPrometheusStats
+
+
+def _Uuid(r):
+   return str(uuid.UUID(int=r.getrandbits(128)))
+
+# Return (CaptureInternalStats output, host info) of a synthetic host with
+# nDisks disks, nWorlds LSOM worlds and nVms virtual disks. The output also
+# has nUnused stats nodes not converted by the exporter, as the real output.
+def SynthesizeHost(seed=0, nDisks=8, nWorlds=40, nVms=20, nUnused=40):
+   r = random.Random(seed)
+   value = lambda: r.randint(0, 10 ** 9)
+   hostUuid = _Uuid(r)
+   disks = [_Uuid(r) for _ in range(nDisks)]
+   stats = {}
+
+   def node(key, metrics, entities):
+      stats[key] = {
+         'metrics': metrics,
+         'entities': dict([(entity, values if values is not None else
+                            [value() for _ in metrics])
+                           for entity, values in entities.items()]),
+      }
+
+   worldMetrics = ['upTime', 'usedTime', 'readyTime']
+   worlds = ['%s|PLOG-%s-w%d|%d' % (hostUuid, disks[i % nDisks], i, 1000 + i)
+             for i in range(nWorlds)]
+   worlds += ['%s|VSAN_0x%x_LSOMHelper|%d' % (hostUuid, i, 2000 + i)
+              for i in range(3)]
+   node('/sched/Vcpus/$getLsomWorldInformation', worldMetrics,
+        dict.fromkeys(worlds))
+   node('/sched/Vcpus/$getDomWorldInformation', worldMetrics,
+        dict([('%s|DOM_x_%s|%d' % (hostUuid, role, 3000 + i), None)
+              for i, role in enumerate(['Owner', 'Client', 'CompMgr'])]))
+   node('/sched/Vcpus/$getCmmdsWorldInformation', worldMetrics,
+        {'%s|CMMDS|5000' % hostUuid: None})
+
+   ioStats = ['write', 'read', 'unmap', 'recoveryWrite', 'resyncRead']
+   domMetrics = ['%s%s' % (io, suffix) for io in ioStats
+                 for suffix in ['Count', 'Bytes', 'LatencySumUs',
+                                'LatencySqSumUs', 'CongestionSum']]
+   domMetrics += ['numOIOSum']
+   for role in ['clientStats', 'ownerStats', 'compmgrStats']:
+      node('/vmkModules/vsan/dom/%s' % role, domMetrics, {hostUuid: None})
+   node('/vmkModules/vsan/dom/clientCacheStats', ['lookups', 'hits'],
+        {hostUuid: None})
+
+   dgMetrics = ['%s%s' % (io, suffix) for io in ioStats
+                for suffix in ['Count', 'Bytes', 'LatencySumUs']]
+   node('/vmkModules/vsan/dom/compSchedulers/%s/stats', dgMetrics,
+        dict.fromkeys(disks[:2]))
+   diskMetrics = ['info/%sCongestion' % k
+                  for k in ['ssd', 'mem', 'iops', 'slab', 'log', 'comp']]
+   diskMetrics += ['info/%sSpace' % k
+                   for k in ['plogLog', 'plogData', 'llogLog', 'llogData']]
+   diskMetrics += ['info/%s' % k for k in [
+      'wbSize', 'capacity', 'capacityUsed', 'capacityReserved',
+      'physDiskCapacity', 'physDiskCapacityUsed', 'physCapacityReserved',
+      'physCapacityPending', 'physCapacityUnreservedUsed', 'avgReadLatency']]
+   node('/vmkModules/lsom/disks/%s/info', diskMetrics, dict.fromkeys(disks))
+   drained = [(value(), value()) for _ in disks]
+   node('/vmkModules/plog/devices/%r/info|stats:./%s/info[deviceUUID]',
+        ['stats/totalBytesDrained', 'stats/ssdBytesDrained',
+         'stats/zeroBytesDrained', 'stats/nrIOs'],
+        dict([(disk, [ssd + zero, ssd, zero, value()])
+              for disk, (ssd, zero) in zip(disks, drained)]))
+   node('/system/heaps/$getHeapInformation', ['heapUtil'],
+        dict([('%s|%s-0x%x' % (hostUuid, name, i), None)
+              for i, name in enumerate(['dom', 'CMMDS', 'LSOM', 'RDT'])]))
+   node('/sched/pcpus/$getHostCpuInformation',
+        ['coreUtilTime', 'elapsedTime', 'usedTime', 'utilTime'],
+        {hostUuid: None})
+
+   vmMetrics = ['objUuid', 'numReads', 'numWrites', 'bytesRead',
+                'bytesWrite', 'latencyReads', 'latencyWrites']
+   vmDisks = ['%s|scsi0:%d' % (_Uuid(r), i) for i in range(nVms)]
+   node('/worldGroups/%v/vscsi/%v/stats/ioStats', vmMetrics,
+        dict([(vmDisk, [_Uuid(r)] + [value() for _ in vmMetrics[1:]])
+              for vmDisk in vmDisks]))
+
+   # nodes the exporter doesn't convert
+   for i in range(nUnused):
+      node('/unused/node%d/$getInformation' % i,
+           ['metric%d' % j for j in range(12)],
+           dict([('%s|entity-%d' % (hostUuid, j), None) for j in range(30)]))
+
+   hostInfo = {
+      'vsan_cluster_uuid': _Uuid(r),
+      'host_uuid': hostUuid,
+      'hostname': 'esx-%d.example.com' % seed,
+      'vmDict': dict([(vmDisk.split('|')[0], 'vm-%d' % i)
+                      for i, vmDisk in enumerate(vmDisks)]),
+      'disks': dict([(disk, {
+         'Device': 'naa.%d' % i, 'VSAN UUID': disk,
+         'VSAN Disk Group UUID': disks[0], 'Is Capacity Tier': i > 0})
+         for i, disk in enumerate(disks)]),
+      'version': 0,
+      'labelCache': prometheus.LabelCache(),
+      'schemaCache': prometheus.StatsSchemaCache('esx-%d.example.com' % seed),
+   }
+   return json.dumps({'stats': stats}), hostInfo
+
+
+# Run fn(arg) for every arg, return (CPU seconds, peak bytes allocated)
+def Measure(fn, args, rounds):
+   t1 = time.process_time()
+   for _ in range(rounds):
+      for arg in args:
+         fn(arg)
+   cpuTime = time.process_time() - t1
+   tracemalloc.start()
+   fn(args[0])
+   peak = tracemalloc.get_traced_memory()[1]
+   tracemalloc.stop()
+   return cpuTime, peak
+
+def BenchmarkParse(rawStatsList, rounds):
+   for rawStats in rawStatsList:
+      selected = vsanPrometheusStats.LoadStats(rawStats)['stats']
+      full = json.loads(rawStats)['stats']
+      assert list(selected.keys()) == list(full.keys())
+      for key, value in selected.items():
+         assert value is None or value == full[key]
+   print('Parse %d hosts x %d rounds, %.1f KB per host' % (
+      len(rawStatsList), rounds, len(rawStatsList[0]) / 1024.0))
+   for name, fn in [('json.loads', json.loads),
+                    ('LoadStats', vsanPrometheusStats.LoadStats)]:
+      cpuTime, peak = Measure(fn, rawStatsList, rounds)
+      print('   %-12s %8.2f ms/host %10.1f KB peak' % (
+         name, cpuTime * 1000.0 / (len(rawStatsList) * rounds),
+         peak / 1024.0))
+
+# Convert the parsed stats of every host to samples, and render them
+def BenchmarkConvert(hosts, rounds):
+   parsed = [(vsanPrometheusStats.LoadStats(rawStats), hostInfo)
+             for rawStats, hostInfo in hosts]
+   convert = lambda host: list(vsanPrometheusStats._IterateAndFormatStats(
+      host[0], None, host[1]['schemaCache']))
+   render = lambda host: vsanPrometheusStats.GenerateStatsAsString(
+      [vsanPrometheusStats.ConvertStats(host[1], host[0])])
+   # fill the label caches, as after the first scrape of the hosts
+   for host in parsed:
+      render(host)
+   print('Convert %d hosts x %d rounds' % (len(hosts), rounds))
+   for name, fn in [('convert', convert), ('convert+render', render)]:
+      cpuTime, peak = Measure(fn, parsed, rounds)
+      print('   %-14s %8.2f ms/host %8.1f hosts/s %10.1f KB peak' % (
+         name, cpuTime * 1000.0 / (len(hosts) * rounds),
+         len(hosts) * rounds / cpuTime, peak / 1024.0))
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--hosts', type=int, default=8)
+   parser.add_argument('--rounds', type=int, default=10)
+   parser.add_argument('--disks', type=int, default=8)
+   parser.add_argument('--worlds', type=int, default=40)
+   parser.add_argument('--vms', type=int, default=20)
+   args = parser.parse_args()
+   hosts = [SynthesizeHost(seed, nDisks=args.disks, nWorlds=args.worlds,
+                           nVms=args.vms) for seed in range(args.hosts)]
+   BenchmarkParse([rawStats for rawStats, hostInfo in hosts], args.rounds)
+   BenchmarkConvert(hosts, args.rounds)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Unit tests of the asyncio collector fetching the stats of many hosts.
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import unittest
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import asyncCollector
+import hostConnections
+
+class MockClient:
+   def __init__(self, hostname, delay):
+      self.hostname = hostname
+      self.delay = delay
+      self.closed = False
+
+   async def captureInternalStats(self):
+      await asyncio.sleep(self.delay)
+      return '{"stats": {}}'
+
+   async def close(self):
+      self.closed = True
+
+
+class TestAsyncCollector(unittest.TestCase):
+   @classmethod
+   def setUpClass(cls):
+      logging.disable(logging.CRITICAL)
+
+   @classmethod
+   def tearDownClass(cls):
+      logging.disable(logging.NOTSET)
+
+   def test_fetchTimeout(self):
+      self.assertLessEqual(asyncCollector.ASYNC_FETCH_TIMEOUT,
+                           hostConnections.HOST_FETCH_TIMEOUT)
+
+   def test_fetch(self):
+      collector = asyncCollector.AsyncCollector(2, 5)
+      clients = dict([('host-%d' % i, MockClient('esx-%d' % i, 0))
+                      for i in range(4)])
+      results = dict(collector.fetchAsCompleted(clients))
+      self.assertEqual(results, dict([(hostId, '{"stats": {}}')
+                                      for hostId in clients]))
+
+   # A fetch waiting for a free slot gives up at the same time as the hung
+   # fetch holding the slot
+   def test_hungHost(self):
+      collector = asyncCollector.AsyncCollector(1, 0.2)
+      clients = {'host-1': MockClient('esx-1', 60),
+                 'host-2': MockClient('esx-2', 60)}
+      t1 = time.time()
+      results = dict(collector.fetchAsCompleted(clients))
+      self.assertLess(time.time() - t1, 1)
+      for hostId, result in results.items():
+         self.assertIsInstance(result, asyncio.TimeoutError, hostId)
+      self.assertEqual(
+         sorted([client.closed for client in clients.values()]),
+         [False, True])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Unit tests of the sharing of the stats fetches of a host by concurrent
+# requests and of the per-host circuit breaker of the fetches.
+
+import os
+import sys
+import time
+import logging
+import threading
+import unittest
+from unittest.mock import patch
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import hostConnections
+import vsanPrometheusStats
+from workerPool import WorkerPool
+
+CLOSED = vsanPrometheusStats.HostCircuitBreaker.CLOSED
+OPEN = vsanPrometheusStats.HostCircuitBreaker.OPEN
+HALF_OPEN = vsanPrometheusStats.HostCircuitBreaker.HALF_OPEN
+HOST_INFO = {'host_uuid': 'host-uuid-1', 'hostname': 'esx-1',
+             'vsan_cluster_uuid': 'cluster-uuid-1'}
+HOST_DOWN = vsanPrometheusStats.GenerateHostUpStats(HOST_INFO, False)
+
+def CreateVCenter():
+   vcenter = vsanPrometheusStats.VsanVCenter(
+      'vc1', 443, 'user', 'password', 'VSAN-Cluster',
+      pool=WorkerPool(2, 8, 'test'))
+   vcenter.HOST_FETCH_TIMEOUT = 0.1
+   return vcenter
+
+
+class TestSingleFlight(unittest.TestCase):
+   def setUp(self):
+      self.release = threading.Event()
+      self.calls = 0
+
+   def tearDown(self):
+      self.release.set()
+
+   def blockedCall(self, result):
+      self.calls += 1
+      self.release.wait(10)
+      if isinstance(result, Exception):
+         raise result
+      return result
+
+   def test_coalesce(self):
+      flights = vsanPrometheusStats.SingleFlight()
+      leader, isLeader = flights.join('host-1')
+      self.assertTrue(isLeader)
+      follower, isLeader = flights.join('host-1')
+      self.assertFalse(isLeader)
+      self.assertIs(follower, leader)
+      self.assertEqual(flights.coalesced, 1)
+      # other keys don't share the flight
+      other, isLeader = flights.join('host-2')
+      self.assertTrue(isLeader)
+      self.assertIsNot(other, leader)
+
+      flights.run('host-1', leader, pow, 2, 3)
+      self.assertEqual(follower.result(), 8)
+      # a call after the flight landed starts a new one
+      future, isLeader = flights.join('host-1')
+      self.assertTrue(isLeader)
+      self.assertIsNot(future, leader)
+
+   def test_do(self):
+      flights = vsanPrometheusStats.SingleFlight()
+      results = []
+      threads = [threading.Thread(target=lambda: results.append(
+                    flights.do('host-1', self.blockedCall, 'stats')))
+                 for i in range(4)]
+      for thread in threads:
+         thread.start()
+      while flights.coalesced < 3:
+         self.release.wait(0.01)
+      self.release.set()
+      for thread in threads:
+         thread.join(10)
+      self.assertEqual(results, ['stats'] * 4)
+      self.assertEqual(self.calls, 1)
+      self.assertEqual(flights.flights, {})
+
+   # A caller after the call was abandoned starts a new call, which isn't
+   # dropped by the abandoned call landing
+   def test_abandon(self):
+      flights = vsanPrometheusStats.SingleFlight()
+      abandoned, isLeader = flights.join('host-1')
+      flights.abandon('host-1', abandoned)
+      future, isLeader = flights.join('host-1')
+      self.assertTrue(isLeader)
+      flights.abandon('host-1', abandoned)
+      flights.resolve('host-1', abandoned, 'late')
+      self.assertIs(flights.join('host-1')[0], future)
+
+   def test_error(self):
+      flights = vsanPrometheusStats.SingleFlight()
+      leader, isLeader = flights.join('host-1')
+      follower, isLeader = flights.join('host-1')
+      self.release.set()
+      flights.run('host-1', leader, self.blockedCall,
+                  Exception('Host not responding'))
+      for future in [leader, follower]:
+         self.assertRaisesRegex(
+            Exception, 'Host not responding', future.result)
+      self.assertEqual(flights.flights, {})
+      # the failed call isn't served to later callers
+      self.assertEqual(flights.do('host-1', self.blockedCall, 'stats'),
+                       'stats')
+
+
+class TestHostCircuitBreaker(unittest.TestCase):
+   @classmethod
+   def setUpClass(cls):
+      logging.disable(logging.CRITICAL)
+
+   @classmethod
+   def tearDownClass(cls):
+      logging.disable(logging.NOTSET)
+
+   def setUp(self):
+      self.now = 1000.0
+      patcher = patch.object(vsanPrometheusStats.time, 'time',
+                             lambda: self.now)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+      self.breaker = vsanPrometheusStats.HostCircuitBreaker(3, 30, 100)
+
+   def assertState(self, state, allowed):
+      self.assertEqual(self.breaker.allowRequest('host-1'), allowed)
+      self.assertEqual(self.breaker.getState('host-1'), state)
+
+   def openCircuit(self):
+      for i in range(3):
+         self.assertState(CLOSED, True)
+         self.breaker.recordFailure('host-1')
+      self.assertState(OPEN, False)
+
+   def test_open(self):
+      self.breaker.recordFailure('host-1')
+      self.breaker.recordFailure('host-1')
+      self.assertState(CLOSED, True)
+      # a success resets the failures
+      self.breaker.recordSuccess('host-1')
+      self.breaker.recordFailure('host-1')
+      self.breaker.recordFailure('host-1')
+      self.assertState(CLOSED, True)
+      self.breaker.recordFailure('host-1')
+      self.assertState(OPEN, False)
+      self.assertEqual(self.breaker.getState('host-2'), CLOSED)
+
+   def test_halfOpen(self):
+      self.openCircuit()
+      self.now += 29
+      self.assertState(OPEN, False)
+      self.now += 1
+      # a single probe is allowed
+      self.assertState(HALF_OPEN, True)
+      self.assertState(HALF_OPEN, False)
+      self.breaker.recordSuccess('host-1')
+      self.assertState(CLOSED, True)
+      self.assertEqual(self.breaker.hosts['host-1']['failures'], 0)
+
+   def test_backoff(self):
+      self.openCircuit()
+      for backoff in [60, 100, 100]:
+         self.now += self.breaker.hosts['host-1']['backoff']
+         self.assertState(HALF_OPEN, True)
+         # a failed probe opens the circuit with doubled backoff
+         self.breaker.recordFailure('host-1')
+         self.assertEqual(self.breaker.hosts['host-1']['backoff'], backoff)
+         self.now += backoff - 1
+         self.assertState(OPEN, False)
+         self.now -= backoff - 1
+      self.now += 100
+      self.assertState(HALF_OPEN, True)
+      self.breaker.recordSuccess('host-1')
+      # the next circuit opens with the initial backoff again
+      self.openCircuit()
+      self.assertEqual(self.breaker.hosts['host-1']['backoff'], 30)
+
+   def test_forget(self):
+      self.openCircuit()
+      self.breaker.forget('host-1')
+      self.assertState(CLOSED, True)
+
+
+class TestFetchOutcome(unittest.TestCase):
+   @classmethod
+   def setUpClass(cls):
+      logging.disable(logging.CRITICAL)
+
+   @classmethod
+   def tearDownClass(cls):
+      logging.disable(logging.NOTSET)
+
+   def setUp(self):
+      self.release = threading.Event()
+      self.fail = False
+
+   def tearDown(self):
+      self.release.set()
+
+   # Capture blocked until released
+   def captureStats(self, hostId, hostMoInfo):
+      self.release.wait(10)
+      if self.fail:
+         raise Exception('Host not responding')
+      return time.time(), ['stats']
+
+   def fetchLate(self, vcenter):
+      hostMos = {'host-1': (None, HOST_INFO)}
+      with patch.object(vsanPrometheusStats, 'CaptureStatsForHost',
+                        self.captureStats):
+         hostId, out = next(vcenter._iterStatsForHosts(hostMos))
+         self.assertEqual(out, [HOST_DOWN])
+         self.release.set()
+         # the done callbacks of the capture have run once its task is done
+         vcenter.pool.tasks.join()
+      return vcenter.breaker.hosts['host-1']['failures']
+
+   # The late outcome of a capture given up on isn't recorded again
+   def test_timeoutThenFailure(self):
+      vcenter = CreateVCenter()
+      self.fail = True
+      self.assertEqual(self.fetchLate(vcenter), 1)
+
+   # A host whose captures never return is skipped right away once the
+   # circuit opened, every scrape giving up on it counts as a failure
+   def test_hungHost(self):
+      vcenter = CreateVCenter()
+      threshold = vcenter.CIRCUIT_BREAKER_THRESHOLD
+      submitted = []
+      submit = vcenter.pool.submit
+      def countingSubmit(*args, **kwargs):
+         submitted.append(kwargs.get('taskName'))
+         return submit(*args, **kwargs)
+      hostMos = {'host-1': (None, HOST_INFO)}
+      with patch.object(vsanPrometheusStats, 'CaptureStatsForHost',
+                        self.captureStats), \
+           patch.object(vcenter.pool, 'submit', countingSubmit):
+         for i in range(threshold):
+            self.assertEqual(dict(vcenter._iterStatsForHosts(hostMos)),
+                             {'host-1': [HOST_DOWN]})
+            # every scrape starts its own capture
+            self.assertEqual(len(submitted), i + 1)
+         self.assertEqual(vcenter.breaker.getState('host-1'), OPEN)
+         t1 = time.time()
+         self.assertEqual(dict(vcenter._iterStatsForHosts(hostMos)),
+                          {'host-1': [HOST_DOWN]})
+         self.assertLess(time.time() - t1, vcenter.HOST_FETCH_TIMEOUT)
+         self.assertEqual(len(submitted), threshold)
+
+   # The host connections time out, so hung hosts don't hold the workers
+   def test_connectionTimeout(self):
+      connection = hostConnections.HostHTTPSConnection('esx-1', port=443)
+      self.assertEqual(connection.timeout, hostConnections.HOST_FETCH_TIMEOUT)
+
+   # A host not submitted since the pool is full is down, without failing
+   # its circuit
+   def test_poolFull(self):
+      vcenter = CreateVCenter()
+      vcenter.pool = WorkerPool(1, 1, 'test')
+      vcenter.pool.submit(self.release.wait, 10)
+      vcenter.pool.submit(self.release.wait, 10)
+      with patch.object(vsanPrometheusStats, 'CaptureStatsForHost',
+                        self.captureStats):
+         t1 = time.time()
+         result = dict(vcenter._iterStatsForHosts(
+            {'host-1': (None, HOST_INFO)}))
+      self.assertLess(time.time() - t1, vcenter.HOST_FETCH_TIMEOUT)
+      self.assertEqual(result, {'host-1': [HOST_DOWN]})
+      self.assertEqual(vcenter.breaker.getState('host-1'), CLOSED)
+      self.assertEqual(vcenter.breaker.hosts['host-1']['failures'], 0)
+      self.assertEqual(vcenter.statsFlights.flights, {})
+
+   def test_success(self):
+      vcenter = CreateVCenter()
+      vcenter.breaker.recordFailure('host-1')
+      self.release.set()
+      with patch.object(vsanPrometheusStats, 'CaptureStatsForHost',
+                        self.captureStats):
+         result = dict(vcenter._iterStatsForHosts(
+            {'host-1': (None, HOST_INFO)}))
+      self.assertIn('stats', result['host-1'])
+      self.assertEqual(vcenter.breaker.hosts['host-1']['failures'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
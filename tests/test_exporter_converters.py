@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Unit tests of the conversion of the CaptureInternalStats output of a host.
+# The expected samples in data/*.prom were converted by the handlers of the
+# exporter before they were replaced by the MetricSpecs of prometheus.py.
+
+import os
+import sys
+import copy
+import json
+import logging
+import unittest
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import prometheus
+import vsanPrometheusStats
+
+DATA_DIR = os.path.join(curDir(), 'data')
+# (stats key, metric) removed from the payloads of the missing key tests
+MISSING_KEYS = [
+   ('/vmkModules/lsom/disks/%s/info', 'info/physCapacityPending'),
+   ('/net/nics/$getVsanNetworkStats', 'rxtoterr'),
+]
+# The samples of MISSING_KEYS
+MISSING_SAMPLES = [
+   'vmware_vsan_disk_phys_capacity_pending_bytes{',
+   'vmware_esx_pnic_pkt_err_total{',
+]
+
+def LoadPayload(name):
+   with open(os.path.join(DATA_DIR, name + '.json')) as f:
+      data = json.load(f)
+   return data['hostInfo'], data['stats']
+
+def LoadSamples(name):
+   with open(os.path.join(DATA_DIR, name + '.prom')) as f:
+      return set(f.read().splitlines())
+
+def RemoveMetric(stats, key, metric):
+   node = stats[key]
+   col = node['metrics'].index(metric)
+   del node['metrics'][col]
+   for values in node['entities'].values():
+      del values[col]
+
+# Return the set of sample lines of the stats converted for the host
+def Convert(hostInfo, stats, caches=False):
+   hostInfo = dict(hostInfo)
+   if caches:
+      hostInfo['labelCache'] = prometheus.LabelCache()
+      hostInfo['schemaCache'] = prometheus.StatsSchemaCache('host')
+   rawStats = json.dumps({'stats': stats})
+   out = vsanPrometheusStats.GenerateStatsAsString(
+      [vsanPrometheusStats.ConvertStats(
+         hostInfo, vsanPrometheusStats.LoadStats(rawStats))])
+   samples = [line for line in out.splitlines()
+              if line and not line.startswith('#')]
+   assert len(samples) == len(set(samples))
+   return set(samples)
+
+
+class TestConverters(unittest.TestCase):
+   @classmethod
+   def setUpClass(cls):
+      logging.disable(logging.CRITICAL)
+
+   @classmethod
+   def tearDownClass(cls):
+      logging.disable(logging.NOTSET)
+
+   def test_vsan70(self):
+      hostInfo, stats = LoadPayload('stats-vsan70')
+      self.assertEqual(Convert(hostInfo, stats), LoadSamples('stats-vsan70'))
+
+   def test_pre70(self):
+      hostInfo, stats = LoadPayload('stats-vsan67')
+      self.assertEqual(Convert(hostInfo, stats), LoadSamples('stats-vsan67'))
+
+   def test_caches(self):
+      for name in ['stats-vsan70', 'stats-vsan67']:
+         hostInfo, stats = LoadPayload(name)
+         hostInfo['labelCache'] = prometheus.LabelCache()
+         hostInfo['schemaCache'] = prometheus.StatsSchemaCache('host')
+         expected = LoadSamples(name)
+         self.assertEqual(Convert(hostInfo, stats), expected)
+         # the second scrape is served from the caches
+         self.assertEqual(Convert(hostInfo, stats), expected)
+
+   def test_missingKey(self):
+      for name in ['stats-vsan70', 'stats-vsan67']:
+         hostInfo, stats = LoadPayload(name)
+         for key, metric in MISSING_KEYS:
+            RemoveMetric(stats, key, metric)
+         for caches in [False, True]:
+            samples = Convert(hostInfo, stats, caches)
+            # all samples converted before, except those of the missing keys
+            self.assertTrue(LoadSamples(name + '-missing') <= samples)
+            expected = set([
+               sample for sample in LoadSamples(name)
+               if not sample.startswith(MISSING_SAMPLES[0]) and
+                  not (sample.startswith(MISSING_SAMPLES[1]) and
+                       'io_type="rx"' in sample)])
+            self.assertEqual(samples, expected)
+
+   def test_missingScaleKey(self):
+      hostInfo, stats = LoadPayload('stats-vsan70')
+      key = '/storage/scsifw/devices/%r/info|stats:/vmkModules/plog/devices/%s/info[deviceUUID]'
+      RemoveMetric(stats, key, 'info/capacity/blockSize')
+      samples = Convert(hostInfo, stats)
+      scaled = [sample for sample in LoadSamples('stats-vsan70')
+                if sample.startswith('vmware_vsan_disks_dev_bytes_total{')]
+      self.assertTrue(scaled)
+      self.assertEqual(samples, LoadSamples('stats-vsan70') - set(scaled))
+
+   # The labels of an entity only depend on its name, whatever its values
+   def test_plogDrained(self):
+      nodeStats = {
+         'metrics': ['stats/totalBytesDrained', 'stats/ssdBytesDrained',
+                     'stats/zeroBytesDrained'],
+         'entities': {'disk-1': [10, 1, 2]}}
+      hostInfo = {'host_uuid': 'host-1', 'hostname': 'esx-1',
+                  'vsan_cluster_uuid': 'cluster-1', 'disks': {}, 'vmDict': {}}
+      labelCache = prometheus.LabelCache()
+      for cache in [None, labelCache, labelCache]:
+         if cache is not None:
+            cache.begin(hostInfo)
+         out = prometheus.SampleStore()
+         prometheus.plogDevicesStats.convert(out, '/vmkModules/plog/devices',
+            '%r/info|stats:./%s/info[deviceUUID]', copy.deepcopy(nodeStats),
+            labelCache=cache)
+         samples = dict(out.items())['vmware_vsan_disk_drain_bytes_total']
+         self.assertEqual(sorted([value for value, labels in samples]), [1, 2])
+
+   def test_compileUnresolved(self):
+      columns = prometheus.lsomDisks.columns(['info/capacity'])
+      stats = prometheus.lsomDisks.compile(None, columns)
+      metrics = [sample[0] for sample in stats.samples]
+      self.assertIn('vmware_vsan_disk_capacity_bytes', metrics)
+      self.assertNotIn('vmware_vsan_disk_phys_capacity_pending_bytes', metrics)
+      self.assertIn('physCapacityPending', stats.unresolved)
+
+class VmDict(dict):
+   version = 0
+
+def HostInfo():
+   return {'host_uuid': 'host-1', 'hostname': 'esx-1',
+           'vsan_cluster_uuid': 'cluster-1', 'version': 0, 'vmDict': VmDict(),
+           'disks': {'disk-1': {'Device': 'naa.1', 'VSAN UUID': 'disk-1',
+                                'VSAN Disk Group UUID': 'dg-1',
+                                'Is Capacity Tier': True}}}
+
+
+class TestLabelCache(unittest.TestCase):
+   def test_render(self):
+      labelCache = prometheus.LabelCache()
+      labelCache.begin(HostInfo())
+      self.assertEqual(labelCache.render([{'disk_uuid': 'disk-1'}]), [
+         'disk_uuid="disk-1",host_uuid="host-1",hostname="esx-1",'
+         'vsan_cluster_uuid="cluster-1",diskgroup_uuid="dg-1",'
+         'diskname="naa.1",disk_role="capacity"'])
+
+   # The entries not used by a whole conversion are dropped
+   def test_generations(self):
+      hostInfo = HostInfo()
+      labelCache = prometheus.LabelCache()
+      labelCache.begin(hostInfo)
+      self.assertIsNone(labelCache.get('a'))
+      labelCache.put('a', ['A'])
+      labelCache.put('b', ['B'])
+      self.assertEqual(labelCache.get('a'), ['A'])
+      labelCache.begin(hostInfo)
+      self.assertEqual(labelCache.get('a'), ['A'])
+      labelCache.begin(hostInfo)
+      self.assertEqual(labelCache.get('a'), ['A'])
+      self.assertIsNone(labelCache.get('b'))
+
+   # The entries are dropped when the disks or VMs of the host change
+   def test_topologyChanged(self):
+      hostInfo = HostInfo()
+      labelCache = prometheus.LabelCache()
+      labelCache.begin(hostInfo)
+      labelCache.put('a', ['A'])
+      hostInfo['version'] += 1
+      labelCache.begin(hostInfo)
+      self.assertIsNone(labelCache.get('a'))
+      labelCache.put('a', ['A'])
+      labelCache.begin(hostInfo)
+      self.assertEqual(labelCache.get('a'), ['A'])
+      hostInfo['vmDict'] = VmDict()
+      hostInfo['vmDict'].version = 1
+      labelCache.begin(hostInfo)
+      self.assertIsNone(labelCache.get('a'))
+
+   # The labels rendered after a change of the topology are current
+   def test_convert(self):
+      hostInfo, stats = LoadPayload('stats-vsan70')
+      hostInfo['labelCache'] = prometheus.LabelCache()
+      hostInfo['version'] = 0
+      Convert(hostInfo, stats)
+      diskUuid = next(iter(hostInfo['disks']))
+      hostInfo['disks'] = dict(hostInfo['disks'])
+      hostInfo['disks'][diskUuid] = dict(
+         hostInfo['disks'][diskUuid], Device='naa.renamed')
+      hostInfo['version'] += 1
+      samples = Convert(hostInfo, stats)
+      self.assertTrue([sample for sample in samples
+                       if 'diskname="naa.renamed"' in sample])
+      del hostInfo['labelCache']
+      self.assertEqual(samples, Convert(hostInfo, stats))
+
+if __name__ == '__main__':
+    unittest.main()
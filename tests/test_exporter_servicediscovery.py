@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Unit tests of the service discovery entries returned by the exporter.
+
+import os
+import sys
+import unittest
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import vsanPrometheusStats
+
+SERVER_HOST = '127.0.0.1:8080'
+
+class MockCluster:
+   def __init__(self, clusterName, hostIds):
+      self.clusterName = clusterName
+      self.hostMos = dict([(hostId, None) for hostId in hostIds])
+
+def CreateVCenter(vcip, clusters):
+   vcenter = vsanPrometheusStats.VsanVCenter(
+      vcip, 443, 'user', 'password',
+      [clusterName for clusterId, clusterName, hostIds in clusters],
+      pool=object())
+   vcenter.clusters = dict([(clusterId, MockCluster(clusterName, hostIds))
+                            for clusterId, clusterName, hostIds in clusters])
+   return vcenter
+
+# The exporter without connecting to the vCenters of its environment
+def CreateStats(vcenters, federated=False):
+   stats = object.__new__(vsanPrometheusStats.VsanPrometheusStats)
+   stats.vcenters = dict([(vcenter.vcip, vcenter) for vcenter in vcenters])
+   stats.federated = federated
+   return stats
+
+def MetricsPaths(entries):
+   return sorted([entry['labels']['__metrics_path__'] for entry in entries])
+
+
+class TestServiceDiscovery(unittest.TestCase):
+   def test_singleCluster(self):
+      vcenter = CreateVCenter('vc1', [('domain-c8', 'VSAN-Cluster',
+                                       ['host-16', 'host-22'])])
+      entries = CreateStats([vcenter]).serviceDiscovery(SERVER_HOST)
+      self.assertEqual(MetricsPaths(entries),
+                       ['/vsan/metrics/host-16', '/vsan/metrics/host-22'])
+      for entry in entries:
+         self.assertEqual(entry['targets'], [SERVER_HOST])
+         self.assertEqual(entry['labels']['cluster_id'], 'domain-c8')
+         self.assertEqual(entry['labels']['cluster_name'], 'VSAN-Cluster')
+         self.assertNotIn('vcenter', entry['labels'])
+
+   def test_clusters(self):
+      vcenter = CreateVCenter('vc1', [
+         ('domain-c8', 'VSAN-Cluster', ['host-16']),
+         ('domain-c9', 'VSAN-Cluster2', ['host-40'])])
+      entries = CreateStats([vcenter]).serviceDiscovery(SERVER_HOST)
+      self.assertEqual(MetricsPaths(entries),
+                       ['/vsan/metrics/domain-c8/host-16',
+                        '/vsan/metrics/domain-c9/host-40'])
+
+   # A single cluster in the VCENTERS_CONFIG file keeps the host paths
+   def test_federatedSingleCluster(self):
+      vcenter = CreateVCenter('vc1', [('domain-c8', 'VSAN-Cluster',
+                                       ['host-16'])])
+      entries = CreateStats([vcenter], True).serviceDiscovery(SERVER_HOST)
+      self.assertEqual(MetricsPaths(entries), ['/vsan/metrics/host-16'])
+      self.assertEqual(entries[0]['labels']['vcenter'], 'vc1')
+
+   def test_federated(self):
+      vcenters = [
+         CreateVCenter('vc1', [('domain-c8', 'VSAN-Cluster', ['host-16'])]),
+         CreateVCenter('vc2', [('domain-c8', 'VSAN-Cluster', ['host-16'])])]
+      entries = CreateStats(vcenters, True).serviceDiscovery(SERVER_HOST)
+      self.assertEqual(MetricsPaths(entries),
+                       ['/vsan/metrics/vc1/domain-c8/host-16',
+                        '/vsan/metrics/vc2/domain-c8/host-16'])
+      self.assertEqual(sorted([entry['labels']['vcenter']
+                               for entry in entries]), ['vc1', 'vc2'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Unit tests of the sharding of the hosts across the exporter replicas.
+
+import os
+import sys
+import logging
+import unittest
+from unittest.mock import patch
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import sharding
+
+PEERS = 'exporter-0:8080,exporter-1:8080,exporter-2:8080'
+
+
+KEYS = ['vc1/host-%d' % i for i in range(2000)]
+
+def Owners(ring):
+   return dict([(key, ring.getNode(key)) for key in KEYS])
+
+
+class TestHashRing(unittest.TestCase):
+   def setUp(self):
+      self.nodes = ['exporter-%d:8080' % i for i in range(4)]
+      self.owners = Owners(sharding.HashRing(self.nodes, 128))
+
+   def test_empty(self):
+      self.assertIsNone(sharding.HashRing([], 128).getNode('vc1/host-1'))
+
+   def test_stable(self):
+      # the owners don't depend on the order of the nodes
+      self.assertEqual(
+         Owners(sharding.HashRing(list(reversed(self.nodes)), 128)),
+         self.owners)
+      counts = [list(self.owners.values()).count(node)
+                for node in self.nodes]
+      self.assertTrue(all(count > len(KEYS) / 8 for count in counts), counts)
+
+   # Only the keys of the removed node move, to the other nodes
+   def test_removeNode(self):
+      removed = self.nodes[1]
+      owners = Owners(sharding.HashRing(
+         [node for node in self.nodes if node != removed], 128))
+      for key, node in self.owners.items():
+         if node == removed:
+            self.assertNotEqual(owners[key], removed)
+         else:
+            self.assertEqual(owners[key], node)
+
+   # Only keys moving to the added node move
+   def test_addNode(self):
+      added = 'exporter-4:8080'
+      owners = Owners(sharding.HashRing(self.nodes + [added], 128))
+      moved = [key for key, node in owners.items()
+               if node != self.owners[key]]
+      self.assertTrue(moved)
+      self.assertTrue(all(owners[key] == added for key in moved))
+      self.assertLess(len(moved), len(KEYS) / 3)
+
+
+class TestShardMembership(unittest.TestCase):
+   @classmethod
+   def setUpClass(cls):
+      logging.disable(logging.CRITICAL)
+
+   @classmethod
+   def tearDownClass(cls):
+      logging.disable(logging.NOTSET)
+
+   def createShards(self, peers, selfAddress):
+      with patch.object(sharding, 'SHARD_PEERS', peers), \
+           patch.object(sharding, 'SHARD_SELF', selfAddress), \
+           patch.object(sharding, 'SHARD_SERVICE', None):
+         return sharding.CreateShardMembership()
+
+   def test_disabled(self):
+      self.assertIsNone(self.createShards('', None))
+
+   def test_peers(self):
+      shards = self.createShards(PEERS, 'exporter-1:8080')
+      self.assertEqual(shards.selfAddress, 'exporter-1:8080')
+      self.assertEqual(shards.getPeers(), PEERS.split(','))
+      owners = set([shards.ownerOf('vc1/host-%d' % i) for i in range(100)])
+      self.assertEqual(owners, set(PEERS.split(',')))
+
+   # A replica is on its ring before it's resolvable from the service
+   def test_resolvedPeers(self):
+      shards = sharding.ShardMembership(
+         'exporter-1:8080', service='exporter:8080')
+      shards._update(['exporter-0:8080', 'exporter-2:8080'])
+      self.assertEqual(shards.getPeers(), PEERS.split(','))
+      owned = [key for key in KEYS if shards.owns(key)]
+      self.assertTrue(owned)
+      self.assertTrue(all(shards.ownerOf(key) == 'exporter-1:8080'
+                          for key in owned))
+
+   def test_selfNotInPeers(self):
+      self.assertRaises(Exception, self.createShards, PEERS, 'exporter-3:8080')
+      self.assertRaises(Exception, self.createShards, PEERS, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Unit tests of the collector process publishing the snapshots of the hosts.
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import unittest
+from unittest.mock import patch
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import snapshotStore
+
+class MockStats:
+   VCENTER = 'vc1'
+   VCENTERS_CONFIG = None
+
+   def __init__(self, connectFailures=0):
+      self.vcenters = {}
+      self.authToken = 'token'
+      self.connectFailures = connectFailures
+
+   def connectOnStart(self, vcip):
+      if self.connectFailures:
+         self.connectFailures -= 1
+      else:
+         self.vcenters[vcip] = object()
+
+   def iterStatsByHost(self):
+      return iter([])
+
+   def serviceDiscovery(self, serverHost):
+      return []
+
+   def generateExporterStats(self):
+      return ['vmware_vsan_exporter_vcenter_up{vcenter="vc1"} 1.000000', '']
+
+# Exit twice, the third collector runs until stopped
+def RunFailingCollector(restarts):
+   open(os.path.join(os.environ['TEST_SNAPSHOT_DIR'], str(restarts)),
+        'w').close()
+   if restarts < 2:
+      sys.exit(1)
+   time.sleep(60)
+
+
+class TestSnapshots(unittest.TestCase):
+   @classmethod
+   def setUpClass(cls):
+      logging.disable(logging.CRITICAL)
+
+   @classmethod
+   def tearDownClass(cls):
+      logging.disable(logging.NOTSET)
+
+   def setUp(self):
+      self.snapshotDir = tempfile.mkdtemp()
+      self.writer = snapshotStore.SnapshotWriter(self.snapshotDir)
+      self.reader = snapshotStore.SnapshotReader(self.snapshotDir)
+
+   def tearDown(self):
+      shutil.rmtree(self.snapshotDir)
+
+   def test_connectRetry(self):
+      created = []
+      def createStats():
+         if not created:
+            created.append(None)
+            raise Exception('VC unreachable')
+         vps = MockStats(connectFailures=1)
+         created.append(vps)
+         return vps
+      collector = snapshotStore.SnapshotCollector(createStats, self.writer, 1)
+      # the creation fails, then the connect of the created stats
+      self.assertFalse(collector.connect())
+      self.assertFalse(collector.connect())
+      self.assertTrue(collector.connect())
+      self.assertEqual(len(created), 2)
+      self.assertIn('vc1', collector.vps.vcenters)
+
+   def test_exporterStats(self):
+      self.assertIsNone(self.reader.readExporterStats())
+      collector = snapshotStore.SnapshotCollector(
+         MockStats, self.writer, 1, restarts=3)
+      collector.failures = 2
+      collector.publishExporterStats()
+      lines = self.reader.readExporterStats().decode('utf-8').splitlines()
+      self.assertIn('vmware_vsan_exporter_collector_restarts_total 3.000000',
+                    lines)
+      self.assertIn(
+         'vmware_vsan_exporter_snapshot_publish_failures_total 2.000000',
+         lines)
+      ages = [line for line in lines
+              if line.startswith('vmware_vsan_exporter_snapshot_age_seconds ')]
+      self.assertEqual(len(ages), 1)
+      self.assertLess(float(ages[0].split()[1]), 60)
+
+      collector.vps = MockStats()
+      collector.publishExporterStats()
+      lines = self.reader.readExporterStats().decode('utf-8').splitlines()
+      self.assertIn('vmware_vsan_exporter_vcenter_up{vcenter="vc1"} 1.000000',
+                    lines)
+
+   def test_supervise(self):
+      os.environ['TEST_SNAPSHOT_DIR'] = self.snapshotDir
+      with patch.object(snapshotStore, 'RunCollector', RunFailingCollector), \
+           patch.object(snapshotStore, 'COLLECTOR_RESTART_DELAY', 0):
+         try:
+            snapshotStore.StartCollectorProcess()
+            path = os.path.join(self.snapshotDir, '2')
+            for i in range(100):
+               if os.path.exists(path):
+                  break
+               time.sleep(0.1)
+            self.assertTrue(os.path.exists(path))
+            process = snapshotStore._collectorProcess
+            snapshotStore.StopCollectorProcess()
+            self.assertFalse(process.is_alive())
+         finally:
+            snapshotStore.StopCollectorProcess()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Unit tests of the selective parser of the CaptureInternalStats output, the
+# converted stats nodes are decoded like json.loads does.
+
+import os
+import sys
+import json
+import unittest
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import vsanPrometheusStats
+from statsParser import StatsParser
+
+DATA_DIR = os.path.join(curDir(), 'data')
+VCPUS_KEY = '/sched/Vcpus/$getLsomWorldInformation'
+
+def LoadRawStats(name, **kwargs):
+   with open(os.path.join(DATA_DIR, name + '.json')) as f:
+      stats = json.load(f)['stats']
+   return json.dumps({'stats': stats}, **kwargs)
+
+
+class TestStatsParser(unittest.TestCase):
+   def assertLoadedLikeJson(self, rawStats):
+      stats = vsanPrometheusStats.LoadStats(rawStats)['stats']
+      expected = json.loads(rawStats)['stats']
+      self.assertEqual(stats.keys(), expected.keys())
+      for key, nodeStats in stats.items():
+         if key in vsanPrometheusStats.STATS_DISPATCH:
+            self.assertEqual(nodeStats, expected[key], key)
+         else:
+            self.assertIsNone(nodeStats, key)
+      return stats
+
+   def test_payloads(self):
+      for name in ['stats-vsan70', 'stats-vsan67']:
+         for kwargs in [{}, {'indent': 3}, {'separators': (',', ':')}]:
+            stats = self.assertLoadedLikeJson(LoadRawStats(name, **kwargs))
+            self.assertIsNotNone(stats[VCPUS_KEY])
+
+   # The node names within strings are not nodes
+   def test_nodeNamesInStrings(self):
+      stats = {
+         '/unknown/$node': {
+            'metrics': ['name'],
+            'entities': {'a': ['"%s": {' % VCPUS_KEY], 'b': ['{,"/x": {']},
+         },
+         VCPUS_KEY: {
+            'metrics': ['upTime', 'usedTime', 'readyTime'],
+            'entities': {'host|PLOG-"{x}",|1': [1, 2.5, -1]},
+         },
+      }
+      for kwargs in [{}, {'indent': 1}]:
+         rawStats = json.dumps(
+            {'version': '1', 'stats': stats, 'tail': {}}, **kwargs)
+         loaded = vsanPrometheusStats.LoadStats(rawStats)['stats']
+         self.assertEqual(loaded[VCPUS_KEY], stats[VCPUS_KEY])
+         self.assertIsNone(loaded['/unknown/$node'])
+         self.assertNotIn('/x', loaded)
+
+   def test_noStats(self):
+      for rawStats in ['', '{}', '{"version": "1"}']:
+         self.assertRaises(json.JSONDecodeError,
+                           vsanPrometheusStats.LoadStats, rawStats)
+
+   def test_badNode(self):
+      rawStats = '{"stats": {"%s": {"metrics": [1, }}}' % VCPUS_KEY
+      self.assertRaises(json.JSONDecodeError,
+                        vsanPrometheusStats.LoadStats, rawStats)
+      # nodes not converted aren't decoded
+      rawStats = '{"stats": {"/unknown/$node": {"metrics": [1, }}}'
+      self.assertEqual(StatsParser([VCPUS_KEY]).load(rawStats),
+                       {'stats': {'/unknown/$node': None}})
+
+if __name__ == '__main__':
+    unittest.main()
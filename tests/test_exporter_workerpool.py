@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Unit tests of the worker pool running the host connect and fetch tasks.
+
+import os
+import sys
+import queue
+import logging
+import threading
+import unittest
+
+def curDir():
+   curFile = os.path.realpath(__file__)
+   return os.path.dirname(curFile)
+
+sys.path.append(os.path.join(curDir(), '..', 'vsan-prometheus-exporter'))
+
+import workerPool
+from workerPool import WorkerPool
+
+
+class TestWorkerPool(unittest.TestCase):
+   @classmethod
+   def setUpClass(cls):
+      logging.disable(logging.CRITICAL)
+
+   @classmethod
+   def tearDownClass(cls):
+      logging.disable(logging.NOTSET)
+
+   def setUp(self):
+      self.release = threading.Event()
+
+   def tearDown(self):
+      self.release.set()
+
+   def test_result(self):
+      pool = WorkerPool(2, 8, 'test')
+      futures = [pool.submit(pow, i, 2) for i in range(10)]
+      self.assertEqual([future.result(10) for future in futures],
+                       [i * i for i in range(10)])
+      pool.tasks.join()
+      stats = pool.getStats()
+      self.assertEqual(stats['workers'], 2)
+      self.assertEqual(stats['started'], 10)
+      self.assertEqual(stats['queued'], 0)
+      self.assertGreaterEqual(stats['queueWaitMax'], 0)
+      self.assertGreaterEqual(stats['queueWaitSum'], stats['queueWaitMax'])
+      for future in futures:
+         self.assertIsNotNone(future.queueWaitTime)
+
+   def test_exception(self):
+      pool = WorkerPool(1, 8, 'test')
+      future = pool.submit(int, 'not a number')
+      self.assertRaises(ValueError, future.result, 10)
+      # the worker survives the failed task
+      self.assertEqual(pool.submit(int, '5').result(10), 5)
+
+   # No more tasks than workers run at the same time
+   def test_maxWorkers(self):
+      pool = WorkerPool(2, 8, 'test')
+      lock = threading.Lock()
+      running = [0, 0]
+      def task():
+         with lock:
+            running[0] += 1
+            running[1] = max(running[1], running[0])
+         self.release.wait(10)
+         with lock:
+            running[0] -= 1
+      futures = [pool.submit(task) for i in range(6)]
+      while pool.getStats()['started'] < 2:
+         self.release.wait(0.01)
+      self.assertEqual(pool.getStats()['started'], 2)
+      self.release.set()
+      for future in futures:
+         future.result(10)
+      self.assertEqual(running[1], 2)
+
+   def test_queueFull(self):
+      pool = WorkerPool(1, 1, 'test')
+      pool.submit(self.release.wait, 10)
+      while pool.getStats()['started'] < 1:
+         self.release.wait(0.01)
+      queued = pool.submit(pow, 2, 2)
+      self.assertRaises(queue.Full, pool.submit, pow, 3, 2, block=False)
+      self.release.set()
+      self.assertEqual(queued.result(10), 4)
+
+   def test_cancel(self):
+      pool = WorkerPool(1, 8, 'test')
+      pool.submit(self.release.wait, 10)
+      future = pool.submit(pow, 2, 2)
+      self.assertTrue(future.cancel())
+      self.release.set()
+      pool.tasks.join()
+      self.assertTrue(future.cancelled())
+      self.assertEqual(pool.getStats()['started'], 1)
+
+   def test_sharedPool(self):
+      self.assertIs(workerPool.GetSharedWorkerPool(),
+                    workerPool.GetSharedWorkerPool())
+
+if __name__ == '__main__':
+    unittest.main()
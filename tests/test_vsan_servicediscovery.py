@@ -14,6 +14,11 @@ import importlib
 
 VSAN_PROVIDER = '[{"labels":{"__metrics_path__":"/vsan/metrics/host-16",' \
                 '"cluster_id":"domain-c8","cluster_name":"VSAN-Cluster"},"targets":["127.0.0.1:8080"]}]'
+# Provider of an exporter which monitors several clusters
+VSAN_PROVIDER_CLUSTERS = '[{"labels":{"__metrics_path__":"/vsan/metrics/domain-c8/host-16",' \
+                         '"cluster_id":"domain-c8","cluster_name":"VSAN-Cluster"},"targets":["127.0.0.1:8080"]},' \
+                         '{"labels":{"__metrics_path__":"/vsan/metrics/domain-c9/host-40",' \
+                         '"cluster_id":"domain-c9","cluster_name":"VSAN-Cluster2"},"targets":["127.0.0.1:8080"]}]'
 SERVER_JSON = './servers.json'
 TOKEN = 'f3209af8-9d73-4d74-a4c9-5d1f14'
 
@@ -50,6 +55,13 @@ class TestVsanPrometheusSetup(unittest.TestCase):
          self.assertEqual(content, VSAN_PROVIDER)
       os.remove(SERVER_JSON)
 
+   def test_updateServerListClusters(self):
+      vsanServicediscovery.updateServerList(VSAN_PROVIDER_CLUSTERS)
+      with open(SERVER_JSON, 'r') as f:
+         content = f.read()
+         self.assertEqual(content, VSAN_PROVIDER_CLUSTERS)
+      os.remove(SERVER_JSON)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# asyncio based collector doing the VsanPerfLogin / CaptureInternalStats SOAP
+# exchange against the host /vsan endpoint over non-blocking HTTP, so that the
+# stats of hundreds of hosts can be fetched concurrently from a single thread.
+
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+from hostConnections import (
+   GetHostSslContext, ResolveHost, InvalidateHost, BodyDecoder,
+   HOST_COMPRESSION, ACCEPT_ENCODING, HOST_FETCH_TIMEOUT)
+
+# Set to "asyncio" to fetch host stats with the asyncio collector
+COLLECTOR_MODE = os.environ.get('COLLECTOR_MODE', 'thread')
+ASYNC_COLLECTOR = COLLECTOR_MODE == 'asyncio'
+# The max number of host fetches in flight at the same time
+ASYNC_MAX_IN_FLIGHT = int(os.environ.get('ASYNC_MAX_IN_FLIGHT', 256))
+# The timeout in seconds of one host fetch, including the login if needed and
+# the wait for a free slot. At most HOST_FETCH_TIMEOUT, so a fetch doesn't
+# hold its slot after the scrape gave up on it.
+ASYNC_FETCH_TIMEOUT = min(
+   int(os.environ.get('ASYNC_FETCH_TIMEOUT', HOST_FETCH_TIMEOUT)),
+   HOST_FETCH_TIMEOUT)
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+# vim.version.version9, the version used by connectUtils.ConnectToHost
+VIM_NS = 'urn:vim25'
+SOAP_ACTION = 'urn:vim25/6.0'
+SESSION_COOKIE = 'vmware_soap_session'
+# The max bytes of the response body read at once
+READ_CHUNK_SIZE = 65536
+
+_SOAP_REQUEST = (
+   '<?xml version="1.0" encoding="UTF-8"?>'
+   '<soapenv:Envelope xmlns:soapenc="http://schemas.xmlsoap.org/soap/encoding/"'
+   ' xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"'
+   ' xmlns:xsd="http://www.w3.org/2001/XMLSchema"'
+   ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
+   '<soapenv:Body>%s</soapenv:Body></soapenv:Envelope>'
+)
+
+
+class SoapFault(Exception):
+   def __init__(self, faultString, faultType=None):
+      Exception.__init__(self, faultString)
+      self.faultType = faultType
+
+   def isNotAuthenticated(self):
+      return self.faultType == 'NotAuthenticatedFault'
+
+
+def _BuildSoapRequest(method, moType, moId, params):
+   paramsStr = ''.join(
+      '<%s>%s</%s>' % (k, escape(v), k) for k, v in params)
+   return (_SOAP_REQUEST % (
+      '<%s xmlns="%s"><_this type="%s">%s</_this>%s</%s>' % (
+         method, VIM_NS, moType, moId, paramsStr, method))).encode('utf-8')
+
+# Return the text of "returnval" in the parsed SOAP response, raise SoapFault
+# if the response is a fault
+def _ParseSoapResponse(root):
+   soapBody = root.find('{%s}Body' % SOAP_ENV_NS)
+   if soapBody is None or len(soapBody) == 0:
+      raise SoapFault('Malformed SOAP response')
+   fault = soapBody.find('{%s}Fault' % SOAP_ENV_NS)
+   if fault is not None:
+      faultString = fault.findtext('faultstring') or 'Unknown SOAP fault'
+      faultType = None
+      detail = fault.find('detail')
+      if detail is not None and len(detail) > 0:
+         faultType = detail[0].tag.split('}')[-1]
+      raise SoapFault(faultString, faultType)
+   returnval = soapBody[0].find('{%s}returnval' % VIM_NS)
+   return returnval.text if returnval is not None else None
+
+def _ParseSessionCookie(setCookie):
+   cookie = setCookie.split(';', 1)[0].strip()
+   if cookie.startswith(SESSION_COOKIE + '='):
+      return cookie
+   return None
+
+
+# Parser of a SOAP response body fed piece by piece as it's received, every
+# piece is decompressed and parsed right away. A parse error is raised on
+# close, so the rest of the body is still read off the connection.
+class _SoapResponseParser:
+   def __init__(self, hostname, encoding):
+      self.decoder = BodyDecoder(hostname, encoding)
+      self.parser = ET.XMLParser()
+      self.error = None
+
+   def feed(self, data):
+      if self.error is not None:
+         return
+      try:
+         self.parser.feed(self.decoder.decode(data))
+      except Exception as ex:
+         self.error = ex
+
+   # Return the root element of the response
+   def close(self):
+      if self.error is None:
+         try:
+            self.parser.feed(self.decoder.flush())
+            return self.parser.close()
+         except Exception as ex:
+            self.error = ex
+      raise self.error
+
+
+# Keep-alive SOAP client of the /vsan endpoint of one host. Its coroutines
+# must run on the event loop of the AsyncCollector.
+class VsanHostAsyncClient:
+   def __init__(self, hostname, token, port=443, sslContext=None):
+      self.hostname = hostname
+      self.token = token
+      self.port = port
+      self.sslContext = sslContext or GetHostSslContext()
+      self.cookie = None
+      self.reader = None
+      self.writer = None
+      self.lock = None
+      self.lastUsed = time.time()
+
+   # Same signature as VsanInternalStatsProvider.CaptureInternalStats, so the
+   # client can be used in place of it from any thread
+   def CaptureInternalStats(self, callerNodeId=None, interval=None,
+                            verboseMode=False):
+      return GetAsyncCollector().fetch(self)
+
+   # Log in again ahead of the session expiring, see
+   # hostConnections.HostSessionRefresher
+   def refreshSession(self):
+      GetAsyncCollector().refreshSession(self)
+
+   async def captureInternalStats(self):
+      if self.lock is None:
+         self.lock = asyncio.Lock()
+      self.lastUsed = time.time()
+      async with self.lock:
+         if self.cookie is None:
+            await self._login()
+         try:
+            return await self._captureInternalStats()
+         except SoapFault as ex:
+            if not ex.isNotAuthenticated():
+               raise
+            logging.info('Session of host %s expired, login again',
+               self.hostname)
+            await self._login()
+            return await self._captureInternalStats()
+
+   async def login(self):
+      if self.lock is None:
+         self.lock = asyncio.Lock()
+      async with self.lock:
+         await self._login()
+      self.lastUsed = time.time()
+
+   async def close(self):
+      if self.writer is not None:
+         self.writer.close()
+      self.reader = self.writer = None
+
+   async def _login(self):
+      self.cookie = None
+      body = _BuildSoapRequest('VsanPerfLogin', 'VsanPerformanceManager',
+         'vsan-performance-manager', [('token', self.token)])
+      if await self._call(body) == 'true':
+         logging.info('Host %s authenticated successfully', self.hostname)
+      else:
+         logging.error('Host %s failed to authenticate', self.hostname)
+
+   async def _captureInternalStats(self):
+      body = _BuildSoapRequest('CaptureInternalStats',
+         'VsanInternalStatsProvider', 'vsan-internal-statsprovider', [])
+      return await self._call(body)
+
+   async def _call(self, body):
+      headers = [
+         'POST /vsan HTTP/1.1',
+         'Host: %s' % self.hostname,
+         'Content-Type: text/xml; charset=utf-8',
+         'SOAPAction: "%s"' % SOAP_ACTION,
+         'Content-Length: %d' % len(body),
+         'Connection: keep-alive',
+      ]
+      if HOST_COMPRESSION:
+         headers.append('Accept-Encoding: %s' % ACCEPT_ENCODING)
+      if self.cookie:
+         headers.append('Cookie: %s' % self.cookie)
+      request = ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body
+
+      # retry once on a fresh connection if the idle one was closed by host
+      for attempt in range(2):
+         reused = self.writer is not None
+         if not reused:
+            # cached mostly, resolved off the event loop otherwise
+            address = await asyncio.get_event_loop().run_in_executor(
+               None, ResolveHost, self.hostname, self.port)
+            try:
+               self.reader, self.writer = await asyncio.open_connection(
+                  address, self.port, ssl=self.sslContext,
+                  server_hostname=self.hostname)
+            except OSError:
+               InvalidateHost(self.hostname)
+               raise
+         try:
+            self.writer.write(request)
+            await self.writer.drain()
+            status, respHeaders, respParser = await self._readResponse()
+            break
+         except (ConnectionError, asyncio.IncompleteReadError):
+            await self.close()
+            if not reused or attempt > 0:
+               raise
+
+      if respHeaders.get('connection', '').lower() == 'close':
+         await self.close()
+      for setCookie in respHeaders.get('set-cookie', []):
+         cookie = _ParseSessionCookie(setCookie)
+         if cookie:
+            self.cookie = cookie
+      if status != 200 and status != 500:
+         raise Exception('Unexpected HTTP status %d from host %s' % (
+            status, self.hostname))
+      return _ParseSoapResponse(respParser.close())
+
+   async def _readResponse(self):
+      statusLine = await self.reader.readline()
+      if not statusLine:
+         raise ConnectionError('Connection closed by host %s' % self.hostname)
+      status = int(statusLine.split()[1])
+      headers = {'set-cookie': []}
+      while True:
+         line = await self.reader.readline()
+         if line in (b'\r\n', b'\n', b''):
+            break
+         name, value = line.decode('latin-1').split(':', 1)
+         name = name.strip().lower()
+         if name == 'set-cookie':
+            headers[name].append(value.strip())
+         else:
+            headers[name] = value.strip()
+
+      parser = _SoapResponseParser(
+         self.hostname, headers.get('content-encoding'))
+      if headers.get('transfer-encoding', '').lower() == 'chunked':
+         while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+               # skip the trailer
+               while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                  pass
+               break
+            await self._readBody(parser, size)
+            await self.reader.readexactly(2)
+      elif 'content-length' in headers:
+         await self._readBody(parser, int(headers['content-length']))
+      else:
+         while True:
+            data = await self.reader.read(READ_CHUNK_SIZE)
+            if not data:
+               break
+            parser.feed(data)
+         headers['connection'] = 'close'
+      return status, headers, parser
+
+   # Feed size bytes of the body to parser as they are received
+   async def _readBody(self, parser, size):
+      while size > 0:
+         data = await self.reader.read(min(size, READ_CHUNK_SIZE))
+         if not data:
+            raise asyncio.IncompleteReadError(b'', size)
+         parser.feed(data)
+         size -= len(data)
+
+
+# Event loop running on a dedicated thread, which drives the fetches of all
+# VsanHostAsyncClient instances
+class AsyncCollector:
+   def __init__(self, maxInFlight, fetchTimeout):
+      self.maxInFlight = maxInFlight
+      self.fetchTimeout = fetchTimeout
+      self.semaphore = None
+      self.loop = asyncio.new_event_loop()
+      self.thread = threading.Thread(
+         target=self.loop.run_forever, name='async-collector', daemon=True)
+      self.thread.start()
+
+   async def _fetch(self, client):
+      return await asyncio.wait_for(
+         self._fetchInSlot(client), self.fetchTimeout)
+
+   async def _fetchInSlot(self, client):
+      if self.semaphore is None:
+         self.semaphore = asyncio.Semaphore(self.maxInFlight)
+      async with self.semaphore:
+         t1 = time.time()
+         try:
+            return await client.captureInternalStats()
+         except:
+            # drop the connection, it's in unknown state after a failure
+            await client.close()
+            raise
+         finally:
+            logging.info('Fetching stats for %s took %.2fs',
+               client.hostname, time.time() - t1)
+
+   # Fetch the raw stats of one host, blocking the calling thread
+   def fetch(self, client):
+      return asyncio.run_coroutine_threadsafe(
+         self._fetch(client), self.loop).result()
+
+   # Log in to the host again, blocking the calling thread
+   def refreshSession(self, client):
+      asyncio.run_coroutine_threadsafe(
+         asyncio.wait_for(client.login(), self.fetchTimeout), self.loop).result()
+
+   # Fetch the raw stats of all hosts concurrently. Yield (hostId, raw stats
+   # or the exception raised) in the order the fetches complete.
+   def fetchAsCompleted(self, clients):
+      done = queue.Queue()
+      for hostId, client in clients.items():
+         future = asyncio.run_coroutine_threadsafe(
+            self._fetch(client), self.loop)
+         future.add_done_callback(
+            lambda f, hostId=hostId: done.put((hostId, f)))
+      for _ in range(len(clients)):
+         hostId, future = done.get()
+         try:
+            rawStats = future.result()
+         except BaseException as ex:
+            rawStats = ex
+         yield hostId, rawStats
+
+
+_collector = None
+_collectorLock = threading.Lock()
+
+def GetAsyncCollector():
+   global _collector
+   with _collectorLock:
+      if _collector is None:
+         logging.info('Start asyncio collector, max in flight %d',
+            ASYNC_MAX_IN_FLIGHT)
+         _collector = AsyncCollector(ASYNC_MAX_IN_FLIGHT, ASYNC_FETCH_TIMEOUT)
+      return _collector
@@ -4,13 +4,16 @@
 # SPDX-License-Identifier: BSD-2-Clause
 #
 
-import ssl
+import time
 import atexit
 import logging
 
 from pyVim.connect import SmartConnectNoSSL, Disconnect, VimSessionOrientedStub
 from pyVmomi import vim, SoapStubAdapter
 import vsanmgmtObjects
+from asyncCollector import VsanHostAsyncClient
+from hostConnections import (
+   GetHostSslContext, HostHTTPSConnection, HOST_COMPRESSION)
 
 
 def _GetDataCenters(rootFolder):
@@ -44,16 +47,71 @@ def ConnectToVC(vchost, vcport, vcuser, vcpassword):
    atexit.register(Disconnect, si)
    return si
 
-def ConnectToHost(hostRef):
-   hostname = hostRef.name
+# Session oriented stub of the /vsan endpoint of a host, which tracks when it
+# was last used and can log in again ahead of the session expiring, see
+# hostConnections.HostSessionRefresher
+class VsanHostStub(VimSessionOrientedStub):
+   def __init__(self, soapStub, hostname, token):
+      VimSessionOrientedStub.__init__(
+         self, soapStub, _makeHostLoginMethod(hostname, token))
+      self.lastUsed = time.time()
+
+   def InvokeMethod(self, mo, info, args):
+      self.lastUsed = time.time()
+      return VimSessionOrientedStub.InvokeMethod(self, mo, info, args)
+
+   # Log in now instead of on the next call, under the lock the stub logs in
+   # with when the session is found gone
+   def refreshSession(self):
+      with self.lock:
+         self.loginMethod(self.soapStub)
+         self.state = self.STATE_AUTHENTICATED
+      self.lastUsed = time.time()
+
+# hostname and vsanSystem can be given from a bulk loaded inventory to save
+# reading them from hostRef
+def ConnectToHost(hostRef, hostname=None, vsanSystem=None):
+   hostname = hostname or hostRef.name
    stub = SoapStubAdapter(
       host=hostname,
       path='/vsan',
       version='vim.version.version9',
-      sslContext=ssl._create_unverified_context())
-
-   token = hostRef.configManager.vsanSystem.FetchVsanSharedSecret()
-   return VimSessionOrientedStub(stub, _makeHostLoginMethod(hostname, token))
+      sslContext=GetHostSslContext(),
+      acceptCompressedResponses=bool(HOST_COMPRESSION))
+   # keep-alive connections of the stub pool are opened with the cached
+   # address and TLS session of the host, and decompress responses as read
+   stub.scheme = HostHTTPSConnection
+
+   vsanSystem = vsanSystem or hostRef.configManager.vsanSystem
+   token = vsanSystem.FetchVsanSharedSecret()
+   stub = VsanHostStub(stub, hostname, token)
+   _LoginOnConnect(stub, hostname)
+   return stub
+
+# Same as ConnectToHost, but return a client for the asyncio collector, which
+# can be used in place of vim.cluster.VsanInternalStatsProvider
+def ConnectToHostAsync(hostRef, hostname=None, vsanSystem=None):
+   hostname = hostname or hostRef.name
+   vsanSystem = vsanSystem or hostRef.configManager.vsanSystem
+   token = vsanSystem.FetchVsanSharedSecret()
+   client = VsanHostAsyncClient(hostname, token)
+   _LoginOnConnect(client, hostname)
+   return client
+
+# Log in on connect, so the first scrape doesn't wait on it. A host failing
+# now is still connected and logged in by its first call.
+def _LoginOnConnect(session, hostname):
+   try:
+      session.refreshSession()
+   except:
+      logging.exception('Failed to log in to host %s', hostname)
+
+# Return the session of the connected host, with lastUsed and
+# refreshSession(), of vis returned by GetHostMos
+def GetHostSession(vis):
+   if isinstance(vis, VsanHostAsyncClient):
+      return vis
+   return vis._stub
 
 def _makeHostLoginMethod(hostname, token):
    def _doLogin(soapStub):
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Connection management of the host /vsan endpoints shared by the pyVmomi
+# stubs and the asyncio collector: one SSL context for all hosts, cached DNS
+# resolution, TLS session resumption of new connections, compressed responses
+# with per-host byte counters, and a background refresher logging in again to
+# idle host sessions before they expire.
+
+import os
+import ssl
+import time
+import zlib
+import queue
+import socket
+import logging
+import threading
+import http.client
+
+from workerPool import GetSharedWorkerPool
+
+# The seconds a resolved host address is cached
+HOST_DNS_TTL = int(os.environ.get('HOST_DNS_TTL', 300))
+# The interval to log in again to hosts idle for that long, so their sessions
+# don't expire between scrapes. Disabled if 0
+HOST_SESSION_REFRESH_INTERVAL = int(
+   os.environ.get('HOST_SESSION_REFRESH_INTERVAL', 600))
+# Set to 0 to not ask hosts for gzip or deflate compressed responses
+HOST_COMPRESSION = int(os.environ.get('HOST_COMPRESSION', 1))
+# The max seconds a scrape waits for the stats of a host. It's also the
+# socket timeout of the host connections, so a hung host doesn't hold a
+# worker after the scrape gave up on it.
+HOST_FETCH_TIMEOUT = int(os.environ.get('HOST_FETCH_TIMEOUT', 30))
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+# Cache of host name -> resolved address, so new connections don't wait on
+# DNS. The stale address is kept if DNS fails, and dropped if it can't be
+# connected.
+class HostResolver:
+   def __init__(self, ttl):
+      self.ttl = ttl
+      self.lock = threading.Lock()
+      # hostname -> (address, expire time)
+      self.addresses = {}
+
+   def resolve(self, hostname, port):
+      now = time.time()
+      with self.lock:
+         entry = self.addresses.get(hostname)
+      if entry is not None and entry[1] > now:
+         return entry[0]
+      try:
+         infos = socket.getaddrinfo(hostname, port, type=socket.SOCK_STREAM)
+      except socket.gaierror:
+         if entry is None:
+            raise
+         logging.warning('Failed to resolve host %s, use cached address %s',
+            hostname, entry[0])
+         return entry[0]
+      address = infos[0][4][0]
+      with self.lock:
+         self.addresses[hostname] = (address, now + self.ttl)
+      return address
+
+   def invalidate(self, hostname):
+      with self.lock:
+         self.addresses.pop(hostname, None)
+
+
+# The last TLS session of every host, offered for resumption by the next
+# connection to the host
+class TlsSessionCache:
+   def __init__(self):
+      self.lock = threading.Lock()
+      # (hostname, port) -> ssl.SSLSession
+      self.sessions = {}
+
+   def get(self, key):
+      with self.lock:
+         return self.sessions.get(key)
+
+   def put(self, key, session):
+      if session is None:
+         return
+      with self.lock:
+         self.sessions[key] = session
+
+   def discard(self, key):
+      with self.lock:
+         self.sessions.pop(key, None)
+
+
+# Response body bytes received from every host, as sent on the wire and
+# decompressed
+class HostTransferStats:
+   def __init__(self):
+      self.lock = threading.Lock()
+      # hostname -> [wire bytes, decompressed bytes]
+      self.hosts = {}
+
+   def record(self, hostname, wireBytes, decodedBytes):
+      with self.lock:
+         counters = self.hosts.setdefault(hostname, [0, 0])
+         counters[0] += wireBytes
+         counters[1] += decodedBytes
+
+   # Return (wire bytes, decompressed bytes) received from the host
+   def get(self, hostname):
+      with self.lock:
+         return tuple(self.hosts.get(hostname, (0, 0)))
+
+
+_sslContext = ssl._create_unverified_context()
+_resolver = HostResolver(HOST_DNS_TTL)
+_tlsSessions = TlsSessionCache()
+_transferStats = HostTransferStats()
+
+# The SSL context of all host connections, TLS sessions can be resumed only
+# with the context they were created by
+def GetHostSslContext():
+   return _sslContext
+
+def ResolveHost(hostname, port):
+   return _resolver.resolve(hostname, port)
+
+def InvalidateHost(hostname):
+   _resolver.invalidate(hostname)
+
+def GetHostTransferStats(hostname):
+   return _transferStats.get(hostname)
+
+
+# Incremental decoder of a response body of the host in Content-Encoding
+# encoding. Every piece is decompressed as it's received, so the body is
+# never held compressed as a whole.
+class BodyDecoder:
+   def __init__(self, hostname, encoding):
+      self.hostname = hostname
+      encoding = (encoding or 'identity').strip().lower()
+      if encoding in ('gzip', 'x-gzip', 'deflate'):
+         # detect the gzip or zlib header
+         self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+      elif encoding == 'identity':
+         self.decompressor = None
+      else:
+         raise Exception('Unsupported Content-Encoding %s from host %s' % (
+            encoding, hostname))
+
+   def decode(self, data):
+      if self.decompressor is None:
+         out = data
+      else:
+         out = self.decompressor.decompress(data)
+      _transferStats.record(self.hostname, len(data), len(out))
+      return out
+
+   def flush(self):
+      if self.decompressor is None:
+         return b''
+      out = self.decompressor.flush()
+      _transferStats.record(self.hostname, 0, len(out))
+      return out
+
+
+# HTTPResponse decompressing the body as it's read by the SOAP parser of the
+# pyVmomi stub, which sees a plain response
+class HostHTTPResponse(http.client.HTTPResponse):
+   def begin(self):
+      http.client.HTTPResponse.begin(self)
+      self.decoder = None
+      self.pending = bytearray()
+      self.drained = False
+      self.encoding = self.msg.get('Content-Encoding')
+      if self.encoding is not None:
+         # decompressed here, the stub must not decompress it again
+         del self.msg['Content-Encoding']
+
+   def read(self, amt=None):
+      if self.decoder is None:
+         return http.client.HTTPResponse.read(self, amt)
+      while not self.drained and (amt is None or len(self.pending) < amt):
+         data = http.client.HTTPResponse.read(self, amt)
+         if not data:
+            self.pending += self.decoder.flush()
+            self.drained = True
+            break
+         self.pending += self.decoder.decode(data)
+      if amt is None:
+         amt = len(self.pending)
+      data = bytes(self.pending[:amt])
+      del self.pending[:amt]
+      return data
+
+
+# HTTPSConnection to a host with the cached address of the host and resuming
+# the last TLS session of the host, used by the pyVmomi host stubs
+class HostHTTPSConnection(http.client.HTTPSConnection):
+   response_class = HostHTTPResponse
+
+   def __init__(self, host, **kwargs):
+      kwargs.setdefault('timeout', HOST_FETCH_TIMEOUT)
+      http.client.HTTPSConnection.__init__(self, host, **kwargs)
+
+   def getresponse(self):
+      response = http.client.HTTPSConnection.getresponse(self)
+      response.decoder = BodyDecoder(self.host, response.encoding)
+      return response
+
+   def connect(self):
+      address = ResolveHost(self.host, self.port)
+      try:
+         sock = socket.create_connection(
+            (address, self.port), self.timeout, self.source_address)
+      except OSError:
+         InvalidateHost(self.host)
+         raise
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      key = (self.host, self.port)
+      session = _tlsSessions.get(key)
+      try:
+         self.sock = self._context.wrap_socket(
+            sock, server_hostname=self.host, session=session)
+      except:
+         sock.close()
+         # the host may reject the cached session, don't offer it again
+         _tlsSessions.discard(key)
+         raise
+      if session is not None and not self.sock.session_reused:
+         logging.debug('TLS session of host %s not resumed', self.host)
+      _tlsSessions.put(key, self.sock.session)
+
+   def close(self):
+      # with TLS 1.3 the resumable session is known only after the handshake
+      if self.sock is not None and hasattr(self.sock, 'session'):
+         _tlsSessions.put((self.host, self.port), self.sock.session)
+      http.client.HTTPSConnection.close(self)
+
+
+# Log in again to the hosts whose session has been idle for interval, so the
+# sessions and their keep-alive connections are warm when the hosts are
+# scraped. getSessions() returns hostId -> session, a session has the time it
+# was last used as lastUsed and refreshSession() to log in again.
+class HostSessionRefresher:
+   def __init__(self, getSessions, interval, pool=None):
+      self.getSessions = getSessions
+      self.interval = interval
+      self.pool = pool or GetSharedWorkerPool()
+      self.stopEvent = threading.Event()
+      self.thread = None
+
+   def start(self):
+      if self.thread is not None:
+         return
+      logging.info('Start refreshing host sessions idle for %ds',
+         self.interval)
+      self.thread = threading.Thread(
+         target=self._run, name='session-refresher', daemon=True)
+      self.thread.start()
+
+   def stop(self):
+      self.stopEvent.set()
+
+   def _refresh(self, hostId, session):
+      try:
+         session.refreshSession()
+      except:
+         logging.exception('Failed to refresh session of host %s', hostId)
+
+   def _run(self):
+      while not self.stopEvent.wait(self.interval):
+         try:
+            idleSince = time.time() - self.interval
+            for hostId, session in self.getSessions().items():
+               if session.lastUsed > idleSince:
+                  continue
+               self.pool.submit(self._refresh, hostId, session,
+                  taskName='refresh session %s' % hostId, block=False)
+               # mark it used, so it's not picked again while queued
+               session.lastUsed = time.time()
+         except queue.Full:
+            logging.warning('Worker queue full, delay refresh of sessions')
+         except:
+            logging.exception('Failed to refresh host sessions')
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import logging
+import threading
+from pyVmomi import vim, vmodl
+
+# Properties of hosts and VMs loaded by RetrieveHostInventory
+HOST_INVENTORY_PROPERTIES = [
+   'name', 'configManager.vsanSystem', 'config.vsanHostConfig', 'vm']
+VM_INVENTORY_PROPERTIES = ['name', 'config.instanceUuid']
+# Property of the vSAN disk mappings of a host
+HOST_STORAGE_PROPERTY = 'config.vsanHostConfig.storageInfo'
+
+
+# Watch property changes of vCenter inventory with a dedicated
+# PropertyCollector and WaitForUpdatesEx. Several filters share the watch, each
+# with its own handlers: onUpdate(objectUpdate) is called for every object
+# changed. The first update of a watch reports the full current state, and the
+# watch is set up again from scratch after failures. If onInitialUpdate is
+# given, it's called with all object updates of the first update of the filter
+# instead, so the handler can rebuild its state at once.
+class PropertyWatcher:
+   # The max seconds one WaitForUpdatesEx call waits for changes
+   WAIT_SECONDS = 60
+   # The seconds to wait before setting up the watch again after a failure
+   RETRY_INTERVAL = 10
+
+   # createFilters(si) returns the list of (vmodl.query.PropertyCollector.
+   # FilterSpec, onUpdate, onInitialUpdate) to watch, it's called on every
+   # setup of the watch since views referenced by the specs are per session
+   def __init__(self, si, name, createFilters):
+      self.si = si
+      self.name = name
+      self.createFilters = createFilters
+      self.stopEvent = threading.Event()
+      self.thread = None
+
+   def start(self):
+      if self.thread is not None:
+         return
+      self.thread = threading.Thread(
+         target=self._run, name='watch-%s' % self.name, daemon=True)
+      self.thread.start()
+
+   def stop(self):
+      self.stopEvent.set()
+
+   def _handle(self, handler, arg):
+      try:
+         handler(arg)
+      except:
+         logging.exception('Failed to handle update of %s', self.name)
+
+   def _run(self):
+      options = vmodl.query.PropertyCollector.WaitOptions(
+         maxWaitSeconds=self.WAIT_SECONDS)
+      while not self.stopEvent.is_set():
+         pc = None
+         views = []
+         try:
+            filters = self.createFilters(self.si)
+            views = [objSpec.obj for filterSpec, _, _ in filters
+                     for objSpec in filterSpec.objectSet
+                     if isinstance(objSpec.obj, vim.view.View)]
+            pc = self.si.content.propertyCollector.CreatePropertyCollector()
+            # filter moId -> (onUpdate, onInitialUpdate)
+            handlers = {}
+            for filterSpec, onUpdate, onInitialUpdate in filters:
+               pcFilter = pc.CreateFilter(filterSpec, False)
+               handlers[pcFilter._moId] = (onUpdate, onInitialUpdate)
+            logging.info('Watching %s for changes', self.name)
+            version = ''
+            initial = True
+            while not self.stopEvent.is_set():
+               update = pc.WaitForUpdatesEx(version, options)
+               if update is None and not initial:
+                  continue
+               objUpdates = {}
+               if update is not None:
+                  version = update.version
+                  for filterSet in update.filterSet or []:
+                     objUpdates.setdefault(filterSet.filter._moId, []).extend(
+                        filterSet.objectSet or [])
+               for filterId, (onUpdate, onInitialUpdate) in handlers.items():
+                  filterUpdates = objUpdates.get(filterId, [])
+                  if initial and onInitialUpdate is not None:
+                     self._handle(onInitialUpdate, filterUpdates)
+                  else:
+                     for objUpdate in filterUpdates:
+                        self._handle(onUpdate, objUpdate)
+               initial = False
+         except:
+            logging.exception('Failed to watch %s, retry in %ds',
+               self.name, self.RETRY_INTERVAL)
+            self.stopEvent.wait(self.RETRY_INTERVAL)
+         finally:
+            if pc is not None:
+               try:
+                  pc.Destroy()
+               except:
+                  pass
+            for view in views:
+               try:
+                  view.DestroyView()
+               except:
+                  pass
+
+# Filter spec of the property "host" of the cluster
+def CreateClusterHostsFilterSpec(clusterRef):
+   objSpec = vmodl.query.PropertyCollector.ObjectSpec(
+      obj=clusterRef, skip=False)
+   propSpec = vmodl.query.PropertyCollector.PropertySpec(
+      type=vim.ClusterComputeResource, pathSet=['host'], all=False)
+   return vmodl.query.PropertyCollector.FilterSpec(
+      objectSet=[objSpec], propSet=[propSpec])
+
+# Filter spec of the properties pathSet of all objects of objType in the
+# container. The ContainerView is created in the session of si, so it's gone
+# with the session.
+def CreateContainerFilterSpec(si, container, objType, pathSet):
+   PC = vmodl.query.PropertyCollector
+   view = si.content.viewManager.CreateContainerView(
+      container, [objType], True)
+   viewToObj = PC.TraversalSpec(name='viewToObj',
+      type=vim.view.ContainerView, path='view', skip=False)
+   return PC.FilterSpec(
+      objectSet=[PC.ObjectSpec(obj=view, skip=True, selectSet=[viewToObj])],
+      propSet=[PC.PropertySpec(type=objType, pathSet=pathSet, all=False)])
+
+# Filter spec of the name and instance UUID of all VMs in the cluster
+def CreateClusterVmsFilterSpec(si, clusterRef):
+   return CreateContainerFilterSpec(
+      si, clusterRef, vim.VirtualMachine, VM_INVENTORY_PROPERTIES)
+
+# Filter spec of the vSAN disk mappings of all hosts in the cluster
+def CreateClusterStorageFilterSpec(si, clusterRef):
+   return CreateContainerFilterSpec(
+      si, clusterRef, vim.HostSystem, [HOST_STORAGE_PROPERTY])
+
+
+# Cluster wide index of VM instance UUID -> VM name. It's loaded in bulk by
+# the initial update of a PropertyWatcher on all VMs in the cluster and kept
+# current by the following updates, so VMs created or moved between hosts
+# are resolved without reconnecting hosts. It's used as the "vmDict" of the
+# host info of every host.
+class VmNameIndex:
+   def __init__(self):
+      self.lock = threading.Lock()
+      # instanceUuid -> VM name
+      self.names = {}
+      # VM moId -> (instanceUuid, VM name)
+      self.vms = {}
+      # bumped on every change of the names
+      self.version = 0
+      self.loaded = threading.Event()
+
+   def get(self, instanceUuid, default=None):
+      return self.names.get(instanceUuid, default)
+
+   def __len__(self):
+      return len(self.names)
+
+   def load(self, objUpdates):
+      vms = {}
+      for objUpdate in objUpdates:
+         if objUpdate.kind != 'leave':
+            instanceUuid, name = self._applyChanges((None, None), objUpdate)
+            if instanceUuid:
+               vms[objUpdate.obj._moId] = (instanceUuid, name)
+      names = dict(vms.values())
+      with self.lock:
+         self.vms = vms
+         self.names = names
+         self.version += 1
+      self.loaded.set()
+      logging.info('Loaded names of %d VMs', len(names))
+
+   def onUpdate(self, objUpdate):
+      moId = objUpdate.obj._moId
+      with self.lock:
+         vm = self.vms.pop(moId, (None, None))
+         if vm[0] is not None:
+            self.names.pop(vm[0], None)
+         self.version += 1
+         if objUpdate.kind == 'leave':
+            return
+         instanceUuid, name = self._applyChanges(vm, objUpdate)
+         if instanceUuid:
+            self.vms[moId] = (instanceUuid, name)
+            self.names[instanceUuid] = name
+
+   def _applyChanges(self, vm, objUpdate):
+      instanceUuid, name = vm
+      for change in objUpdate.changeSet or []:
+         val = change.val if change.op == 'assign' else None
+         if change.name == 'name':
+            name = val
+         elif change.name == 'config.instanceUuid':
+            instanceUuid = val
+      return instanceUuid, name
+
+
+# Retrieve all objects matching filterSpecs, following the continuation token
+# of RetrievePropertiesEx. Return {moId: (objRef, {property path: value})}.
+def RetrieveProperties(pc, filterSpecs):
+   objects = {}
+   result = pc.RetrievePropertiesEx(
+      filterSpecs, vmodl.query.PropertyCollector.RetrieveOptions())
+   while result is not None:
+      for objContent in result.objects or []:
+         props = dict([(p.name, p.val) for p in objContent.propSet or []])
+         objects[objContent.obj._moId] = (objContent.obj, props)
+      if not result.token:
+         break
+      result = pc.ContinueRetrievePropertiesEx(result.token)
+   return objects
+
+# Load the inventory of every host in the cluster and its VMs through a
+# ContainerView in a single RetrievePropertiesEx call, instead of reading the
+# properties host by host. Return {hostId: {property path: value}}, where the
+# VMs of the host are listed as 'vm' -> [(instanceUuid, name)], or left
+# empty if withVms is False.
+def RetrieveHostInventory(si, clusterRef, withVms=True):
+   PC = vmodl.query.PropertyCollector
+   content = si.content
+   view = content.viewManager.CreateContainerView(
+      clusterRef, [vim.HostSystem], True)
+   try:
+      hostToVm = PC.TraversalSpec(
+         name='hostToVm', type=vim.HostSystem, path='vm', skip=False)
+      viewToHost = PC.TraversalSpec(name='viewToHost',
+         type=vim.view.ContainerView, path='view', skip=False,
+         selectSet=[hostToVm])
+      propSet = [PC.PropertySpec(type=vim.HostSystem,
+         pathSet=HOST_INVENTORY_PROPERTIES, all=False)]
+      if withVms:
+         propSet.append(PC.PropertySpec(type=vim.VirtualMachine,
+            pathSet=VM_INVENTORY_PROPERTIES, all=False))
+      else:
+         viewToHost.selectSet = []
+      filterSpec = PC.FilterSpec(
+         objectSet=[PC.ObjectSpec(obj=view, skip=True, selectSet=[viewToHost])],
+         propSet=propSet)
+      objects = RetrieveProperties(content.propertyCollector, [filterSpec])
+   finally:
+      view.DestroyView()
+
+   inventory = {}
+   for moId, (objRef, props) in objects.items():
+      if not isinstance(objRef, vim.HostSystem):
+         continue
+      vms = []
+      for vmRef in props.get('vm') or []:
+         vmProps = objects.get(vmRef._moId, (None, {}))[1]
+         if 'config.instanceUuid' in vmProps:
+            vms.append((vmProps['config.instanceUuid'], vmProps.get('name')))
+      props['vm'] = vms
+      inventory[moId] = props
+   return inventory
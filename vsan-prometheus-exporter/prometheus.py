@@ -4,29 +4,387 @@
 # SPDX-License-Identifier: BSD-2-Clause
 #
 
+import os
 import re
 import time
 import json
 import logging
-
-def pinit(out, metric):
-   out.setdefault(metric, {'help': None, 'origin': {'path': None, 'nodes': set()}, 'values': []})
-
-def rec(out, metric, value, labels):
-   # filter the non existing metrics
-   if value < 0:
-      return
-   pinit(out, metric)
-   out[metric]['values'].append((value, labels))
-
-def phelp(out, metric, helpStr, node1, node2):
-   pinit(out, metric)
-   out[metric]['help'] = helpStr
-   out[metric]['origin']['path'] = node1
-   out[metric]['origin']['nodes'].add(node2)
-
-def vcpuMetrics(out, node1, node2, entity, metrics):
-   metricMap = {"upTime": "uptime", "usedTime": "usedtime", "readyTime": "readytime"}
+import threading
+import collections
+from array import array
+
+# The max number of entities whose labels parsed out of their names are cached
+ENTITY_LABELS_CACHE_SIZE = int(os.environ.get('ENTITY_LABELS_CACHE_SIZE',
+                                              100000))
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+# A metric family, its HELP and TYPE lines are rendered once as header
+class MetricFamily:
+   __slots__ = ['name', 'type', 'help', 'header']
+
+   def __init__(self, name, metricType, helpStr):
+      self.name = name
+      self.type = metricType
+      self.help = helpStr
+      self.header = self._renderHeader(helpStr)
+
+   def _renderHeader(self, helpStr):
+      return "# HELP %s %s\n# TYPE %s %s" % (
+         self.name, helpStr, self.name, self.type)
+
+   # Tell the stats nodes the family is converted from in its help
+   def setOrigin(self, node1, node2s):
+      self.header = self._renderHeader("%s [from %s %s]" % (
+         self.help, node1, ",".join(node2s)))
+
+# Registry of the metric families of the host stats, name -> MetricFamily
+METRIC_FAMILIES = {}
+
+def metricFamily(name, metricType, helpStr):
+   assert(name not in METRIC_FAMILIES)
+   METRIC_FAMILIES[name] = MetricFamily(name, metricType, helpStr)
+
+# The samples of a metric family, their values and the ids of their label
+# sets in the SampleStore
+class FamilySamples:
+   __slots__ = ['values', 'labelIds', 'addValue', 'addLabelId']
+
+   def __init__(self):
+      self.values = array('d')
+      self.labelIds = array('i')
+      self.addValue = self.values.append
+      self.addLabelId = self.labelIds.append
+
+# Columnar store of the samples of a path of paths. The label sets, rendered
+# as string by a LabelCache or dicts, are added once per entity and referred
+# to by id from the samples.
+class SampleStore:
+   __slots__ = ['families', 'labels']
+
+   def __init__(self):
+      # metric -> FamilySamples, in order of the first sample
+      self.families = {}
+      self.labels = []
+
+   # Add the label sets of an entity, return the id of the first
+   def addLabels(self, labelSets):
+      labelId = len(self.labels)
+      self.labels.extend(labelSets)
+      return labelId
+
+   def rec(self, metric, value, labelId):
+      # filter the non existing metrics
+      if value < 0:
+         return
+      samples = self.families.get(metric)
+      if samples is None:
+         samples = self.families[metric] = FamilySamples()
+      samples.addValue(value)
+      samples.addLabelId(labelId)
+
+   # Yield (metric, [(value, labels)]) of every family
+   def items(self):
+      for metric, samples in self.families.items():
+         yield metric, [(value, self.labels[labelId]) for value, labelId in
+                        zip(samples.values, samples.labelIds)]
+
+# Fan-out of a metric into one sample per part, labeled with label set to the
+# value of the part. The source key of a sample is the key of the metric
+# formatted with the part.
+class Fanout:
+   def __init__(self, label, parts, values=None):
+      self.label = label
+      self.parts = list(parts)
+      self.values = list(values) if values is not None else self.parts
+
+# Declarative spec of the samples of metric converted from the stats of an
+# entity:
+#   key: source key, formatted with the fan-out parts. A tuple of keys takes
+#        the first key present.
+#   fanout: Fanout of the samples, a single sample if None
+#   div, scale: divisor and factor of the value
+#   scaleKey: key of another value the value is multiplied by
+#   default: the value if the key is missing, the samples of a missing key
+#            are skipped if None
+#   labels: labels set on top of the entity labels
+# The metric must be registered by metricFamily.
+class MetricSpec:
+   def __init__(self, metric, key, fanout=None, div=None, scale=None,
+                scaleKey=None, default=None, labels=None):
+      assert(metric in METRIC_FAMILIES)
+      self.metric = metric
+      self.key = key
+      self.fanout = fanout
+      self.div = div
+      self.scale = scale
+      self.scaleKey = scaleKey
+      self.default = default
+      self.labels = labels
+
+   # Yield (source keys, labels) of every sample of the spec
+   def samples(self):
+      keys = self.key if isinstance(self.key, tuple) else (self.key,)
+      labels = tuple(self.labels.items()) if self.labels else ()
+      if self.fanout is None:
+         yield keys, labels
+         return
+      for part, value in zip(self.fanout.parts, self.fanout.values):
+         yield (tuple(key % part for key in keys),
+                ((self.fanout.label, value),) + labels)
+
+# Stats of one entity by key, a view on its row of values in the stats node.
+# A key mapped to None is a missing metric with value -1.
+class StatsRow:
+   __slots__ = ['columns', 'values']
+
+   def __init__(self, columns):
+      self.columns = columns
+      self.values = None
+
+   def __getitem__(self, key):
+      col = self.columns[key]
+      return -1 if col is None else self.values[col]
+
+   def __contains__(self, key):
+      return key in self.columns
+
+   def get(self, key, default=None):
+      return self[key] if key in self.columns else default
+
+# The specs of a StatsConverter compiled against the columns of a stats node:
+# every sample is resolved to its column, or constant value, and label set.
+# The samples of metrics missing from the node are skipped, unresolved lists
+# the keys not in the node at all.
+class CompiledStats:
+   __slots__ = ['labelSets', 'samples', 'unresolved']
+
+   def __init__(self, specs, columns):
+      self.labelSets = [()]
+      self.samples = []
+      self.unresolved = []
+      for spec in specs:
+         scaleCol = None
+         if spec.scaleKey is not None:
+            if spec.scaleKey not in columns:
+               self.unresolved.append(spec.scaleKey)
+            scaleCol = columns.get(spec.scaleKey)
+         for keys, labels in spec.samples():
+            col, const = self._resolve(keys, spec.default, columns)
+            # the label sets don't depend on the missing metrics, so the
+            # labels cached for an entity fit any schema of the node
+            if labels not in self.labelSets:
+               self.labelSets.append(labels)
+            if col is None and const is None:
+               self.unresolved.append(keys[0])
+               continue
+            if col is None and const < 0:
+               continue
+            if spec.scaleKey is not None and scaleCol is None:
+               continue
+            self.samples.append((spec.metric, col, const, spec.div,
+                                 spec.scale, scaleCol,
+                                 self.labelSets.index(labels)))
+
+   # Return (column, constant value) of the first of keys in columns, a
+   # missing metric has value -1. (None, None) if no key is in columns and
+   # there's no default.
+   @staticmethod
+   def _resolve(keys, default, columns):
+      for key in keys:
+         if key in columns:
+            col = columns[key]
+            return col, -1 if col is None else None
+      return None, default
+
+   # Return the labels of every label set of the samples of an entity with
+   # labels
+   def expandLabels(self, labels):
+      labelSets = [labels]
+      for extra in self.labelSets[1:]:
+         sampleLabels = labels.copy()
+         for k, v in extra:
+            sampleLabels[k] = v
+         labelSets.append(sampleLabels)
+      return labelSets
+
+   # Record the samples of the entity into store, with the row of values and
+   # the label sets added to store from labelId on
+   def run(self, store, labelId, values):
+      families = store.families
+      for metric, col, const, div, scale, scaleCol, labelIndex in self.samples:
+         value = const if col is None else values[col]
+         if div is not None:
+            value = value / div
+         if scale is not None:
+            value = value * scale
+         if scaleCol is not None:
+            value = value * values[scaleCol]
+         # filter the non existing metrics, see SampleStore.rec
+         if value < 0:
+            continue
+         samples = families.get(metric)
+         if samples is None:
+            samples = families[metric] = FamilySamples()
+         samples.addValue(value)
+         samples.addLabelId(labelId + labelIndex)
+
+# LRU cache of the labels parsed out of the names of the entities of all
+# hosts, which don't change for the lifetime of a host. Unlike LabelCache, the
+# entries don't depend on the topology of the host, the labels are not
+# augmented. Keys are those of LabelCache, the names of the entities include
+# the host UUID.
+class EntityLabelsCache:
+   def __init__(self, maxSize):
+      self.maxSize = maxSize
+      self.lock = threading.Lock()
+      self.entries = collections.OrderedDict()
+      self.hits = 0
+      self.misses = 0
+
+   # Return a copy of the labels of key, parsed by parse() if not cached
+   def get(self, key, parse):
+      with self.lock:
+         labels = self.entries.get(key)
+         if labels is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return labels.copy()
+         self.misses += 1
+      labels = parse()
+      if self.maxSize > 0:
+         with self.lock:
+            self.entries[key] = labels
+            if len(self.entries) > self.maxSize:
+               self.entries.popitem(last=False)
+      return labels.copy()
+
+   # Return (hits, misses, entries)
+   def getStats(self):
+      with self.lock:
+         return self.hits, self.misses, len(self.entries)
+
+entityLabelsCache = EntityLabelsCache(ENTITY_LABELS_CACHE_SIZE)
+
+# The schema of a stats node: its metrics, their columns by key and the specs
+# compiled against them by variant
+class NodeSchema:
+   __slots__ = ['metrics', 'columns', 'compiled']
+
+   def __init__(self, metrics, columns):
+      self.metrics = metrics
+      self.columns = columns
+      self.compiled = {}
+
+# Converter of the stats nodes of a path of paths, built from MetricSpecs:
+#   labels(node2, entity, row): the labels of an entity
+#   metrics: the MetricSpecs, or if variant is given, dict of variant ->
+#            MetricSpecs
+#   strip: substrings removed from the keys of the node, in order
+#   variant(node2, row): the variant of an entity
+#   labelKeys: the keys of the values the labels or variant of an entity
+#              depend on, besides node2 and entity
+#   parseCache: EntityLabelsCache of the labels, if parsing the names of the
+#               entities isn't cheap
+# The specs are compiled once per stats node against its metrics, each entity
+# is then converted from its row of values.
+class StatsConverter:
+   def __init__(self, labels, metrics, strip=(), variant=None, labelKeys=(),
+                parseCache=None):
+      self.labels = labels
+      self.strip = strip
+      self.variant = variant
+      self.labelKeys = labelKeys
+      self.parseCache = parseCache
+      self.variants = metrics if variant is not None else {None: metrics}
+
+   def _rename(self, key):
+      for s in self.strip:
+         key = key.replace(s, '')
+      return key
+
+   # Return key -> column of the metrics of a node, the missingMetrics not in
+   # the node map to None (value -1). Later keys win if renamed to the same.
+   def columns(self, metrics, missingMetrics=()):
+      columns = {}
+      for col, key in enumerate(metrics):
+         columns[self._rename(key)] = col
+      present = set(metrics)
+      for key in missingMetrics:
+         if key not in present:
+            columns[self._rename(key)] = None
+      return columns
+
+   # Return the names of all metrics converted
+   def metrics(self):
+      return [spec.metric for specs in self.variants.values()
+              for spec in specs]
+
+   def compile(self, variant, columns):
+      return CompiledStats(self.variants[variant], columns)
+
+   def schema(self, metrics, missingMetrics=()):
+      return NodeSchema(metrics, self.columns(metrics, missingMetrics))
+
+   # Return the labels of every label set of the samples of an entity, from
+   # labelCache if given, else as dicts
+   def _entityLabels(self, stats, node1, node2, entity, row, labelCache):
+      key = (node1, node2, entity)
+      if self.labelKeys:
+         key += tuple([row.get(k) for k in self.labelKeys])
+      if labelCache is None:
+         return stats.expandLabels(self._parseLabels(key, node2, entity, row))
+      labelSets = labelCache.get(key)
+      if labelSets is None:
+         labelSets = labelCache.render(stats.expandLabels(
+            self._parseLabels(key, node2, entity, row)))
+         labelCache.put(key, labelSets)
+      return labelSets
+
+   def _parseLabels(self, key, node2, entity, row):
+      if self.parseCache is None:
+         return self.labels(node2, entity, row)
+      return self.parseCache.get(
+         key, lambda: self.labels(node2, entity, row))
+
+   # Convert all entities of the stats node node1/node2 into the SampleStore
+   # out, with the labels rendered by labelCache and the schema of the node
+   # from schemaCache if given.
+   def convert(self, out, node1, node2, nodeStats, missingMetrics=(),
+               labelCache=None, schemaCache=None):
+      if schemaCache is not None:
+         schema = schemaCache.get(
+            self, node1, node2, nodeStats['metrics'], missingMetrics)
+      else:
+         schema = self.schema(nodeStats['metrics'], missingMetrics)
+      row = StatsRow(schema.columns)
+      compiled = schema.compiled
+      for entity, values in nodeStats['entities'].items():
+         row.values = values
+         try:
+            variant = None
+            if self.variant is not None:
+               variant = self.variant(node2, row)
+            stats = compiled.get(variant)
+            if stats is None:
+               stats = compiled[variant] = self.compile(variant, row.columns)
+               if stats.unresolved:
+                  logging.warning('Metrics %s not in stats %s, %s, skipped',
+                     ', '.join(stats.unresolved), node1, node2)
+            labelSets = self._entityLabels(
+               stats, node1, node2, entity, row, labelCache)
+            stats.run(out, out.addLabels(labelSets), values)
+         except:
+            logging.exception(
+               'Failed to process metrics of entity {}, {}, {}'.format(
+                  node1, node2, entity))
+
+_plogWorldName = re.compile(r'(PLOG|LLOG|DDP)-([a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})-(.*)')
+_vsanWorldName = re.compile(r'(VSAN)_(0x[a-f0-9]*)_(.*)')
+_storageWorldName = re.compile(r'(vmx|PVSCSI|NVMeComplWorld|Cmpl-vmhba|CmdCompl)-?(.*)')
+
+def vcpuLabels(node2, entity, row):
    #["$getLsomWorldInformation", "$getDomWorldInformation",
    #  "$getNicWorldInformation", "$getCmmdsWorldInformation"]
    x = entity.split("|")
@@ -36,13 +394,13 @@ def vcpuMetrics(out, node1, node2, entity, metrics):
       # XXX: x[1] translation is not universal, depends on DOM vs. PLOG vs ...
       labels = {"subsystem": "DOM", "host_uuid": x[0], "world_id": x[2], "role": y[2]}
    elif node2 == "$getLsomWorldInformation":
-      m = re.match(r'(PLOG|LLOG|DDP)-([a-z0-9]{8}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{4}-[a-z0-9]{12})-(.*)', x[1])
+      m = _plogWorldName.match(x[1])
       if m:
          labels = {'subsystem': m.group(1), 'host_uuid': x[0], 'disk_uuid': m.group(2), 'name': m.group(3)}
          if len(x) >= 3:
             labels['world_id'] = x[2]
       else:
-         m = re.match(r'(VSAN)_(0x[a-f0-9]*)_(.*)', x[1])
+         m = _vsanWorldName.match(x[1])
          if not m:
             print(x[1])
          assert(m)
@@ -56,7 +414,7 @@ def vcpuMetrics(out, node1, node2, entity, metrics):
    # from vSAN 70U1, getNicWorldInformation => getNetworkWorldInformation
    elif node2 == "$getNetworkWorldInformation":
       labels = {"subsystem": "Network", "host_uuid": x[0], "name": x[1]}
-      m = re.match(r'(vmx|PVSCSI|NVMeComplWorld|Cmpl-vmhba|CmdCompl)-?(.*)', x[1])
+      m = _storageWorldName.match(x[1])
       if m:
          labels['subsystem'] = 'Storage'
          labels['world_id'] = x[2]
@@ -65,20 +423,29 @@ def vcpuMetrics(out, node1, node2, entity, metrics):
       labels = {"subsystem": "CMMDS", "host_uuid": x[0], "world_id": x[2], "role": x[1] if len(y) == 1 else y[2]}
    else:
       raise Exception(node2)
+   return labels
+
+# uptime is runTime before vSAN 70U1
+metricFamily("vmware_esx_world_uptime_seconds_total", COUNTER,
+   "Worlds is what ESX calls threads. Except when noted in the name, refers to a single world. uptime is a sum total of the time the world was not paused")
+metricFamily("vmware_esx_world_usedtime_seconds_total", COUNTER,
+   "Worlds is what ESX calls threads. Except when noted in the name, refers to a single world. usedtime is a sum total of the time the world was running on a pCPU. So usedtime/uptime is utilization.")
+metricFamily("vmware_esx_world_readytime_seconds_total", COUNTER,
+   "Worlds is what ESX calls threads. Except when noted in the name, refers to a single world. readytime is a sum total of the time the world was activated, but waiting for a pCPU.")
 
-   phelp(out, 'vmware_esx_world_uptime_seconds_total', "Worlds is what ESX calls threads. Except when noted in the name, refers to a single world. uptime is a sum total of the time the world was not paused", node1, node2)
-   phelp(out, 'vmware_esx_world_usedtime_seconds_total', "Worlds is what ESX calls threads. Except when noted in the name, refers to a single world. usedtime is a sum total of the time the world was running on a pCPU. So usedtime/uptime is utilization.", node1, node2)
-   phelp(out, 'vmware_esx_world_readytime_seconds_total', "Worlds is what ESX calls threads. Except when noted in the name, refers to a single world. readytime is a sum total of the time the world was activated, but waiting for a pCPU.", node1, node2)
-   for cur, new in metricMap.items():
-      if cur == 'upTime' and cur not in metrics:
-         cur = 'runTime'
-      rec(out, "vmware_esx_world_%s_seconds_total" % new, metrics[cur] / 1000.0**3, labels)
+vcpuMetrics = StatsConverter(vcpuLabels, [
+   MetricSpec('vmware_esx_world_uptime_seconds_total', ('upTime', 'runTime'), div=1000.0**3),
+   MetricSpec('vmware_esx_world_usedtime_seconds_total', 'usedTime', div=1000.0**3),
+   MetricSpec('vmware_esx_world_readytime_seconds_total', 'readyTime', div=1000.0**3),
+], parseCache=entityLabelsCache)
 
-def heapMetrics(out, node1, node2, entity, metrics):
+_heapName = re.compile(r"(.*)-(0x[a-f0-9]*)$")
+
+def heapLabels(node2, entity, row):
    # "/system/heaps/$getHeapInformation":
 
    x = entity.split("|")
-   m = re.match(r"(.*)-(0x[a-f0-9]*)$", x[1])
+   m = _heapName.match(x[1])
    assert(m)
    labels = {"subsystem": "system", "host_uuid": x[0], "heap_id": m.group(2), 'heap_name': m.group(1)}
    if 'dom' in x[1]:
@@ -93,591 +460,562 @@ def heapMetrics(out, node1, node2, entity, metrics):
       labels['subsystem'] = "VSANSparse"
    if 'RDT' in x[1]:
       labels['subsystem'] = "RDT"
+   return labels
+
+metricFamily("vmware_esx_heap_usage_ratio", GAUGE,
+   "Point in time. Usage of heap (mempool) in percent. For some being full is normal, others may impact control or IO operations")
 
-   phelp(out, "vmware_esx_heap_usage_ratio", "Point in time. Usage of heap (mempool) in percent. For some being full is normal, others may impact control or IO operations", node1, node2)
-   rec(out, "vmware_esx_heap_usage_ratio", metrics['heapUtil'] / 100.0, labels)
+heapMetrics = StatsConverter(heapLabels, [
+   MetricSpec("vmware_esx_heap_usage_ratio", 'heapUtil', div=100.0),
+], parseCache=entityLabelsCache)
 
 
-def domRoleState(out, node1, node2, entity, metrics):
+def hostLabels(node2, entity, row):
+   return {'host_uuid': entity}
+
+def diskLabels(node2, entity, row):
+   return {'disk_uuid': entity}
+
+def domRoleLabels(node2, entity, row):
    #"/vmkModules/vsan/dom"
-   labels = {
+   return {
       'host_uuid': entity,
       'role': node2.replace('Stats', ''),
    }
-   isOwner = labels['role'] == 'owner'
-   isClient = labels['role'] == 'client'
-
-   phelp(out, 'vmware_vsan_dom_io_total', 'Total IOs processed by vSAN DOM since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_dom_io_bytes_total', 'Total Bytes processed by vSAN DOM since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_dom_io_duration_seconds_total', 'Sum total of duration of IO processed by vSAN DOM since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_dom_io_durationsquare_seconds_total', 'Sum total of duration^2 of IO processed by vSAN DOM since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_dom_congestion_total', 'Sum total of observed congestion values by vSAN DOM since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_dom_numoio_total', 'Sum total of observed Outstanding IOs (aka Queue Depth) by vSAN DOM since boot.', node1, node2)
-
-   keys = ["write", "read", "unmap", "recoveryWrite", "resyncRead"]
-   if isClient:
-      keys = ["write", "read", "unmap"]
-
-   for key in keys:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key
-      rec(out, "vmware_vsan_dom_io_total", metrics['%sCount' % key], ioLabels)
-      rec(out, "vmware_vsan_dom_io_bytes_total", metrics['%sBytes' % key], ioLabels)
-      rec(out, "vmware_vsan_dom_io_duration_seconds_total", metrics['%sLatencySumUs' % key] / 1000.0**2, ioLabels)
-      rec(out, "vmware_vsan_dom_io_durationsquare_seconds_total", metrics.get('%sLatencySqSumUs' % key, 0) / 1000.0**4, ioLabels)
-      rec(out, "vmware_vsan_dom_congestion_total", metrics['%sCongestionSum' % key], ioLabels)
-
-   if isOwner:
-      for key in ["write", "read", "unmap", "recoveryWrite", "recoveryUnmap"]:
-         ioLabels = labels.copy()
-         ioLabels['io_type'] = key
-         ioLabels['role'] = 'ownerLeaf'
-         rec(out, "vmware_vsan_dom_io_total", metrics['%sLeafOwnerCount' % key], ioLabels)
-         rec(out, "vmware_vsan_dom_io_duration_seconds_total", metrics['%sLeafOwnerLatencySumUs' % key] / 1000.0**2, ioLabels)
-
-   rec(out, "vmware_vsan_dom_numoio_total", metrics["numOIOSum"], labels)
-
-
-
-def domDgState(out, node1, node2, entity, metrics):
-   # "/vmkModules/vsan/dom/compSchedulers" "%s/stats"
-   labels = {
-      'disk_uuid': entity,
-   }
 
-            # "sumQueuedBytes",
-            # "sumOutstandingBytes",
-            # "sumResyncRecWBytes",
-            # "sumResyncReadBytes",
-
-            # "sumResyncRecWCount",
-            # "sumResyncReadCount",
-
-            # "sumResyncRecWLatencyUs",
-            # "sumResyncReadLatencyUs",
-            # "sumLatencyForVMDiskUs",
-            # "sumLatencyForNameSpaceUs",
-            # "sumLatencyForRecoveryUs",
-            # "sumLatencyForActivationUs",
-            # "sumLatencyForMetaDataUs",
-
-            # "numActivation",
-            # "numDirectActivation",
-
-            # "queueBytesMetaData",
-            # "queueBytesRecovery",
-            # "queueSumOpVMDisk",
-            # "queueSumOpNameSpace",
-            # "queueSumOpRecovery",
-            # "queueBytesNameSpace",
-            # "queueSumOpMetaData",
-            # "queueBytesVMDisk",
-
-
-   phelp(out, 'vmware_vsan_domdg_io_total', 'Total IOs processed by vSAN DOM on DiskGroup since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_domdg_io_bytes_total', 'Total Bytes processed by vSAN DOM on DiskGroup since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_domdg_io_duration_seconds_total', 'Sum total of duration of IO processed by vSAN DOM on DiskGroup since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_domdg_numoio_total', 'Sum total of observed Outstanding IOs (aka Queue Depth) by vSAN DOM on DiskGroup since boot.', node1, node2)
-
-   for key in ["write", "read", "unmap", "recoveryWrite", "recoveryUnmap"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key
-      keyCap = "%s%s" % (key[:1].capitalize(), key[1:])
-      rec(out, "vmware_vsan_domdg_io_total", metrics['%sCount' % key], ioLabels)
-      rec(out, "vmware_vsan_domdg_io_bytes_total", metrics['%sBytes' % key], ioLabels)
-      rec(out, "vmware_vsan_domdg_io_duration_seconds_total", metrics['%sLatencySumUs' % key] / 1000.0**2, ioLabels)
-      rec(out, "vmware_vsan_domdg_numoio_total", metrics["numOIOSum%s" % keyCap], ioLabels)
-
-   # "/vmkModules/vsan/dom/compSchedulers": ["%s/stats"]
-
-
-def plogDevicesStats(out, node1, node2, entity, metrics):
+metricFamily("vmware_vsan_dom_io_total", COUNTER,
+   'Total IOs processed by vSAN DOM since boot.')
+metricFamily("vmware_vsan_dom_io_bytes_total", COUNTER,
+   'Total Bytes processed by vSAN DOM since boot.')
+metricFamily("vmware_vsan_dom_io_duration_seconds_total", COUNTER,
+   'Sum total of duration of IO processed by vSAN DOM since boot.')
+metricFamily("vmware_vsan_dom_io_durationsquare_seconds_total", COUNTER,
+   'Sum total of duration^2 of IO processed by vSAN DOM since boot.')
+metricFamily("vmware_vsan_dom_congestion_total", COUNTER,
+   'Sum total of observed congestion values by vSAN DOM since boot.')
+metricFamily("vmware_vsan_dom_numoio_total", COUNTER,
+   'Sum total of observed Outstanding IOs (aka Queue Depth) by vSAN DOM since boot.')
+
+def _DomRoleSpecs(ioTypes, leafIoTypes):
+   ioTypes = Fanout('io_type', ioTypes)
+   specs = [
+      MetricSpec('vmware_vsan_dom_io_total', '%sCount', ioTypes),
+      MetricSpec('vmware_vsan_dom_io_bytes_total', '%sBytes', ioTypes),
+      MetricSpec('vmware_vsan_dom_io_duration_seconds_total', '%sLatencySumUs', ioTypes, div=1000.0**2),
+      MetricSpec('vmware_vsan_dom_io_durationsquare_seconds_total', '%sLatencySqSumUs', ioTypes, div=1000.0**4, default=0),
+      MetricSpec('vmware_vsan_dom_congestion_total', '%sCongestionSum', ioTypes),
+   ]
+   if leafIoTypes:
+      leafIoTypes = Fanout('io_type', leafIoTypes)
+      leafLabels = {'role': 'ownerLeaf'}
+      specs += [
+         MetricSpec('vmware_vsan_dom_io_total', '%sLeafOwnerCount', leafIoTypes, labels=leafLabels),
+         MetricSpec('vmware_vsan_dom_io_duration_seconds_total', '%sLeafOwnerLatencySumUs', leafIoTypes, div=1000.0**2, labels=leafLabels),
+      ]
+   specs.append(MetricSpec('vmware_vsan_dom_numoio_total', 'numOIOSum'))
+   return specs
+
+domRoleState = StatsConverter(domRoleLabels, {
+   'clientStats': _DomRoleSpecs(["write", "read", "unmap"], None),
+   'ownerStats': _DomRoleSpecs(["write", "read", "unmap", "recoveryWrite", "resyncRead"],
+                               ["write", "read", "unmap", "recoveryWrite", "recoveryUnmap"]),
+   'compmgrStats': _DomRoleSpecs(["write", "read", "unmap", "recoveryWrite", "resyncRead"], None),
+}, variant=lambda node2, row: node2)
+
+
+# "/vmkModules/vsan/dom/compSchedulers" "%s/stats"
+         # "sumQueuedBytes",
+         # "sumOutstandingBytes",
+         # "sumResyncRecWBytes",
+         # "sumResyncReadBytes",
+
+         # "sumResyncRecWCount",
+         # "sumResyncReadCount",
+
+         # "sumResyncRecWLatencyUs",
+         # "sumResyncReadLatencyUs",
+         # "sumLatencyForVMDiskUs",
+         # "sumLatencyForNameSpaceUs",
+         # "sumLatencyForRecoveryUs",
+         # "sumLatencyForActivationUs",
+         # "sumLatencyForMetaDataUs",
+
+         # "numActivation",
+         # "numDirectActivation",
+
+         # "queueBytesMetaData",
+         # "queueBytesRecovery",
+         # "queueSumOpVMDisk",
+         # "queueSumOpNameSpace",
+         # "queueSumOpRecovery",
+         # "queueBytesNameSpace",
+         # "queueSumOpMetaData",
+         # "queueBytesVMDisk",
+
+_domDgIoTypes = Fanout('io_type', ["write", "read", "unmap", "recoveryWrite", "recoveryUnmap"])
+metricFamily("vmware_vsan_domdg_io_total", COUNTER,
+   'Total IOs processed by vSAN DOM on DiskGroup since boot.')
+metricFamily("vmware_vsan_domdg_io_bytes_total", COUNTER,
+   'Total Bytes processed by vSAN DOM on DiskGroup since boot.')
+metricFamily("vmware_vsan_domdg_io_duration_seconds_total", COUNTER,
+   'Sum total of duration of IO processed by vSAN DOM on DiskGroup since boot.')
+metricFamily("vmware_vsan_domdg_numoio_total", COUNTER,
+   'Sum total of observed Outstanding IOs (aka Queue Depth) by vSAN DOM on DiskGroup since boot.')
+
+domDgState = StatsConverter(diskLabels, [
+   MetricSpec('vmware_vsan_domdg_io_total', '%sCount', _domDgIoTypes),
+   MetricSpec('vmware_vsan_domdg_io_bytes_total', '%sBytes', _domDgIoTypes),
+   MetricSpec('vmware_vsan_domdg_io_duration_seconds_total', '%sLatencySumUs', _domDgIoTypes, div=1000.0**2),
+   MetricSpec('vmware_vsan_domdg_numoio_total', 'numOIOSum%s',
+      Fanout('io_type', ["Write", "Read", "Unmap", "RecoveryWrite", "RecoveryUnmap"], _domDgIoTypes.values)),
+])
+
+
+def plogDevicesLabels(node2, entity, row):
    # "/vmkModules/plog/devices" "%r/info|stats:./%s/info[deviceUUID]"
-   labels = {'disk_uuid': entity}
-   metrics = dict([(k.replace('stats/', '').replace('/stats', ''), v) for k, v in metrics.items()])
-
-   # for ioType in ['read', 'write']:
-   #          "totalQTimeOrdered",
-   #          "nrIOs",
-   #          "totalQTimeUnOrdered",
-   #          "encTimeLatency",
-   #          "totalLatency",
-   #          "numHelperQueueElems",
-   #          "queueTimeLatency"]
-   #    pass
-
-   # out["vmware_vsan_plog_readfromcapacity_bytes_total"] = (metrics['totalBytesReadFromMD'], labels)
-   # out["vmware_vsan_plog_readfromcache_bytes_total"] = (metrics['totalBytesReadFromSSD'], labels)
-   # out["vmware_vsan_plog_read_bytes_total"] = (metrics['totalBytesRead'], labels)
-   # out["vmware_vsan_plog_numio_total"] = (metrics['nrIOs'], labels)
-
-   phelp(out, "vmware_vsan_disk_drain_total", "Sum total of bytes drained/destaged from cache to capacity, split by zeros (from component delete, TRIM/UNMAP) and real data.", node1, node2)
-   # Not emitting "totalBytesDrained" as it is redundant
-   assert(metrics['totalBytesDrained'] == metrics['ssdBytesDrained'] + metrics['zeroBytesDrained'])
-   for ioType, name in [('ssd', 'data'), ('zero', 'zero')]:
-      ioLabels = labels.copy()
-      ioLabels['drain_type'] = name
-      rec(out, "vmware_vsan_disk_drain_bytes_total", metrics['%sBytesDrained' % ioType], ioLabels)
-
-def plogDevicesElevStats(out, node1, node2, entity, metrics):
-   # "/vmkModules/plog/devices" "%r/info|elevStats:./%s/info[deviceUUID]"
-
-            # "plogDataUsage",
-            # "plogMDDataUsage",
-
-            # "elevUnthrottleThresh",
-            # "timeToSleepMs",
-            # "plogNumFreedLogs",
-            # "plogNumWriteLogs",
-            # "elevStartThresh",
-            # "plogNumCommitLogs",
-            # "plogNumFreedCommitLogs",
-
-            # "elevRuns",
-
-            # "numMDWrites",
-            # "numRCReads",
-            # "numMDReads",
-            # "numVMFSReads",
-            # "numReads",
-            # "numElevSSDReads",
-            # "numSSDReads"
-
-   labels = {'disk_uuid': entity}
-   metrics = dict([(k.replace('elevStats/', ''), v) for k, v in metrics.items()])
-
-   phelp(out, 'vmware_vsan_plog_elev_bytes_total', 'Total bytes of PLOG elevator', node1, node2)
-   phelp(out, 'vmware_vsan_plog_elev_thresholds_ratio', 'Utilization metrics for write buffer of PLOG elevator', node1, node2)
-
-   for key in ['CS', 'FS', 'Zero', 'FSUnmap', 'Del', 'CF']:
-      # XXX: Better name?
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key
-      rec(out, 'vmware_vsan_plog_elev_bytes_total', metrics['total%sBytes' % key], ioLabels)
-
-   for key in ['RC', 'VMFS']:
-      # XXX: Better name?
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key
-      rec(out, 'vmware_vsan_plog_elev_bytes_total', metrics['totalBytesReadBy%s' % key], ioLabels)
-
-   for key in ['mem', 'data', 'ssd', 'max', 'zero', 'log']:
-      ioLabels = labels.copy()
-      ioLabels['threshold_type'] = key
-      rec(out, 'vmware_vsan_plog_elev_thresholds_ratio', metrics['%sP' % key] / 100.0, ioLabels)
-
-def plogDevicesDedupStats(out, node1, node2, entity, metrics):
-   # "/vmkModules/plog/devices" "%r/info|dedupStats:./%s/info[deviceUUID]"
-
-   labels = {'disk_uuid': entity}
-   metrics = dict([(k.replace('dedupStats/', ''), v) for k, v in metrics.items()])
-
-   phelp(out, 'vmware_vsan_plog_dedup_seconds_total', 'Total seconds of PLOG deduplication', node1, node2)
-   phelp(out, 'vmware_vsan_plog_dedup_bytes_total', 'Total bytes of PLOG deduplication', node1, node2)
-   phelp(out, 'vmware_vsan_plog_dedup_io_total', 'Total IOs of PLOG deduplication', node1, node2)
-   phelp(out, 'vmware_vsan_plog_dedup_events_total', 'Total events of PLOG deduplication', node1, node2)
-
-   for key in ["txnReplayHashmap",
-            "txnBuild",
-            "hashCalc",
-            "txnReplay",
-            "compression",
-            "txnReplayBitmap",
-            "dataWrite",
-            "txnReplayXmap",
-            "txnWrite"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key
-      rec(out, "vmware_vsan_plog_dedup_seconds_total", metrics['%sTime' % key] / 1000.0**3, ioLabels)
-
-   for key in [
-            "deduped",
-            "compressed",
-            "total",
-            "free",
-            "hashed"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key
-      rec(out, "vmware_vsan_plog_dedup_bytes_total", metrics['%sBytes' % key], ioLabels)
-
-   for key in [
-            "txnReplayBgWriteIOs",
-            "txnReplayFgWriteIOs",
-            "numHashmapReads",
-            "numBitmapWrites",
-            "numXMapReads",
-            "numBitmapReads",
-            "numHashmapWrites",
-            "numXMapWrites",
-            "txnWrites"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key
-      rec(out, "vmware_vsan_plog_dedup_io_total", metrics['%s' % key], ioLabels)
-
-   for key in [
-            "cacheMissesBmap",
-            "cacheMissesXmap",
-            "cacheMissesHmap",
-            "cacheHitsBmap",
-            "cacheHitsXmap",
-            "cacheHitsHmap",
-            "pendingTxnReplayYields",
-            "txnReplayReadIOHits"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key
-      rec(out, "vmware_vsan_plog_dedup_events_total", metrics['%s' % key], ioLabels)
+   return {'disk_uuid': entity}
+
+# for ioType in ['read', 'write']:
+#          "totalQTimeOrdered",
+#          "nrIOs",
+#          "totalQTimeUnOrdered",
+#          "encTimeLatency",
+#          "totalLatency",
+#          "numHelperQueueElems",
+#          "queueTimeLatency"]
+#    pass
+
+# out["vmware_vsan_plog_readfromcapacity_bytes_total"] = (metrics['totalBytesReadFromMD'], labels)
+# out["vmware_vsan_plog_readfromcache_bytes_total"] = (metrics['totalBytesReadFromSSD'], labels)
+# out["vmware_vsan_plog_read_bytes_total"] = (metrics['totalBytesRead'], labels)
+# out["vmware_vsan_plog_numio_total"] = (metrics['nrIOs'], labels)
+
+# Not emitting "totalBytesDrained" as it is redundant
+metricFamily("vmware_vsan_disk_drain_bytes_total", COUNTER,
+   "Sum total of bytes drained/destaged from cache to capacity, split by zeros (from component delete, TRIM/UNMAP) and real data.")
+
+plogDevicesStats = StatsConverter(plogDevicesLabels, [
+   MetricSpec("vmware_vsan_disk_drain_bytes_total", '%sBytesDrained', Fanout('drain_type', ['ssd', 'zero'], ['data', 'zero'])),
+], strip=['stats/', '/stats'])
+
+# "/vmkModules/plog/devices" "%r/info|elevStats:./%s/info[deviceUUID]"
+         # "plogDataUsage",
+         # "plogMDDataUsage",
+
+         # "elevUnthrottleThresh",
+         # "timeToSleepMs",
+         # "plogNumFreedLogs",
+         # "plogNumWriteLogs",
+         # "elevStartThresh",
+         # "plogNumCommitLogs",
+         # "plogNumFreedCommitLogs",
+
+         # "elevRuns",
+
+         # "numMDWrites",
+         # "numRCReads",
+         # "numMDReads",
+         # "numVMFSReads",
+         # "numReads",
+         # "numElevSSDReads",
+         # "numSSDReads"
+
+# XXX: Better name of io_type?
+_elevIoTypes = Fanout('io_type', ['CS', 'FS', 'Zero', 'FSUnmap', 'Del', 'CF'])
+metricFamily("vmware_vsan_plog_elev_bytes_total", COUNTER,
+   'Total bytes of PLOG elevator')
+metricFamily("vmware_vsan_plog_elev_thresholds_ratio", GAUGE,
+   'Utilization metrics for write buffer of PLOG elevator')
+
+plogDevicesElevStats = StatsConverter(diskLabels, [
+   MetricSpec('vmware_vsan_plog_elev_bytes_total', 'total%sBytes', _elevIoTypes),
+   MetricSpec('vmware_vsan_plog_elev_bytes_total', 'totalBytesReadBy%s', Fanout('io_type', ['RC', 'VMFS'])),
+   MetricSpec('vmware_vsan_plog_elev_thresholds_ratio', '%sP',
+      Fanout('threshold_type', ['mem', 'data', 'ssd', 'max', 'zero', 'log']), div=100.0),
+], strip=['elevStats/'])
+
+# "/vmkModules/plog/devices" "%r/info|dedupStats:./%s/info[deviceUUID]"
+metricFamily("vmware_vsan_plog_dedup_seconds_total", COUNTER,
+   'Total seconds of PLOG deduplication')
+metricFamily("vmware_vsan_plog_dedup_bytes_total", COUNTER,
+   'Total bytes of PLOG deduplication')
+metricFamily("vmware_vsan_plog_dedup_io_total", COUNTER,
+   'Total IOs of PLOG deduplication')
+metricFamily("vmware_vsan_plog_dedup_events_total", COUNTER,
+   'Total events of PLOG deduplication')
+
+plogDevicesDedupStats = StatsConverter(diskLabels, [
+   MetricSpec("vmware_vsan_plog_dedup_seconds_total", '%sTime', Fanout('io_type', [
+      "txnReplayHashmap",
+      "txnBuild",
+      "hashCalc",
+      "txnReplay",
+      "compression",
+      "txnReplayBitmap",
+      "dataWrite",
+      "txnReplayXmap",
+      "txnWrite"]), div=1000.0**3),
+   MetricSpec("vmware_vsan_plog_dedup_bytes_total", '%sBytes', Fanout('io_type', [
+      "deduped",
+      "compressed",
+      "total",
+      "free",
+      "hashed"])),
+   MetricSpec("vmware_vsan_plog_dedup_io_total", '%s', Fanout('io_type', [
+      "txnReplayBgWriteIOs",
+      "txnReplayFgWriteIOs",
+      "numHashmapReads",
+      "numBitmapWrites",
+      "numXMapReads",
+      "numBitmapReads",
+      "numHashmapWrites",
+      "numXMapWrites",
+      "txnWrites"])),
+   MetricSpec("vmware_vsan_plog_dedup_events_total", '%s', Fanout('io_type', [
+      "cacheMissesBmap",
+      "cacheMissesXmap",
+      "cacheMissesHmap",
+      "cacheHitsBmap",
+      "cacheHitsXmap",
+      "cacheHitsHmap",
+      "pendingTxnReplayYields",
+      "txnReplayReadIOHits"])),
+], strip=['dedupStats/'])
 
 # "%r/info|health/latencyStats:./%s/info[deviceUUID]" is used for DDH only, not as important
 
-def plogDevicesRecoveryStats(out, node1, node2, entity, metrics):
-   # "/vmkModules/plog/devices" "%r/info|info:./%s/info[deviceUUID]"
-
-            # "totalRecoveryTime",
-            # "recoveryProcessTime",
-            # "numRecoveryReads",
-            # "recoveryReadTime"
-
-   labels = {'disk_uuid': entity}
-   metrics = dict([(k.replace('info/', ''), v) for k, v in metrics.items()])
-
-   phelp(out, 'vmware_vsan_plog_recovery_seconds_total', 'Total seconds of PLOG recovery', node1, node2)
-   phelp(out, 'vmware_vsan_plog_recovery_io_total', 'Total IOs of PLOG recovery', node1, node2)
-
-   for key in ["total"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key.lower()
-      rec(out, "vmware_vsan_plog_recovery_seconds_total", metrics['%sRecoveryTime' % key] / 1000.0**2, ioLabels)
-
-   for key in ["Process", "Read"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key.lower()
-      rec(out, "vmware_vsan_plog_recovery_seconds_total", metrics['recovery%sTime' % key] / 1000.0**2, ioLabels)
-
-   for key in ["Read"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key.lower()
-      rec(out, "vmware_vsan_plog_recovery_io_total", metrics['numRecovery%ss' % key], ioLabels)
-
-# "/vmkModules/lsom/disks"
-def lsomDisks(out, node1, node2, entity, metrics):
-   # "%s/info"
-   labels = {'disk_uuid': entity}
-   metrics = dict([(k.replace('info/', ''), v) for k, v in metrics.items()])
-
-   phelp(out, "vmware_vsan_disk_congestion_total", "vSAN Disk Group point in time congestion value (0-255). LSOM indicates how much incoming rate it can sustain, typically limited by physical disks or CPU. DOM maps it to bandwidth limit (0 is no limit, 255 is 0 MB/s) using a monotonic non-linear opaque function.", node1, node2)
-   for key in ["ssd", "mem", "iops", "slab", "log", "comp"]:
-      ioLabels = labels.copy()
-      ioLabels['congestion_type'] = key
-      rec(out, "vmware_vsan_disk_congestion_total", metrics['%sCongestion' % key], ioLabels)
-
-   phelp(out, "vmware_vsan_disk_congestion_bytespersecond", "vSAN Disk Group point in time congestion value in Bytes/s. LSOM indicates how much incoming rate it can sustain, DOM enforces it.", node1, node2)
-   for key in ["Log"]:
-      ioLabels = labels.copy()
-      ioLabels['congestion_type'] = key.lower()
-      rec(out, "vmware_vsan_disk_congestion_bytespersecond", metrics.get('oob%sCongestionIOPS' % key, 0) * 4096, ioLabels)
-
-   phelp(out, "vmware_vsan_disk_writebuffer_usage_bytes", "Point in time, vSAN Cache Disk write buffer consumption by various consumers", node1, node2)
-   for key in ["plogLog", "plogData", "llogLog", "llogData"]:
-      ioLabels = labels.copy()
-      ioLabels['consumer_type'] = key.lower()
-      rec(out, "vmware_vsan_disk_writebuffer_usage_bytes", metrics['%sSpace' % key], ioLabels)
-
-   phelp(out, "vmware_vsan_disk_writebuffer_size_bytes", "vSAN Cache Disk write buffer size. Static value.", node1, node2)
-   rec(out, "vmware_vsan_disk_writebuffer_size_bytes", metrics['wbSize'], labels)
+# "/vmkModules/plog/devices" "%r/info|info:./%s/info[deviceUUID]"
+         # "totalRecoveryTime",
+         # "recoveryProcessTime",
+         # "numRecoveryReads",
+         # "recoveryReadTime"
+metricFamily("vmware_vsan_plog_recovery_seconds_total", COUNTER,
+   'Total seconds of PLOG recovery')
+metricFamily("vmware_vsan_plog_recovery_io_total", COUNTER,
+   'Total IOs of PLOG recovery')
+
+plogDevicesRecoveryStats = StatsConverter(diskLabels, [
+   MetricSpec("vmware_vsan_plog_recovery_seconds_total", '%sRecoveryTime', Fanout('io_type', ['total']), div=1000.0**2),
+   MetricSpec("vmware_vsan_plog_recovery_seconds_total", 'recovery%sTime', Fanout('io_type', ['Process', 'Read'], ['process', 'read']), div=1000.0**2),
+   MetricSpec("vmware_vsan_plog_recovery_io_total", 'numRecovery%ss', Fanout('io_type', ['Read'], ['read'])),
+], strip=['info/'])
+
+# "/vmkModules/lsom/disks" "%s/info"
+metricFamily("vmware_vsan_disk_congestion_total", GAUGE,
+   "vSAN Disk Group point in time congestion value (0-255). LSOM indicates how much incoming rate it can sustain, typically limited by physical disks or CPU. DOM maps it to bandwidth limit (0 is no limit, 255 is 0 MB/s) using a monotonic non-linear opaque function.")
+metricFamily("vmware_vsan_disk_congestion_bytespersecond", GAUGE,
+   "vSAN Disk Group point in time congestion value in Bytes/s. LSOM indicates how much incoming rate it can sustain, DOM enforces it.")
+metricFamily("vmware_vsan_disk_writebuffer_usage_bytes", GAUGE,
+   "Point in time, vSAN Cache Disk write buffer consumption by various consumers")
+metricFamily("vmware_vsan_disk_writebuffer_size_bytes", GAUGE,
+   "vSAN Cache Disk write buffer size. Static value.")
+metricFamily("vmware_vsan_disk_capacity_bytes", GAUGE,
+   "Point in time, vSAN Capacity Disk logical capacity (up to 10x inflated in dedup case)")
+metricFamily("vmware_vsan_disk_capacity_used_bytes", GAUGE,
+   "Point in time, vSAN Capacity Disk logical capacity used.")
+metricFamily("vmware_vsan_disk_capacity_reserved_bytes", GAUGE,
+   "Point in time, vSAN Capacity Disk logical capacity reserved.")
+metricFamily("vmware_vsan_disk_phys_capacity_bytes", GAUGE,
+   "Point in time, vSAN Capacity Disk physical capacity (after dedup if enabled)")
+metricFamily("vmware_vsan_disk_phys_capacity_used_bytes", GAUGE,
+   "Point in time, vSAN Capacity Disk physical capacity used (after dedup if enabled).")
+metricFamily("vmware_vsan_disk_phys_capacity_reserved_bytes", GAUGE,
+   "Point in time, vSAN Capacity Disk physical capacity reserved.")
+metricFamily("vmware_vsan_disk_phys_capacity_pending_bytes", GAUGE,
+   "Point in time, vSAN Capacity Disk physical capacity Pending (XXX What does it mean?).")
+metricFamily("vmware_vsan_disk_phys_capacity_unreservedused_bytes", GAUGE,
+   "Point in time, vSAN Capacity Disk physical capacity UnreservedUsed (XXX What does it mean?).")
+
+lsomDisks = StatsConverter(diskLabels, [
+   MetricSpec("vmware_vsan_disk_congestion_total", '%sCongestion',
+      Fanout('congestion_type', ["ssd", "mem", "iops", "slab", "log", "comp"])),
+   MetricSpec("vmware_vsan_disk_congestion_bytespersecond", 'oob%sCongestionIOPS',
+      Fanout('congestion_type', ["Log"], ["log"]), scale=4096, default=0),
+   MetricSpec("vmware_vsan_disk_writebuffer_usage_bytes", '%sSpace',
+      Fanout('consumer_type', ["plogLog", "plogData", "llogLog", "llogData"], ["ploglog", "plogdata", "lloglog", "llogdata"])),
+   MetricSpec("vmware_vsan_disk_writebuffer_size_bytes", 'wbSize'),
 
    # Caacity related metrics
-   phelp(out, "vmware_vsan_disk_capacity_bytes", "Point in time, vSAN Capacity Disk logical capacity (up to 10x inflated in dedup case)", node1, node2)
-   rec(out, "vmware_vsan_disk_capacity_bytes", metrics['capacity'], labels)
-   phelp(out, "vmware_vsan_disk_capacity_used_bytes", "Point in time, vSAN Capacity Disk logical capacity used.", node1, node2)
-   rec(out, "vmware_vsan_disk_capacity_used_bytes", metrics['capacityUsed'], labels)
-   phelp(out, "vmware_vsan_disk_capacity_reserved_bytes", "Point in time, vSAN Capacity Disk logical capacity reserved.", node1, node2)
-   rec(out, "vmware_vsan_disk_capacity_reserved_bytes", metrics['capacityReserved'], labels)
-
-   phelp(out, "vmware_vsan_disk_phys_capacity_bytes", "Point in time, vSAN Capacity Disk physical capacity (after dedup if enabled)", node1, node2)
-   rec(out, "vmware_vsan_disk_phys_capacity_bytes", metrics['physDiskCapacity'], labels)
-   phelp(out, "vmware_vsan_disk_phys_capacity_used_bytes", "Point in time, vSAN Capacity Disk physical capacity used (after dedup if enabled).", node1, node2)
-   rec(out, "vmware_vsan_disk_phys_capacity_used_bytes", metrics['physDiskCapacityUsed'], labels)
-   phelp(out, "vmware_vsan_disk_phys_capacity_reserved_bytes", "Point in time, vSAN Capacity Disk physical capacity reserved.", node1, node2)
-   rec(out, "vmware_vsan_disk_phys_capacity_reserved_bytes", metrics['physCapacityReserved'], labels)
-   phelp(out, "vmware_vsan_disk_phys_capacity_pending_bytes", "Point in time, vSAN Capacity Disk physical capacity Pending (XXX What does it mean?).", node1, node2)
-   rec(out, "vmware_vsan_disk_phys_capacity_pending_bytes", metrics['physCapacityPending'], labels)
-   phelp(out, "vmware_vsan_disk_phys_capacity_unreservedused_bytes", "Point in time, vSAN Capacity Disk physical capacity UnreservedUsed (XXX What does it mean?).", node1, node2)
-   rec(out, "vmware_vsan_disk_phys_capacity_unreservedused_bytes", metrics['physCapacityUnreservedUsed'], labels)
-
-   # XXX: Below metrics are not converted yet ...
-      #       "fsMetadataSize",
-      #       "conservativePrep",
-      #       "unreservedUsage",
-
-      #       "rcSize",
-      #       "wbSize",
-
-      #       "reservedOverwrittenEstSinceLastScan",
-      #       "reservedWrittenAtLastScan",
-
-      #       "conservativeUsage",
-      #       "conservativeUnmap",
-
-
-
-      #       "plogCurrSegNo",
-      #       "plogStartSegNo",
-      #       "llogStartSegNo",
-      #       "llogCurrSegNo",
-
-      # XXX: Related to new log congestion, LSOM 1.5 metrics
-      #       "currentTrueWBFillRate",
-      #       "currentIncomingRate",
-      #       "overWriteFactorMovingAvg",
-      #       "oobBw",
-      #       "drainRateMovingAvg",
-      #       "currentDrainRate",
-      #       "currentOverWriteFactor",
-
-
-      #       "recoveryProcessTime",
-      #       "recoveryReadTime",
-      #       "totalRecoveryTime",
-      #       "numRecoveryReads",
-
-      #       "type",
-
-      #       "nrOutstandingRecovWriteOps",
-      #       "nrOutstandingRecovIoSize",
-      #       "nrOutstandingWriteOps",
-      #       "nrOutstandingIoSize",
-
-      # We don't really want precomputed averages
-      #       "avgUnmapLatency",
-      #       "avgReadLatency",
-      #       "avgUnmapTPut",
-      #       "avgReadIOPS",
-      #       "avgReadTPut",
-      #       "avgWriteTPut",
-      #       "avgWriteIOPS",
-      #       "avgUnmapIOPS",
-      #       "avgWriteLatency",
-
-      # XXX: What are these?
-      #       "aggStats/writeLeIoTime",
-      #       "aggStats/quotaEvictions",
-      #       "aggStats/plogCbSlotNotFound",
-      #       "aggStats/rar",
-      #       "aggStats/readIoTime",
-      #       "aggStats/partialMiss",
-      #       "aggStats/bytesRead",
-      #       "aggStats/rarMem",
-      #       "aggStats/wastedPatchedBytes"
-      #       "aggStats/rarRCSsd",
-      #       "aggStats/payloadIoTime",
-      #       "aggStats/unmapLeIoTime",
-      #       "aggStats/warEvictions",
-      #       "aggStats/readIoCount",
-      #       "aggStats/patchedBytes",
-      #       "aggStats/bytesWritten",
-      #       "aggStats/rawar",
-      #       "aggStats/writeIoTime",
-      #       "aggStats/rawarBytes",
-      #       "aggStats/plogCbBitNotSet",
-      #       "aggStats/unmapLeIoCount",
-      #       "aggStats/writeLeIoCount",
-      #       "aggStats/payloadIoCount",
-      #       "aggStats/miss",
-      #       "aggStats/writeIoCount",
-      #       "aggStats/plogCbInvalidated",
-      #       "aggStats/writeLeDataBytes",
-      #       "aggStats/payloadDataBytes",
-      #       "aggStats/unmapLeDataBytes",
-      #       "aggStats/memcacheEvictions",
-      #       "aggStats/plogCbPatched",
+   MetricSpec("vmware_vsan_disk_capacity_bytes", 'capacity'),
+   MetricSpec("vmware_vsan_disk_capacity_used_bytes", 'capacityUsed'),
+   MetricSpec("vmware_vsan_disk_capacity_reserved_bytes", 'capacityReserved'),
+
+   MetricSpec("vmware_vsan_disk_phys_capacity_bytes", 'physDiskCapacity'),
+   MetricSpec("vmware_vsan_disk_phys_capacity_used_bytes", 'physDiskCapacityUsed'),
+   MetricSpec("vmware_vsan_disk_phys_capacity_reserved_bytes", 'physCapacityReserved'),
+   MetricSpec("vmware_vsan_disk_phys_capacity_pending_bytes", 'physCapacityPending'),
+   MetricSpec("vmware_vsan_disk_phys_capacity_unreservedused_bytes", 'physCapacityUnreservedUsed'),
+], strip=['info/'])
+
+# XXX: Below metrics are not converted yet ...
+   #       "fsMetadataSize",
+   #       "conservativePrep",
+   #       "unreservedUsage",
+
+   #       "rcSize",
+   #       "wbSize",
+
+   #       "reservedOverwrittenEstSinceLastScan",
+   #       "reservedWrittenAtLastScan",
+
+   #       "conservativeUsage",
+   #       "conservativeUnmap",
+
+
+
+   #       "plogCurrSegNo",
+   #       "plogStartSegNo",
+   #       "llogStartSegNo",
+   #       "llogCurrSegNo",
+
+   # XXX: Related to new log congestion, LSOM 1.5 metrics
+   #       "currentTrueWBFillRate",
+   #       "currentIncomingRate",
+   #       "overWriteFactorMovingAvg",
+   #       "oobBw",
+   #       "drainRateMovingAvg",
+   #       "currentDrainRate",
+   #       "currentOverWriteFactor",
+
+
+   #       "recoveryProcessTime",
+   #       "recoveryReadTime",
+   #       "totalRecoveryTime",
+   #       "numRecoveryReads",
+
+   #       "type",
+
+   #       "nrOutstandingRecovWriteOps",
+   #       "nrOutstandingRecovIoSize",
+   #       "nrOutstandingWriteOps",
+   #       "nrOutstandingIoSize",
+
+   # We don't really want precomputed averages
+   #       "avgUnmapLatency",
+   #       "avgReadLatency",
+   #       "avgUnmapTPut",
+   #       "avgReadIOPS",
+   #       "avgReadTPut",
+   #       "avgWriteTPut",
+   #       "avgWriteIOPS",
+   #       "avgUnmapIOPS",
+   #       "avgWriteLatency",
+
+   # XXX: What are these?
+   #       "aggStats/writeLeIoTime",
+   #       "aggStats/quotaEvictions",
+   #       "aggStats/plogCbSlotNotFound",
+   #       "aggStats/rar",
+   #       "aggStats/readIoTime",
+   #       "aggStats/partialMiss",
+   #       "aggStats/bytesRead",
+   #       "aggStats/rarMem",
+   #       "aggStats/wastedPatchedBytes"
+   #       "aggStats/rarRCSsd",
+   #       "aggStats/payloadIoTime",
+   #       "aggStats/unmapLeIoTime",
+   #       "aggStats/warEvictions",
+   #       "aggStats/readIoCount",
+   #       "aggStats/patchedBytes",
+   #       "aggStats/bytesWritten",
+   #       "aggStats/rawar",
+   #       "aggStats/writeIoTime",
+   #       "aggStats/rawarBytes",
+   #       "aggStats/plogCbBitNotSet",
+   #       "aggStats/unmapLeIoCount",
+   #       "aggStats/writeLeIoCount",
+   #       "aggStats/payloadIoCount",
+   #       "aggStats/miss",
+   #       "aggStats/writeIoCount",
+   #       "aggStats/plogCbInvalidated",
+   #       "aggStats/writeLeDataBytes",
+   #       "aggStats/payloadDataBytes",
+   #       "aggStats/unmapLeDataBytes",
+   #       "aggStats/memcacheEvictions",
+   #       "aggStats/plogCbPatched",
 
 def lsomDisksCfStats(node1, node2, entity, metrics):
-      # "/vmkModules/lsom/disks/%s/CFStats":{
-      #    "metrics":[
-      #       "extentsProcessed",
-      #       "totalVirstoBarrierTime",
-      #       "numCFActivations",
-      #       "numPLOGIOs",
-      #       "unmapBytes",
-      #       "totalExtentSizeProcessed",
-      #       "componentsToFlush",
-      #       "numVirstoBarriers",
-      #       "numCksumFlushes",
-      #       "totalCFTime",
-      #       "totalCksumFlushTime",
-      #       "totalPLOGIOTime"
-      #    ],
-      pass
+   # "/vmkModules/lsom/disks/%s/CFStats":{
+   #    "metrics":[
+   #       "extentsProcessed",
+   #       "totalVirstoBarrierTime",
+   #       "numCFActivations",
+   #       "numPLOGIOs",
+   #       "unmapBytes",
+   #       "totalExtentSizeProcessed",
+   #       "componentsToFlush",
+   #       "numVirstoBarriers",
+   #       "numCksumFlushes",
+   #       "totalCFTime",
+   #       "totalCksumFlushTime",
+   #       "totalPLOGIOTime"
+   #    ],
+   pass
 
 def lsomDisksVirstoStats(node1, node2, entity, metrics):
-      # "/vmkModules/lsom/disks/%s/virstoStats":{
-      #    "metrics":[
-      #       "mfTotalMetadata",
-      #       "mbDirty",
-      #       "mbFree",
-      #       "mbValid",
-      #       "mbcMisses",
-      #       "mbcHits",
-      #       "heapUtilization",
-      #       "mbInvalid",
-      #       "mbcEvictions",
-      #       "mfRuns",
-      #       "mfPendingMetadata"
-      pass
+   # "/vmkModules/lsom/disks/%s/virstoStats":{
+   #    "metrics":[
+   #       "mfTotalMetadata",
+   #       "mbDirty",
+   #       "mbFree",
+   #       "mbValid",
+   #       "mbcMisses",
+   #       "mbcHits",
+   #       "heapUtilization",
+   #       "mbInvalid",
+   #       "mbcEvictions",
+   #       "mfRuns",
+   #       "mfPendingMetadata"
+   pass
 
 def lsomDisksChecksumStats(node1, node2, entity, metrics):
-      # "/vmkModules/lsom/disks/%s/checksumErrors":{
-      #    "metrics":[
-      #       "total"
-      pass
-
-def lsomDisksBlkattrStats(out, node1, node2, entity, metrics):
-   # "/vmkModules/lsom/disks/%s/blkattrInfo":{
+   # "/vmkModules/lsom/disks/%s/checksumErrors":{
    #    "metrics":[
-
-   labels = {'disk_uuid': entity}
-   metrics = dict([(k.replace('info/', ''), v) for k, v in metrics.items()])
-
-   phelp(out, "vmware_vsan_disk_blkattrcache_size_bytes", "vSAN Disk Group blkattr memory cache size.", node1, node2)
-   rec(out, "vmware_vsan_disk_blkattrcache_size_bytes", metrics['cacheSize'] * 1024**2, labels)
-
-   phelp(out, "vmware_vsan_disk_blkattrcache_hits_count", "vSAN Disk Group blkattr memory cache hits (number).", node1, node2)
-   rec(out, "vmware_vsan_disk_blkattrcache_hits_count", metrics['cacheHits'], labels)
-
-   phelp(out, "vmware_vsan_disk_blkattrcache_misses_count", "vSAN Disk Group blkattr memory cache misses (number).", node1, node2)
-   rec(out, "vmware_vsan_disk_blkattrcache_misses_count", metrics['cacheMisses'], labels)
-
-def plogPsaStats(out, node1, node2, entity, metrics):
-   # "/storage/scsifw/devices/%r/info|stats:/vmkModules/plog/devices/%s/info[deviceUUID]"
-
-   # DAvg: (issueTime + queueTime - layerTime) / (readOps + writeOps)
-   # GAvg: (totalTime) / (readOps + writeOps)
-
-   metrics = dict([(k.replace('info/', '').replace('latency/', '').replace('stats/', ''), v) for k, v in metrics.items()])
-   labels = {'disk_uuid': entity}
-
-   blkSize = metrics["capacity/blockSize"]
-
-   phelp(out, 'vmware_vsan_disks_dev_io_total', 'Total IOs processed by ESX device layer since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_disks_dev_bytes_total', 'Total Bytes processed by ESX device layer since boot.', node1, node2)
-   phelp(out, 'vmware_vsan_disks_dev_duration_seconds_total', 'Total seconds of IO processing time by ESX device layer since boot.', node1, node2)
-
-   for key in ["Write", "Read"]:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key.lower()
-      rec(out, "vmware_vsan_disks_dev_io_total", metrics['%sOps' % key.lower()], ioLabels)
-      bKey = "Written" if key == "Write" else key
-      rec(out, "vmware_vsan_disks_dev_bytes_total", metrics['blocks%s' % bKey] * blkSize, ioLabels)
-      bKey = "Writes" if key == "Write" else "Reads"
-      rec(out, "vmware_vsan_disks_dev_duration_seconds_total", metrics['totalTime%s' % bKey] / 1024.0**2, ioLabels)
-
+   #       "total"
+   pass
+
+
+# "/vmkModules/lsom/disks" "%s/blkattrInfo"
+metricFamily("vmware_vsan_disk_blkattrcache_size_bytes", GAUGE,
+   "vSAN Disk Group blkattr memory cache size.")
+metricFamily("vmware_vsan_disk_blkattrcache_hits_count", COUNTER,
+   "vSAN Disk Group blkattr memory cache hits (number).")
+metricFamily("vmware_vsan_disk_blkattrcache_misses_count", COUNTER,
+   "vSAN Disk Group blkattr memory cache misses (number).")
+
+lsomDisksBlkattrStats = StatsConverter(diskLabels, [
+   MetricSpec("vmware_vsan_disk_blkattrcache_size_bytes", 'cacheSize', scale=1024**2),
+   MetricSpec("vmware_vsan_disk_blkattrcache_hits_count", 'cacheHits'),
+   MetricSpec("vmware_vsan_disk_blkattrcache_misses_count", 'cacheMisses'),
+], strip=['info/'])
+
+# "/storage/scsifw/devices/%r/info|stats:/vmkModules/plog/devices/%s/info[deviceUUID]"
+
+# DAvg: (issueTime + queueTime - layerTime) / (readOps + writeOps)
+# GAvg: (totalTime) / (readOps + writeOps)
+
+metricFamily("vmware_vsan_disks_dev_io_total", COUNTER,
+   'Total IOs processed by ESX device layer since boot.')
+metricFamily("vmware_vsan_disks_dev_bytes_total", COUNTER,
+   'Total Bytes processed by ESX device layer since boot.')
+metricFamily("vmware_vsan_disks_dev_duration_seconds_total", COUNTER,
+   'Total seconds of IO processing time by ESX device layer since boot.')
+metricFamily("vmware_vsan_disks_dev_duration_breakdown_seconds_total", COUNTER,
+   'Total seconds of IO processing time (broken out into different spans/scopes) by ESX device layer since boot.')
+
+plogPsaStats = StatsConverter(diskLabels, [
+   MetricSpec("vmware_vsan_disks_dev_io_total", '%sOps', Fanout('io_type', ['write', 'read'])),
+   MetricSpec("vmware_vsan_disks_dev_bytes_total", 'blocks%s', Fanout('io_type', ['Written', 'Read'], ['write', 'read']),
+      scaleKey='capacity/blockSize'),
+   MetricSpec("vmware_vsan_disks_dev_duration_seconds_total", 'totalTime%s', Fanout('io_type', ['Writes', 'Reads'], ['write', 'read']),
+      div=1024.0**2),
    # XXX: Document the span types ...
-   phelp(out, 'vmware_vsan_disks_dev_duration_breakdown_seconds_total', 'Total seconds of IO processing time (broken out into different spans/scopes) by ESX device layer since boot.', node1, node2)
-   for key in ['issue', 'layer', 'queue', 'total']:
-      keyLabels = labels.copy()
-      keyLabels['span'] = key
-      rec(out, "vmware_vsan_disks_dev_duration_breakdown_seconds_total", metrics['%sTime' % key] / 1024.0**2, keyLabels)
-
-def netStats(out, node1, node2, entity, metrics):
-   # "/net/nics" "$getVsanNetworkStats"
-
-   # XXX: This is a mess because we mix two types ...
-            # "connects",
-            # "rx_pkts",
-            # "rxerrs",
-            # "tx_pkt_discards",
-            # "tcptimeoutdrops",
-            # "rx_bytes",
-            # "tx_pkts",
-            # "halfconns",
-            # "hw",
-            # "iochaindrops",
-            # "totalPnicPkt",
-            # "totalPkt",
-            # "tx_bytes",
-            # "rx_pkt_discards",
-
-
-   # Both:
-            # "portRxpkts",
-            # "portTxpkts",
-            # "portTxDrops",
-            # "portRxDrops",
-            # "iochainRxdrops",
-            # "iochainTxdrops",
-
-   if metrics["type"] == "vnic":
-            # "rexmits",
-            # "sack_rexmits",
-            # "rcvdupack",
-            # "rcvduppack",
-            # "sack_rcv_blocks",
-            # "rcvoopack",
-            # "sack_send_blocks",
-
-            # "conndrops",
-
-            # "snd_zerowin",
-
-            # "iptotal",
-            # "ip6total",
-            # "iperrs",
-            # "tcperrs",
-            # "ip6errs",
-      x = entity.split('|')
-      labels = {
+   MetricSpec("vmware_vsan_disks_dev_duration_breakdown_seconds_total", '%sTime', Fanout('span', ['issue', 'layer', 'queue', 'total']),
+      div=1024.0**2),
+], strip=['info/', 'latency/', 'stats/'])
+
+# "/net/nics" "$getVsanNetworkStats"
+# XXX: This is a mess because we mix two types ...
+         # "connects",
+         # "rx_pkts",
+         # "rxerrs",
+         # "tx_pkt_discards",
+         # "tcptimeoutdrops",
+         # "rx_bytes",
+         # "tx_pkts",
+         # "halfconns",
+         # "hw",
+         # "iochaindrops",
+         # "totalPnicPkt",
+         # "totalPkt",
+         # "tx_bytes",
+         # "rx_pkt_discards",
+
+
+# Both:
+         # "portRxpkts",
+         # "portTxpkts",
+         # "portTxDrops",
+         # "portRxDrops",
+         # "iochainRxdrops",
+         # "iochainTxdrops",
+
+def netLabels(node2, entity, row):
+   x = entity.split('|')
+   if row["type"] == "vnic":
+      return {
          'host_uuid': x[0],
          'stack': x[1],
          'vmknic': x[2],
       }
+   return {
+      'host_uuid': x[0],
+      'vmnic': x[1],
+   }
 
-      phelp(out, 'vmware_esx_vmknic_tcppkt_total', 'Total Packets processed by ESX VMkernel NIC TCP since boot.', node1, node2)
-      phelp(out, 'vmware_esx_vmknic_tcppkt_bytes_total', 'Total Bytes processed by ESX VMkernel NIC TCP since boot.', node1, node2)
-
-      phelp(out, 'vmware_esx_vmknic_tcppkt_rcvduppack_total', 'Total received duplicate packets by ESX VMkernel NIC TCP since boot.', node1, node2)
-      phelp(out, 'vmware_esx_vmknic_tcppkt_rcvdupack_total', 'Total received duplicate ACKs by ESX VMkernel NIC TCP since boot.', node1, node2)
-      phelp(out, 'vmware_esx_vmknic_tcppkt_sack_rcv_blocks_total', 'Total received SACK asks for blocks by ESX VMkernel NIC TCP since boot.', node1, node2)
-      phelp(out, 'vmware_esx_vmknic_tcppkt_sack_send_blocks_total', 'Total requested SACK retransmit of blocks by ESX VMkernel NIC TCP since boot.', node1, node2)
-      phelp(out, 'vmware_esx_vmknic_tcppkt_sack_rexmits_total', 'Total sent SACK asks for blocks by ESX VMkernel NIC TCP since boot.', node1, node2)
-      phelp(out, 'vmware_esx_vmknic_tcppkt_sndrexmitpack_total', 'Total retransmitted packets by ESX VMkernel NIC TCP since boot.', node1, node2)
-      phelp(out, 'vmware_esx_vmknic_tcppkt_rcvoopack_total', 'Total received out-of-order packets by ESX VMkernel NIC TCP since boot.', node1, node2)
-
-
-      for key, key2 in [("rx", 'rcv'), ("tx", 'snd')]:
-         ioLabels = labels.copy()
-         ioLabels['io_type'] = key
-         rec(out, "vmware_esx_vmknic_tcppkt_total", metrics['tcp%spkts' % key], ioLabels)
-         rec(out, "vmware_esx_vmknic_tcppkt_bytes_total", metrics['%sbyte' % key2], ioLabels)
-
-      rec(out, "vmware_esx_vmknic_tcppkt_rcvduppack_total", metrics["rcvduppack"], labels)
-      rec(out, "vmware_esx_vmknic_tcppkt_rcvdupack_total", metrics["rcvdupack"], labels)
-      rec(out, "vmware_esx_vmknic_tcppkt_sack_rcv_blocks_total", metrics["sack_rcv_blocks"], labels)
-      rec(out, "vmware_esx_vmknic_tcppkt_sack_send_blocks_total", metrics["sack_send_blocks"], labels)
-      rec(out, "vmware_esx_vmknic_tcppkt_sack_rexmits_total", metrics["sack_rexmits"], labels)
-      rec(out, "vmware_esx_vmknic_tcppkt_sndrexmitpack_total", metrics["rexmits"], labels)
-      rec(out, "vmware_esx_vmknic_tcppkt_rcvoopack_total", metrics["rcvoopack"], labels)
-
-   elif metrics["type"] == "pnic":
-      x = entity.split('|')
-      labels = {
-         'host_uuid': x[0],
-         'vmnic': x[1],
-      }
-
-      phelp(out, 'vmware_esx_pnic_pkt_total', 'Total Packets processed by ESX physical NIC since boot.', node1, node2)
-      phelp(out, 'vmware_esx_pnic_pkt_bytes_total', 'Total Bytes processed by ESX physical NIC since boot.', node1, node2)
-
-
-      for key in ["rx", "tx"]:
-         ioLabels = labels.copy()
-         ioLabels['io_type'] = key
-         rec(out, "vmware_esx_pnic_pkt_total", metrics['%spkt' % key], ioLabels)
-         rec(out, "vmware_esx_pnic_pkt_bytes_total", metrics['%sbytes' % key], ioLabels)
-         rec(out, "vmware_esx_pnic_pkt_err_total", metrics['%stoterr' % key], ioLabels)
-   else:
-      assert(False)
-
-def vsanSlabStats(out, node1, node2, entity, metrics):
+metricFamily("vmware_esx_vmknic_tcppkt_total", COUNTER,
+   'Total Packets processed by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_vmknic_tcppkt_bytes_total", COUNTER,
+   'Total Bytes processed by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_vmknic_tcppkt_rcvduppack_total", COUNTER,
+   'Total received duplicate packets by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_vmknic_tcppkt_rcvdupack_total", COUNTER,
+   'Total received duplicate ACKs by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_vmknic_tcppkt_sack_rcv_blocks_total", COUNTER,
+   'Total received SACK asks for blocks by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_vmknic_tcppkt_sack_send_blocks_total", COUNTER,
+   'Total requested SACK retransmit of blocks by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_vmknic_tcppkt_sack_rexmits_total", COUNTER,
+   'Total sent SACK asks for blocks by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_vmknic_tcppkt_sndrexmitpack_total", COUNTER,
+   'Total retransmitted packets by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_vmknic_tcppkt_rcvoopack_total", COUNTER,
+   'Total received out-of-order packets by ESX VMkernel NIC TCP since boot.')
+metricFamily("vmware_esx_pnic_pkt_total", COUNTER,
+   'Total Packets processed by ESX physical NIC since boot.')
+metricFamily("vmware_esx_pnic_pkt_bytes_total", COUNTER,
+   'Total Bytes processed by ESX physical NIC since boot.')
+metricFamily("vmware_esx_pnic_pkt_err_total", COUNTER,
+   'Total errors of packets processed by ESX physical NIC since boot.')
+
+netStats = StatsConverter(netLabels, {
+         # "rexmits",
+         # "sack_rexmits",
+         # "rcvdupack",
+         # "rcvduppack",
+         # "sack_rcv_blocks",
+         # "rcvoopack",
+         # "sack_send_blocks",
+
+         # "conndrops",
+
+         # "snd_zerowin",
+
+         # "iptotal",
+         # "ip6total",
+         # "iperrs",
+         # "tcperrs",
+         # "ip6errs",
+   'vnic': [
+      MetricSpec("vmware_esx_vmknic_tcppkt_total", 'tcp%spkts', Fanout('io_type', ['rx', 'tx'])),
+      MetricSpec("vmware_esx_vmknic_tcppkt_bytes_total", '%sbyte', Fanout('io_type', ['rcv', 'snd'], ['rx', 'tx'])),
+      MetricSpec("vmware_esx_vmknic_tcppkt_rcvduppack_total", "rcvduppack"),
+      MetricSpec("vmware_esx_vmknic_tcppkt_rcvdupack_total", "rcvdupack"),
+      MetricSpec("vmware_esx_vmknic_tcppkt_sack_rcv_blocks_total", "sack_rcv_blocks"),
+      MetricSpec("vmware_esx_vmknic_tcppkt_sack_send_blocks_total", "sack_send_blocks"),
+      MetricSpec("vmware_esx_vmknic_tcppkt_sack_rexmits_total", "sack_rexmits"),
+      MetricSpec("vmware_esx_vmknic_tcppkt_sndrexmitpack_total", "rexmits"),
+      MetricSpec("vmware_esx_vmknic_tcppkt_rcvoopack_total", "rcvoopack"),
+   ],
+   'pnic': [
+      MetricSpec("vmware_esx_pnic_pkt_total", '%spkt', Fanout('io_type', ['rx', 'tx'])),
+      MetricSpec("vmware_esx_pnic_pkt_bytes_total", '%sbytes', Fanout('io_type', ['rx', 'tx'])),
+      MetricSpec("vmware_esx_pnic_pkt_err_total", '%stoterr', Fanout('io_type', ['rx', 'tx'])),
+   ],
+}, variant=lambda node2, row: row["type"], labelKeys=['type'],
+   parseCache=entityLabelsCache)
+
+def slabLabels(node2, entity, row):
    # "/vmkModules/vsanutil/slabs" "$getSlabInformation"
 
    hostUuid, slabName = entity.split("|", 2)
@@ -698,123 +1036,123 @@ def vsanSlabStats(out, node1, node2, entity, metrics):
    elif 'RDT' in slabName:
       labels['subsystem'] = "RDT"
    labels['slab'] = slabName
-
-   phelp(out, "vmware_esx_slab_alloc_count", "Point in time. Number of objects allocated/used. For some being full is normal, others may impact control or IO operations", node1, node2)
-   phelp(out, "vmware_esx_slab_max_count", "Point in time. Total number of objects in the slab that could be allocated from. For some being full is normal, others may impact control or IO operations", node1, node2)
-   rec(out, "vmware_esx_slab_alloc_count", metrics['allocCount'], labels)
-   rec(out, "vmware_esx_slab_max_count", metrics['maxObjs'], labels)
-
-   # XXX: Add new alloc failures ...
-
-def domClientCacheStats(out, node1, node2, entity, metrics):
-   # "/vmkModules/vsan/dom" "clientCacheStats"
-   labels = {
-      'host_uuid': entity,
-   }
-
-   phelp(out, "vmware_vsan_dom_clientcache_readio_count", "Total number of Read IOs seen by vSAN DOM Client memory read cache since boot (number).", node1, node2)
-   rec(out, "vmware_vsan_dom_clientcache_readio_count", metrics['lookups'], labels)
-
-   phelp(out, "vmware_vsan_dom_clientcache_readhit_count", "Total number of cache hit Read IOs seen by vSAN DOM Client memory read cache since boot (number).", node1, node2)
-   rec(out, "vmware_vsan_dom_clientcache_readhit_count", metrics['hits'], labels)
-
-def domOriginStats(out, node1, node2, entity, metrics):
+   return labels
+
+# XXX: Add new alloc failures ...
+metricFamily("vmware_esx_slab_alloc_count", GAUGE,
+   "Point in time. Number of objects allocated/used. For some being full is normal, others may impact control or IO operations")
+metricFamily("vmware_esx_slab_max_count", GAUGE,
+   "Point in time. Total number of objects in the slab that could be allocated from. For some being full is normal, others may impact control or IO operations")
+
+vsanSlabStats = StatsConverter(slabLabels, [
+   MetricSpec("vmware_esx_slab_alloc_count", 'allocCount'),
+   MetricSpec("vmware_esx_slab_max_count", 'maxObjs'),
+], parseCache=entityLabelsCache)
+
+# "/vmkModules/vsan/dom" "clientCacheStats"
+metricFamily("vmware_vsan_dom_clientcache_readio_count", COUNTER,
+   "Total number of Read IOs seen by vSAN DOM Client memory read cache since boot (number).")
+metricFamily("vmware_vsan_dom_clientcache_readhit_count", COUNTER,
+   "Total number of cache hit Read IOs seen by vSAN DOM Client memory read cache since boot (number).")
+
+domClientCacheStats = StatsConverter(hostLabels, [
+   MetricSpec("vmware_vsan_dom_clientcache_readio_count", 'lookups'),
+   MetricSpec("vmware_vsan_dom_clientcache_readhit_count", 'hits'),
+])
+
+def domOriginLabels(node2, entity, row):
    # "/vmkModules/vsan/dom/compSchedulers": ["%s/OriginStatsPolicyChange",
    #                                         "%s/OriginStatsDecom",
    #                                         "%s/OriginStatsRebalance",
    #                                         "%s/OriginStatsFixCompliance"]
-   resyncType = node2.replace('%s/OriginStats', '').lower()
-   labels = {
+   return {
       'disk_uuid': entity,
-      'resync_type': resyncType,
+      'resync_type': node2.replace('%s/OriginStats', '').lower(),
    }
 
-   rsyncTypeStr = (
-      'PolicyChange: resync traffic caused by change of policy; '
-      'Decom: resync traffic caused by maintenance mode and disk evacuation; '
-      'Rebalance: resync traffic caused by rebalancing objects; '
-      'FixCompliance: resync traffic caused by object repair.'
-   )
-   phelp(out, 'vmware_vsan_domdg_resync_io_total',
-         'Total IOs of resync read/recovery write of PolicyChange/Decom/Rebalance/FixCompliance processed on DiskGroup. %s' % rsyncTypeStr,
-         node1, node2)
-   phelp(out, 'vmware_vsan_domdg_resync_io_bytes_total',
-         'Total bytes of resync read/recovery write of PolicyChange/Decom/Rebalance/FixCompliance processed on DiskGroup. %s' % rsyncTypeStr,
-         node1, node2)
-   phelp(out, 'vmware_vsan_domdg_resync_io_duration_seconds_total',
-         'Sum total of duration of IO of resync read/recovery write of PolicyChange/Decom/Rebalance/FixCompliance processed on DiskGroup. '
-         'The duration is the time from the scheduler queueing to the scheduler seeing the completion of the IO. %s' % rsyncTypeStr,
-         node1, node2)
-
-   for key in ['read', 'recWrite']:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key.lower()
-      rec(out, 'vmware_vsan_domdg_resync_io_total', metrics['%sCount' % key], ioLabels)
-      rec(out, 'vmware_vsan_domdg_resync_io_bytes_total', metrics['%sBytes' % key], ioLabels)
-      rec(out, 'vmware_vsan_domdg_resync_io_duration_seconds_total', metrics['%sLatencyUs' % key] / 1000.0**2, ioLabels)
-
-   phelp(out, 'vmware_vsan_domdg_resync_tosync_bytes_total',
-         'Sum total of bytes which will resync of current active jobs of PolicyChange/Decom/Rebalance/FixCompliance on DiskGroup. %s' % rsyncTypeStr,
-         node1, node2)
-   rec(out, 'vmware_vsan_domdg_resync_tosync_bytes_total', metrics['sumBytesToSync'], labels)
-
-def hostCpuStats(out, node1, node2, entity, metrics):
-   # "/sched/pcpus": ["$getHostCpuInformation"],
-   labels = {
-      'host_uuid': entity,
-   }
-
-   phelp(out, 'vmware_host_cpu_seconds_total',
-         'usedtime is a sum total of the used time of all pCPUs on host. '
-         'elapsedtime is a sum total of the elapsed time of all pCPUs on host. '
-         'utiltime is a sum total of the utilization time of all pCPUs on host. '
-         'coreutiltime is a sum total of the utilization time of cores of all pCPUs on host.',
-         node1, node2)
-
-   for key in ['coreUtilTime', 'elapsedTime', 'usedTime', 'utilTime']:
-      newLabels = labels.copy()
-      newLabels['type'] = key.lower()
-      rec(out, 'vmware_host_cpu_seconds_total', metrics[key] / 1000.0**3, newLabels)
-
-def virtualSCSIStats(out, node1, node2, entity, metrics):
+_rsyncTypeStr = (
+   'PolicyChange: resync traffic caused by change of policy; '
+   'Decom: resync traffic caused by maintenance mode and disk evacuation; '
+   'Rebalance: resync traffic caused by rebalancing objects; '
+   'FixCompliance: resync traffic caused by object repair.'
+)
+_resyncIoTypes = Fanout('io_type', ['read', 'recWrite'], ['read', 'recwrite'])
+metricFamily("vmware_vsan_domdg_resync_io_total", COUNTER,
+   'Total IOs of resync read/recovery write of PolicyChange/Decom/Rebalance/FixCompliance processed on DiskGroup. %s' % _rsyncTypeStr)
+metricFamily("vmware_vsan_domdg_resync_io_bytes_total", COUNTER,
+   'Total bytes of resync read/recovery write of PolicyChange/Decom/Rebalance/FixCompliance processed on DiskGroup. %s' % _rsyncTypeStr)
+metricFamily("vmware_vsan_domdg_resync_io_duration_seconds_total", COUNTER,
+   'Sum total of duration of IO of resync read/recovery write of PolicyChange/Decom/Rebalance/FixCompliance processed on DiskGroup. '
+   'The duration is the time from the scheduler queueing to the scheduler seeing the completion of the IO. %s' % _rsyncTypeStr)
+metricFamily("vmware_vsan_domdg_resync_tosync_bytes_total", GAUGE,
+   'Sum total of bytes which will resync of current active jobs of PolicyChange/Decom/Rebalance/FixCompliance on DiskGroup. %s' % _rsyncTypeStr)
+
+domOriginStats = StatsConverter(domOriginLabels, [
+   MetricSpec('vmware_vsan_domdg_resync_io_total', '%sCount', _resyncIoTypes),
+   MetricSpec('vmware_vsan_domdg_resync_io_bytes_total', '%sBytes', _resyncIoTypes),
+   MetricSpec('vmware_vsan_domdg_resync_io_duration_seconds_total', '%sLatencyUs', _resyncIoTypes, div=1000.0**2),
+   MetricSpec('vmware_vsan_domdg_resync_tosync_bytes_total', 'sumBytesToSync'),
+])
+
+# "/sched/pcpus": ["$getHostCpuInformation"],
+_cpuTimes = ['coreUtilTime', 'elapsedTime', 'usedTime', 'utilTime']
+metricFamily("vmware_host_cpu_seconds_total", COUNTER,
+   'usedtime is a sum total of the used time of all pCPUs on host. '
+   'elapsedtime is a sum total of the elapsed time of all pCPUs on host. '
+   'utiltime is a sum total of the utilization time of all pCPUs on host. '
+   'coreutiltime is a sum total of the utilization time of cores of all pCPUs on host.')
+
+hostCpuStats = StatsConverter(hostLabels, [
+   MetricSpec('vmware_host_cpu_seconds_total', '%s', Fanout('type', _cpuTimes, [key.lower() for key in _cpuTimes]), div=1000.0**3),
+])
+
+_cnsLabelKeys = ['cns.k8s.pvc.namespace', 'cns.containerCluster.clusterId', 'cns.k8s.pv.name', 'cns.k8s.pvc.name']
+
+def virtualSCSILabels(node2, entity, row):
    # "/worldGroups": ["%v/vscsi/%v/stats/ioStats"],
    vmInstanceUuid, vscsiName = entity.split('|')
    labels = {
       'vm_instance_uuid': vmInstanceUuid,
       'vscsi_name': vscsiName,
-      'objuuid': metrics.get('objUuid'),
+      'objuuid': row.get('objUuid'),
    }
-   for m in ['cns.k8s.pvc.namespace', 'cns.containerCluster.clusterId', 'cns.k8s.pv.name', 'cns.k8s.pvc.name']:
-      if m in metrics:
+   for m in _cnsLabelKeys:
+      if m in row:
          label = m.replace('.', '_')
-         labels[label] = metrics[m]
-
-   phelp(out, 'vmware_vsan_vscsi_io_total', 'Total IOs seen by a VSCSI controller in a VM.', node1, node2)
-   phelp(out, 'vmware_vsan_vscsi_io_bytes_total', 'Total bytes seen by a VSCSI controller in a VM.', node1, node2)
-   phelp(out, 'vmware_vsan_vscsi_io_duration_seconds_total', 'Sum total of duration of IO seen by a VSCSI controller in a VM.', node1, node2)
-
-   for key in ['Read', 'Write']:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key.lower()
-      rec(out, 'vmware_vsan_vscsi_io_total', metrics['num%ss' % key], ioLabels)
-      rec(out, 'vmware_vsan_vscsi_io_bytes_total', metrics['bytes%s' % key], ioLabels)
-      rec(out, 'vmware_vsan_vscsi_io_duration_seconds_total', metrics['latency%ss' % key] / 1000.0**2, ioLabels)
-
-def virtualDiskStats(out, node1, node2, entity, metrics):
+         labels[label] = row[m]
+   return labels
+
+_vscsiIoTypes = Fanout('io_type', ['Read', 'Write'], ['read', 'write'])
+metricFamily("vmware_vsan_vscsi_io_total", COUNTER,
+   'Total IOs seen by a VSCSI controller in a VM.')
+metricFamily("vmware_vsan_vscsi_io_bytes_total", COUNTER,
+   'Total bytes seen by a VSCSI controller in a VM.')
+metricFamily("vmware_vsan_vscsi_io_duration_seconds_total", COUNTER,
+   'Sum total of duration of IO seen by a VSCSI controller in a VM.')
+
+virtualSCSIStats = StatsConverter(virtualSCSILabels, [
+   MetricSpec('vmware_vsan_vscsi_io_total', 'num%ss', _vscsiIoTypes),
+   MetricSpec('vmware_vsan_vscsi_io_bytes_total', 'bytes%s', _vscsiIoTypes),
+   MetricSpec('vmware_vsan_vscsi_io_duration_seconds_total', 'latency%ss', _vscsiIoTypes, div=1000.0**2),
+], labelKeys=['objUuid'] + _cnsLabelKeys)
+
+def virtualDiskLabels(node2, entity, row):
    # "/vmkModules/vsan/dom/topclients": ["$getVirtualDiskStats"],
-   labels = {
+   return {
       'objpath': entity,
-      'objuuid': metrics.get('objUuid'),
+      'objuuid': row.get('objUuid'),
    }
 
-   phelp(out, 'vmware_vsan_vdisk_normalizedio_total', 'Total normalized IOs of a virtual disk.', node1, node2)
-   for key in ['Read', 'ReadDelay', 'Write', 'WriteDelay']:
-      ioLabels = labels.copy()
-      ioLabels['io_type'] = key.lower()
-      rec(out, "vmware_vsan_vdisk_normalizedio_total", metrics['normalized%sCount' % key], ioLabels)
+metricFamily("vmware_vsan_vdisk_normalizedio_total", COUNTER,
+   'Total normalized IOs of a virtual disk.')
+metricFamily("vmware_vsan_vdisk_iopslimit", GAUGE,
+   'IOPS limit number of a virtual disk.')
 
-   phelp(out, 'vmware_vsan_vdisk_iopslimit', 'IOPS limit number of a virtual disk.', node1, node2)
-   rec(out, "vmware_vsan_vdisk_iopslimit", metrics['objIopsLimit'], labels)
+virtualDiskStats = StatsConverter(virtualDiskLabels, [
+   MetricSpec("vmware_vsan_vdisk_normalizedio_total", 'normalized%sCount',
+      Fanout('io_type', ['Read', 'ReadDelay', 'Write', 'WriteDelay'], ['read', 'readdelay', 'write', 'writedelay'])),
+   MetricSpec("vmware_vsan_vdisk_iopslimit", 'objIopsLimit'),
+], labelKeys=['objUuid'])
 
 # Whats missing in this file ...
    # P3:
@@ -938,6 +1276,14 @@ paths = [
    ),
 ]
 
+# The help of every family tells the stats nodes it's converted from
+def _SetFamilyOrigins():
+   for node1, node2s, converter in paths:
+      for metric in converter.metrics():
+         METRIC_FAMILIES[metric].setOrigin(node1, node2s)
+
+_SetFamilyOrigins()
+
 def augmentLabels(labels, hostInfo):
    if 'host_uuid' not in labels:
       labels['host_uuid'] = hostInfo['host_uuid']
@@ -957,6 +1303,74 @@ def augmentLabels(labels, hostInfo):
    if 'vm_instance_uuid' in labels:
       labels['vm_name'] = hostInfo['vmDict'].get(labels['vm_instance_uuid']) or "unknown-vmName"
 
+def renderLabels(labels, hostInfo):
+   augmentLabels(labels, hostInfo)
+   return ",".join(['%s="%s"' % (k, v) for k, v in labels.items()])
+
+# Version of the topology of a host the labels are augmented with, it changes
+# with the disks of the host or the names of the VMs
+def topologyVersion(hostInfo):
+   return (hostInfo.get('version', 0),
+           getattr(hostInfo['vmDict'], 'version', 0))
+
+# Cache of the rendered labels of the entities of a host, the entries are
+# dropped when the topology of the host changes. Entries are kept in two
+# generations, those not used by a whole conversion of the host are dropped,
+# so entities gone from the host don't pile up.
+class LabelCache:
+   def __init__(self):
+      self.hostInfo = None
+      self.version = None
+      self.entries = {}
+      self.previous = {}
+
+   # Start a conversion of the stats of the host
+   def begin(self, hostInfo):
+      version = topologyVersion(hostInfo)
+      self.hostInfo = hostInfo
+      if version != self.version:
+         self.version = version
+         self.previous = {}
+      else:
+         self.previous = self.entries
+      self.entries = {}
+
+   def get(self, key):
+      labelSets = self.entries.get(key)
+      if labelSets is None:
+         labelSets = self.previous.pop(key, None)
+         if labelSets is not None:
+            self.entries[key] = labelSets
+      return labelSets
+
+   def put(self, key, labelSets):
+      self.entries[key] = labelSets
+
+   def render(self, labelSets):
+      return [renderLabels(labels, self.hostInfo) for labels in labelSets]
+
+# Cache of the schemas of the stats nodes of a host, so the specs are compiled
+# against the metrics of a node once, not at every conversion. A node is
+# compiled again if its metrics change, e.g. the host is upgraded.
+class StatsSchemaCache:
+   def __init__(self, hostname):
+      self.hostname = hostname
+      # (node1, node2) -> NodeSchema
+      self.schemas = {}
+
+   def get(self, converter, node1, node2, metrics, missingMetrics=()):
+      key = (node1, node2)
+      schema = self.schemas.get(key)
+      if schema is not None and schema.metrics == metrics:
+         return schema
+      schema = converter.schema(metrics, missingMetrics)
+      missing = len(set(missingMetrics) - set(metrics))
+      logging.debug('%s schema of stats %s, %s of host %s, %d metrics, %d '
+         'missing', 'New' if key not in self.schemas else 'Changed', node1,
+         node2, self.hostname, len(metrics), missing)
+      self.schemas[key] = schema
+      return schema
+
 
 # hostInfo:
 #   host_uuid: ...
@@ -974,21 +1388,21 @@ def augmentLabels(labels, hostInfo):
 # ] value [ timestamp ]
 # metric_name: Uses underscore-seperated hierarchy (general to specific)
 # XXX query was added to mirror generateWavefrontFormat signature, implement later
+# stats: SampleStore
+# Every family is formatted at once into one line of outStr, the header and
+# samples separated by newlines and followed by an empty line.
 def generatePrometheusFormat(hostInfo, stats, query):
+   # labels not rendered by a LabelCache are rendered once per label set
+   labels = [labels if isinstance(labels, str) else
+             renderLabels(labels, hostInfo) for labels in stats.labels]
    outStr = []
-   for metric, info in stats.items():
-      if info['help'] is not None:
-         helpStr = info['help']
-         origin = info['origin']
-         originStr = "%s %s" % (origin['path'], ",".join(origin['nodes']))
-         helpStr = "%s [from %s]" % (helpStr, originStr)
-         outStr.append("# HELP %s %s" % (metric, helpStr))
-      for val, labels in info['values']:
-         augmentLabels(labels, hostInfo)
-
-         labelsStr = ",".join(['%s="%s"' % (k, v) for k, v in labels.items()])
-         outStr.append("%s{%s} %f" % (metric, labelsStr, val))
-      outStr.append("")
+   for metric, samples in stats.families.items():
+      n = len(samples.values)
+      args = [None] * (2 * n)
+      args[0::2] = [labels[labelId] for labelId in samples.labelIds]
+      args[1::2] = samples.values
+      outStr.append("%s\n%s" % (METRIC_FAMILIES[metric].header,
+                                ("%s{%%s} %%f\n" % metric) * n % tuple(args)))
    return outStr
 
 # source: Overrides the source tag in Wavefront format
@@ -1015,6 +1429,7 @@ def _DecodeQuery(query):
 # metricName: Uses dot-seperated hierarchy (general to specific)
 # pointTags: An arbitrary number of key-value pairs separated by spaces: <k1>="<v1>" ... <kn>="<vn>"
 # https://docs.wavefront.com/wavefront_data_format.html
+# stats: SampleStore of labels not rendered
 def generateWavefrontFormat(hostInfo, stats, query):
    query = _DecodeQuery(query)
    source = query.get('source', None)
@@ -1025,14 +1440,14 @@ def generateWavefrontFormat(hostInfo, stats, query):
       # After several tests, we will use float type now.
       tsStr = '%.3f ' % time.time()
    outStr = []
-   for metric, info in stats.items():
+   for metric, values in stats.items():
       metric = metric.replace('_', '.')
       if 'metrics' in query and metric not in query['metrics']:
          # Not the most efficient place to filter, but we aren't sure about the use case
          # to begin with, so this is easy to implement.
          continue
       full_metric = '%s.%s' %(metricPrefix, metric) if metricPrefix else metric
-      for val, labels in info['values']:
+      for val, labels in values:
          augmentLabels(labels, hostInfo)
          if 'labels' in query:
             labels.update(query['labels'])
@@ -5,13 +5,21 @@
 #
 
 import logging
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, send_file
 import sys
 import signal
 from vsanPrometheusStats import VsanPrometheusStats
+from snapshotStore import SNAPSHOT_DIR, SnapshotReader
 
 
-vps = VsanPrometheusStats()
+# With SNAPSHOT_DIR, the stats are collected by the collector process started
+# in gunicorn.conf, and the workers only serve its snapshots
+if SNAPSHOT_DIR:
+   vps = None
+   snapshots = SnapshotReader(SNAPSHOT_DIR)
+else:
+   vps = VsanPrometheusStats()
+   snapshots = None
 
 def create_app():
    app = Flask(__name__)
@@ -22,7 +30,9 @@ def create_app():
 
    @app.route('/vsan/metrics')
    @app.route('/vsan/metrics/<host>')
-   def generate_vsanmetrics(host=None):
+   @app.route('/vsan/metrics/<cluster>/<host>')
+   @app.route('/vsan/metrics/<vcenter>/<cluster>/<host>')
+   def generate_vsanmetrics(host=None, cluster=None, vcenter=None):
       logging.info('Requesting %s', request.path)
       is_authorized = _is_authorized(request)
 
@@ -30,7 +40,10 @@ def create_app():
          result = []
          if is_authorized:
             try:
-               result = vps.serviceDiscovery(request.host)
+               if snapshots is not None:
+                  result = snapshots.serviceDiscovery(request.host)
+               else:
+                  result = vps.serviceDiscovery(request.host)
             except:
                logging.exception('Exception in service discovery')
          else:
@@ -40,18 +53,48 @@ def create_app():
       if not is_authorized:
          return {'msg': 'Not authorized'}, 401
 
+      if snapshots is not None:
+         return _send_snapshot(host, cluster, vcenter)
+
       if host is None:
          result = vps.getStatsForAllHosts()
       else:
-         result = vps.getStatsForHost(host)
+         result = vps.getStatsForHost(host, cluster, vcenter)
       if result is None:
          return {'msg': 'Metrics not found'}, 404
       return Response(vps.generateStatsAsStream(result), mimetype='text/plain')
 
+   @app.route('/vsan/exporter/metrics')
+   def generate_exportermetrics():
+      if not _is_authorized(request):
+         return {'msg': 'Not authorized'}, 401
+      if snapshots is not None:
+         data = snapshots.readExporterStats()
+         if data is None:
+            return {'msg': 'Metrics not found'}, 404
+         return Response(data, mimetype='text/plain')
+      return Response('\n'.join(vps.generateExporterStats()),
+                      mimetype='text/plain')
+
+   # The snapshot of a single host is sent as a file, by sendfile() of the
+   # worker if supported
+   def _send_snapshot(host, cluster, vcenter):
+      if host is None:
+         paths = snapshots.listHosts()
+         if not paths:
+            return {'msg': 'Metrics not found'}, 404
+         return Response(snapshots.iterHosts(paths), mimetype='text/plain')
+      path = snapshots.findHost(host, cluster, vcenter)
+      if path is None:
+         return {'msg': 'Metrics not found'}, 404
+      return send_file(path, mimetype='text/plain', conditional=False)
+
    def _is_authorized(request):
       headers = request.headers
       auth_str = headers.get('Authorization', '')
       token = _parse_auth_info(auth_str)
+      if snapshots is not None:
+         return snapshots.isAuthorized(token)
       return vps.isAuthorized(token)
 
    def _parse_auth_info(auth_str):
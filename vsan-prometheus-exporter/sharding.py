@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import bisect
+import socket
+import hashlib
+import logging
+import threading
+
+# Comma separated addresses (host:port) of all exporter replicas
+SHARD_PEERS = os.environ.get('SHARD_PEERS', '')
+# host:port of a DNS name resolving to the addresses of all exporter replicas,
+# e.g. a headless service, used instead of SHARD_PEERS
+SHARD_SERVICE = os.environ.get('SHARD_SERVICE')
+# The address of this replica as listed in SHARD_PEERS or resolved from
+# SHARD_SERVICE, the own IP address is used with SHARD_SERVICE if not set
+SHARD_SELF = os.environ.get('SHARD_SELF')
+# The number of points of every replica on the hash ring
+SHARD_VNODES = int(os.environ.get('SHARD_VNODES', 128))
+# The interval to resolve SHARD_SERVICE for replicas coming or going
+SHARD_REFRESH_INTERVAL = int(os.environ.get('SHARD_REFRESH_INTERVAL', 30))
+
+
+def _Hash(key):
+   return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+def _FormatAddress(ip, port):
+   if ':' in ip:
+      return '[%s]:%s' % (ip, port)
+   return '%s:%s' % (ip, port)
+
+# Consistent hash ring of the replicas. Every replica is placed on the ring
+# vnodes times, and a key is owned by the first replica following the hash of
+# the key, so a replica coming or going only moves the keys of its own points.
+class HashRing:
+   def __init__(self, nodes, vnodes):
+      self.nodes = sorted(set(nodes))
+      points = sorted((_Hash('%s#%d' % (node, i)), node)
+                      for node in self.nodes for i in range(vnodes))
+      self.hashes = [h for h, _ in points]
+      self.owners = [node for _, node in points]
+
+   def getNode(self, key):
+      if not self.owners:
+         return None
+      i = bisect.bisect(self.hashes, _Hash(key)) % len(self.hashes)
+      return self.owners[i]
+
+
+# The replicas of the exporter fleet and the hash ring deciding which replica
+# owns a host. The replicas are either listed statically or resolved from DNS
+# periodically.
+class ShardMembership:
+   def __init__(self, selfAddress, peers=None, service=None,
+                vnodes=SHARD_VNODES, refreshInterval=SHARD_REFRESH_INTERVAL):
+      self.service = service
+      self.vnodes = vnodes
+      self.refreshInterval = refreshInterval
+      if selfAddress is None:
+         host, port = service.rsplit(':', 1)
+         selfAddress = _FormatAddress(
+            socket.gethostbyname(socket.gethostname()), port)
+      self.selfAddress = selfAddress
+      self.ring = HashRing([selfAddress], vnodes)
+      self.stopEvent = threading.Event()
+      self.thread = None
+      if peers:
+         self._update(peers)
+
+   def start(self):
+      if self.service is None or self.thread is not None:
+         return
+      self._refresh()
+      self.thread = threading.Thread(
+         target=self._run, name='shard-membership', daemon=True)
+      self.thread.start()
+
+   def stop(self):
+      self.stopEvent.set()
+
+   # Return the address of the replica owning key
+   def ownerOf(self, key):
+      return self.ring.getNode(key)
+
+   def owns(self, key):
+      return self.ring.getNode(key) == self.selfAddress
+
+   def getPeers(self):
+      return self.ring.nodes
+
+   def _update(self, peers):
+      # always keep itself on the ring, so it owns its share before it's
+      # resolvable by the other replicas
+      nodes = sorted(set(peers) | set([self.selfAddress]))
+      if nodes != self.ring.nodes:
+         logging.info('Exporter replicas changed to %s, this is %s',
+            nodes, self.selfAddress)
+         self.ring = HashRing(nodes, self.vnodes)
+
+   def _refresh(self):
+      host, port = self.service.rsplit(':', 1)
+      try:
+         infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+      except:
+         logging.exception('Failed to resolve exporter replicas %s',
+            self.service)
+         return
+      self._update([_FormatAddress(info[4][0], port) for info in infos])
+
+   def _run(self):
+      while not self.stopEvent.wait(self.refreshInterval):
+         self._refresh()
+
+
+# Return the ShardMembership configured by env, None if sharding is disabled
+def CreateShardMembership():
+   peers = [peer.strip() for peer in SHARD_PEERS.split(',') if peer.strip()]
+   if not peers and not SHARD_SERVICE:
+      return None
+   if peers and SHARD_SELF is None:
+      raise Exception('SHARD_SELF must be set with SHARD_PEERS')
+   # a replica missing from the peers of the others would own hosts they
+   # point to another replica
+   if peers and not SHARD_SERVICE and SHARD_SELF not in peers:
+      raise Exception('SHARD_SELF %s is not in SHARD_PEERS' % SHARD_SELF)
+   shards = ShardMembership(SHARD_SELF, peers, SHARD_SERVICE)
+   shards.start()
+   logging.info('Sharding enabled, this replica is %s', shards.selfAddress)
+   return shards
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Split of the exporter into one collector process, which owns the VC sessions
+# and publishes the rendered stats of every host as a file, and any number of
+# stateless gunicorn workers serving those files. The files live in
+# SNAPSHOT_DIR, which should be on tmpfs, e.g. /dev/shm.
+
+import os
+import json
+import time
+import glob
+import logging
+import threading
+import multiprocessing
+
+from vsanPrometheusStats import (
+   VsanPrometheusStats, GenerateStatsAsString, FormatExporterMetric)
+
+# If set, stats are collected by a dedicated collector process and published
+# as snapshots in this directory
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR')
+# The interval to publish the snapshots of all hosts
+SNAPSHOT_INTERVAL = int(os.environ.get('SNAPSHOT_INTERVAL', 30))
+# The max age of a snapshot to be served, should be larger than
+# SNAPSHOT_INTERVAL plus the time to fetch the stats of all hosts
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', 120))
+# The delay to restart the collector process after it exited
+COLLECTOR_RESTART_DELAY = int(os.environ.get('COLLECTOR_RESTART_DELAY', 5))
+
+HOSTS_DIR = 'hosts'
+HOST_SUFFIX = '.prom'
+AUTH_TOKEN_FILE = 'auth-token'
+SERVICE_DISCOVERY_FILE = 'service-discovery.json'
+EXPORTER_STATS_FILE = 'exporter-metrics.prom'
+
+# (name, type, help) of the metrics about the collector process
+COLLECTOR_METRICS = [
+   ('vmware_vsan_exporter_collector_restarts_total', 'counter',
+    'Total restarts of the collector process after it exited.'),
+   ('vmware_vsan_exporter_snapshot_publish_failures_total', 'counter',
+    'Total snapshot publishes of the collector which failed, including '
+    'failures to connect to the vCenter.'),
+   ('vmware_vsan_exporter_snapshot_publish_seconds', 'gauge',
+    'Point in time. Seconds the last snapshot publish of the collector took.'),
+   ('vmware_vsan_exporter_snapshot_hosts', 'gauge',
+    'Point in time. Hosts published by the last snapshot publish.'),
+]
+SNAPSHOT_AGE_METRIC = (
+   'vmware_vsan_exporter_snapshot_age_seconds', 'gauge',
+   'Point in time. Seconds since the collector last published, keeps growing '
+   'if the collector is down or stuck.')
+
+
+# Replace the file at path with data, readers see either the old or the new
+# file as a whole
+def _WriteFileAtomic(path, data, mode=0o644):
+   tmpPath = '%s.tmp.%d' % (path, os.getpid())
+   fd = os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+   with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+   os.replace(tmpPath, path)
+
+# A path segment from a request can be used in a file path only if it can't
+# climb out of the snapshot directory
+def _IsSafeSegment(segment):
+   return bool(segment) and '/' not in segment and not segment.startswith('.')
+
+
+# Publish the snapshots into the directory, one file per host at
+# hosts/<vcip>/<clusterId>/<hostId>.prom
+class SnapshotWriter:
+   def __init__(self, snapshotDir):
+      self.snapshotDir = snapshotDir
+      os.makedirs(os.path.join(snapshotDir, HOSTS_DIR), exist_ok=True)
+
+   def hostPath(self, vcip, clusterId, hostId):
+      return os.path.join(self.snapshotDir, HOSTS_DIR, vcip, clusterId,
+         hostId + HOST_SUFFIX)
+
+   def writeHost(self, vcip, clusterId, hostId, data):
+      path = self.hostPath(vcip, clusterId, hostId)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      _WriteFileAtomic(path, data)
+      return path
+
+   # Remove the snapshots of the hosts not in paths, e.g. hosts removed from
+   # the cluster or owned by another replica now
+   def removeHostsExcept(self, paths):
+      for path in glob.glob(os.path.join(
+            self.snapshotDir, HOSTS_DIR, '*', '*', '*' + HOST_SUFFIX)):
+         if path not in paths:
+            try:
+               os.remove(path)
+            except FileNotFoundError:
+               pass
+
+   def writeFile(self, name, data, mode=0o644):
+      _WriteFileAtomic(os.path.join(self.snapshotDir, name), data, mode)
+
+
+# Read the snapshots published by SnapshotWriter, used by the gunicorn workers
+class SnapshotReader:
+   def __init__(self, snapshotDir, maxAge=SNAPSHOT_MAX_AGE):
+      self.snapshotDir = snapshotDir
+      self.maxAge = maxAge
+
+   # Return the path of the fresh snapshot of the host, looked up in any
+   # vCenter or cluster if not given. None if not found or too old.
+   def findHost(self, hostId, clusterId=None, vcip=None):
+      segments = [vcip or '*', clusterId or '*', hostId]
+      if not all(_IsSafeSegment(segment) for segment in segments):
+         return None
+      segments[-1] += HOST_SUFFIX
+      for path in glob.glob(os.path.join(
+            self.snapshotDir, HOSTS_DIR, *segments)):
+         if self._isFresh(path):
+            return path
+      return None
+
+   # Return the paths of the fresh snapshots of all hosts
+   def listHosts(self):
+      paths = glob.glob(os.path.join(
+         self.snapshotDir, HOSTS_DIR, '*', '*', '*' + HOST_SUFFIX))
+      return [path for path in sorted(paths) if self._isFresh(path)]
+
+   # Yield the content of the snapshots at paths, skipping files removed by
+   # the collector in between
+   def iterHosts(self, paths):
+      for path in paths:
+         try:
+            with open(path, 'rb') as f:
+               yield f.read()
+         except FileNotFoundError:
+            pass
+
+   def readFile(self, name):
+      try:
+         with open(os.path.join(self.snapshotDir, name), 'rb') as f:
+            return f.read()
+      except FileNotFoundError:
+         return None
+
+   # The stats about the exporter published by the collector, with the age of
+   # the publish added when read. None if never published.
+   def readExporterStats(self):
+      try:
+         with open(os.path.join(self.snapshotDir, EXPORTER_STATS_FILE),
+                   'rb') as f:
+            data = f.read()
+            age = time.time() - os.fstat(f.fileno()).st_mtime
+      except FileNotFoundError:
+         return None
+      metric, metricType, helpStr = SNAPSHOT_AGE_METRIC
+      return data + '\n'.join(FormatExporterMetric(
+         metric, metricType, helpStr, [({}, age)])).encode('utf-8')
+
+   def isAuthorized(self, authToken):
+      expected = self.readFile(AUTH_TOKEN_FILE)
+      return (expected is not None and authToken is not None and
+              expected.decode('utf-8') == authToken)
+
+   def serviceDiscovery(self, serverHost):
+      data = self.readFile(SERVICE_DISCOVERY_FILE)
+      if data is None:
+         return []
+      result = json.loads(data)
+      # targets not owned by another replica are served by this server
+      for entry in result:
+         entry['targets'] = [target or serverHost for target in entry['targets']]
+      return result
+
+   def _isFresh(self, path):
+      try:
+         age = time.time() - os.path.getmtime(path)
+      except FileNotFoundError:
+         return False
+      if age > self.maxAge:
+         logging.warning('Snapshot %s is %ds old, not served', path, age)
+         return False
+      return True
+
+
+# Collect the stats of all hosts every interval and publish them with writer.
+# The snapshot of a host is published as soon as its stats are done. The
+# VsanPrometheusStats is created by createStats, and created or connected
+# again every interval until it is connected to the vCenters.
+class SnapshotCollector:
+   def __init__(self, createStats, writer, interval, restarts=0):
+      self.createStats = createStats
+      self.vps = None
+      self.writer = writer
+      self.interval = interval
+      self.restarts = restarts
+      self.failures = 0
+      self.elapsed = 0
+      self.hosts = 0
+
+   def run(self):
+      while True:
+         t1 = time.time()
+         try:
+            if self.connect():
+               self.publish()
+            else:
+               self.failures += 1
+         except:
+            self.failures += 1
+            logging.exception('Failed to publish snapshots')
+         self.elapsed = time.time() - t1
+         logging.info('Published snapshots in %.2fs', self.elapsed)
+         try:
+            self.publishExporterStats()
+         except:
+            logging.exception('Failed to publish exporter stats')
+         time.sleep(max(self.interval - self.elapsed, 1))
+
+   # Return True if connected to the vCenters to collect. A single vCenter
+   # set by env "VCENTER" isn't connected again by VsanPrometheusStats once its
+   # first connect failed, so it is retried here.
+   def connect(self):
+      if self.vps is None:
+         try:
+            self.vps = self.createStats()
+         except:
+            logging.exception('Failed to start collecting, retry in %ds',
+               self.interval)
+            return False
+      vps = self.vps
+      if vps.VCENTER and not vps.VCENTERS_CONFIG and not vps.vcenters:
+         vps.connectOnStart(vps.VCENTER)
+         if not vps.vcenters:
+            logging.warning('Not connected to VC %s, retry in %ds',
+               vps.VCENTER, self.interval)
+            return False
+      return True
+
+   def publish(self):
+      if self.vps.authToken is not None:
+         self.writer.writeFile(
+            AUTH_TOKEN_FILE, self.vps.authToken.encode('utf-8'), 0o600)
+      paths = set()
+      for vcip, clusterId, hostId, stats in self.vps.iterStatsByHost():
+         data = GenerateStatsAsString([stats]).encode('utf-8')
+         paths.add(self.writer.writeHost(vcip, clusterId, hostId, data))
+      self.writer.removeHostsExcept(paths)
+      self.hosts = len(paths)
+      self.writer.writeFile(SERVICE_DISCOVERY_FILE,
+         json.dumps(self.vps.serviceDiscovery(None)).encode('utf-8'))
+
+   # Published after every attempt, so the snapshot age served by the
+   # workers tells whether the collector is alive
+   def publishExporterStats(self):
+      out = []
+      if self.vps is not None:
+         out.extend(self.vps.generateExporterStats())
+      samples = {
+         'vmware_vsan_exporter_collector_restarts_total': self.restarts,
+         'vmware_vsan_exporter_snapshot_publish_failures_total': self.failures,
+         'vmware_vsan_exporter_snapshot_publish_seconds': self.elapsed,
+         'vmware_vsan_exporter_snapshot_hosts': self.hosts,
+      }
+      for metric, metricType, helpStr in COLLECTOR_METRICS:
+         out.extend(FormatExporterMetric(
+            metric, metricType, helpStr, [({}, samples[metric])]))
+      self.writer.writeFile(
+         EXPORTER_STATS_FILE, '\n'.join(out).encode('utf-8'))
+
+
+def RunCollector(restarts=0):
+   logging.info('Start collector, publishing snapshots to %s every %ds',
+      SNAPSHOT_DIR, SNAPSHOT_INTERVAL)
+   writer = SnapshotWriter(SNAPSHOT_DIR)
+   SnapshotCollector(
+      VsanPrometheusStats, writer, SNAPSHOT_INTERVAL, restarts).run()
+
+
+_collectorProcess = None
+_collectorSupervisor = None
+_collectorStopped = threading.Event()
+_collectorLock = threading.Lock()
+
+# Run the collector process and start it again COLLECTOR_RESTART_DELAY after
+# it exited, until StopCollectorProcess is called
+def _SuperviseCollector():
+   global _collectorProcess
+   restarts = 0
+   while True:
+      with _collectorLock:
+         if _collectorStopped.is_set():
+            return
+         process = multiprocessing.Process(
+            target=RunCollector, args=(restarts,), name='vsan-collector',
+            daemon=True)
+         process.start()
+         _collectorProcess = process
+      process.join()
+      if _collectorStopped.is_set():
+         return
+      logging.error('Collector process exited with %s, restart in %ds',
+         process.exitcode, COLLECTOR_RESTART_DELAY)
+      restarts += 1
+      _collectorStopped.wait(COLLECTOR_RESTART_DELAY)
+
+# Start the collector process and its supervisor thread, called by the
+# gunicorn master before it forks the workers
+def StartCollectorProcess():
+   global _collectorSupervisor
+   _collectorStopped.clear()
+   _collectorSupervisor = threading.Thread(target=_SuperviseCollector,
+      name='vsan-collector-supervisor', daemon=True)
+   _collectorSupervisor.start()
+
+def StopCollectorProcess():
+   with _collectorLock:
+      _collectorStopped.set()
+      process = _collectorProcess
+   if process is not None and process.is_alive():
+      process.terminate()
+      process.join(10)
+   if _collectorSupervisor is not None:
+      _collectorSupervisor.join(10)
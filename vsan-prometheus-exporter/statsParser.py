@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+# Selective JSON parser of the CaptureInternalStats output. Only the stats
+# nodes the exporter converts are decoded into Python objects, the object
+# tree of all other stats is never built.
+
+import re
+import json
+
+_decoder = json.JSONDecoder()
+_STATS_MEMBER = re.compile(r'"stats"\s*:\s*\{')
+# A stats node, all are named by their path in the VSI tree and are objects
+_NODE_MEMBER = re.compile(r'"(/[^"\\]*)"\s*:\s*(?=\{)')
+_WHITESPACE = ' \t\n\r'
+
+
+# Return True if the string starting at s[i] is the name of an object member,
+# i.e. it follows "{" or "," and is not within another string
+def _IsMemberName(s, i):
+   i -= 1
+   while i >= 0 and s[i] in _WHITESPACE:
+      i -= 1
+   return i >= 0 and (s[i] == '{' or s[i] == ',')
+
+
+# Parser of the CaptureInternalStats output, which decodes only the stats
+# nodes in statsKeys. The nodes are located by a scan for their names, which
+# runs in the regex engine without building any object, and only the nodes
+# in statsKeys are decoded. The rest of the output is not validated.
+class StatsParser:
+   def __init__(self, statsKeys):
+      self.statsKeys = frozenset(statsKeys)
+
+   # Return {'stats': {key: node}} of the stats nodes found in s, the nodes
+   # not in statsKeys are listed with None. Raise json.JSONDecodeError like
+   # json.loads if s has no stats or a bad node.
+   def load(self, s):
+      m = _STATS_MEMBER.search(s)
+      if m is None:
+         raise json.JSONDecodeError('No stats found', s, 0)
+      stats = {}
+      pos = m.end()
+      while True:
+         m = _NODE_MEMBER.search(s, pos)
+         if m is None:
+            break
+         pos = m.end()
+         if not _IsMemberName(s, m.start()):
+            continue
+         key = m.group(1)
+         if key in self.statsKeys:
+            stats[key], pos = _decoder.raw_decode(s, pos)
+         else:
+            stats[key] = None
+      return {'stats': stats}
@@ -6,15 +6,33 @@
 
 import os
 import json
+import queue
 import logging
+import random
 import threading
 import time
 import uuid
 from pyVmomi import vim
 from pyVim.connect import Disconnect
+from concurrent.futures import Future
 
 import prometheus
-from connectUtils import ConnectToVC, ConnectToHost, GetClusterInstance
+from connectUtils import (
+   ConnectToVC, ConnectToHost, ConnectToHostAsync, GetClusterInstance,
+   GetHostSession)
+from hostConnections import (
+   HostSessionRefresher, GetHostTransferStats, HOST_SESSION_REFRESH_INTERVAL,
+   HOST_FETCH_TIMEOUT)
+from workerPool import (
+   WorkerPool, GetSharedWorkerPool, WORKER_POOL_SIZE, WORKER_QUEUE_SIZE)
+from sharding import CreateShardMembership
+from statsParser import StatsParser
+from asyncCollector import (
+   ASYNC_COLLECTOR, GetAsyncCollector, VsanHostAsyncClient)
+from inventory import (
+   PropertyWatcher, VmNameIndex, CreateClusterHostsFilterSpec,
+   CreateClusterVmsFilterSpec, CreateClusterStorageFilterSpec,
+   RetrieveHostInventory, HOST_STORAGE_PROPERTY)
 
 pre70MissingMetrics = {
    ('/vmkModules/vsan/dom', 'clientStats'): [
@@ -73,31 +91,93 @@ pre70MissingMetrics = {
    ],
 }
 
-def _IterateAndFormatStats(vsanStats):
-   for node1, node2s, fn in prometheus.paths:
-      out = {}
-      for node2 in node2s:
-         nodeStats = vsanStats['stats'].get('{}/{}'.format(node1, node2))
-         if not nodeStats:
-            continue
-         for entity, values in nodeStats['entities'].items():
-            statsDict = dict(zip(nodeStats['metrics'], values))
-            missingMetrics = pre70MissingMetrics.get((node1, node2), [])
-            for m in missingMetrics:
-               if m not in statsDict:
-                  # set value "-1" for missing metrics to filter them later
-                  statsDict[m] = -1
-            try:
-               fn(out, node1, node2, entity, statsDict)
-            except:
-               logging.exception(
-                  'Failed to process metrics of entity {}, {}, {}'.format(
-                     node1, node2, entity))
+# Converter of one stats node, see prometheus.paths. order sorts the nodes
+# like prometheus.paths and missingMetrics are the metrics the node may lack,
+# see pre70MissingMetrics.
+class StatsNodeHandler:
+   __slots__ = ['pathIndex', 'order', 'node1', 'node2', 'converter',
+                'missingMetrics']
+
+   def __init__(self, pathIndex, node2Index, node1, node2, converter):
+      self.pathIndex = pathIndex
+      self.order = node2Index
+      self.node1 = node1
+      self.node2 = node2
+      self.converter = converter
+      self.missingMetrics = pre70MissingMetrics.get((node1, node2), [])
+
+# Dispatch index of stats key -> StatsNodeHandler, built once from
+# prometheus.paths
+def _BuildStatsDispatch():
+   dispatch = {}
+   for pathIndex, (node1, node2s, converter) in enumerate(prometheus.paths):
+      for node2Index, node2 in enumerate(node2s):
+         dispatch['{}/{}'.format(node1, node2)] = StatsNodeHandler(
+            pathIndex, node2Index, node1, node2, converter)
+   return dispatch
+
+STATS_DISPATCH = _BuildStatsDispatch()
+
+# Counter of the stats nodes in the payloads without a handler
+class UnknownStatsCounter:
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.count = 0
+      self.keys = set()
+
+   def record(self, keys):
+      with self.lock:
+         self.count += len(keys)
+         newKeys = set(keys) - self.keys
+         self.keys.update(newKeys)
+      for key in newKeys:
+         logging.debug('No handler of stats %s', key)
+
+unknownStats = UnknownStatsCounter()
+
+# Only the stats nodes with a handler are parsed out of the
+# CaptureInternalStats output
+_statsParser = StatsParser(STATS_DISPATCH.keys())
+
+# Decode the raw vsan metrics stats of a host
+def LoadStats(rawStats):
+   return _statsParser.load(rawStats)
+
+# Run the handlers of the stats nodes present in vsanStats, yield the
+# formatted stats of every path of prometheus.paths. The labels are rendered
+# by labelCache and the schemas of the nodes cached by schemaCache if given.
+def _IterateAndFormatStats(vsanStats, labelCache=None, schemaCache=None):
+   pathNodes = [[] for _ in prometheus.paths]
+   unknownKeys = []
+   for key, nodeStats in vsanStats['stats'].items():
+      handler = STATS_DISPATCH.get(key)
+      if handler is None:
+         unknownKeys.append(key)
+      elif nodeStats:
+         pathNodes[handler.pathIndex].append((handler, nodeStats))
+   if unknownKeys:
+      unknownStats.record(unknownKeys)
+
+   for nodes in pathNodes:
+      out = prometheus.SampleStore()
+      nodes.sort(key=lambda node: node[0].order)
+      for handler, nodeStats in nodes:
+         try:
+            # the samples of missing metrics are skipped by the schema
+            handler.converter.convert(out, handler.node1, handler.node2,
+               nodeStats, handler.missingMetrics, labelCache, schemaCache)
+         except:
+            logging.exception('Failed to process metrics of {}, {}'.format(
+               handler.node1, handler.node2))
       yield out
 
 # Convert vsan metrics stats to prometheus format
 def ConvertStats(hostInfo, vsanStats):
-   for stats in _IterateAndFormatStats(vsanStats):
+   labelCache = hostInfo.get('labelCache')
+   if labelCache is not None:
+      labelCache.begin(hostInfo)
+   for stats in _IterateAndFormatStats(vsanStats, labelCache,
+                                       hostInfo.get('schemaCache')):
       yield prometheus.generatePrometheusFormat(hostInfo, stats, None)
 
 def _GetDiskInfo(diskStruct, isCap, ssd):
@@ -118,43 +198,83 @@ def _GetDGInfo(dg):
 def GetHostInfo(hostRef):
    hostname = hostRef.name
    vsanConfig = hostRef.configManager.vsanSystem.config
-   disks = []
    vmDict = {}
 
    if hostRef.vm:
       vmDict = dict([(vm.config.instanceUuid, vm.name) for vm in hostRef.vm])
-   for dg in vsanConfig.storageInfo.diskMapping:
-      disks.extend(_GetDGInfo(dg))
+   return _BuildHostInfo(hostname, vsanConfig, vmDict)
+
+# Same as GetHostInfo, but from the host properties loaded by
+# inventory.RetrieveHostInventory
+def GetHostInfoFromInventory(hostProps):
+   return _BuildHostInfo(hostProps['name'], hostProps['config.vsanHostConfig'],
+      dict(hostProps['vm']))
+
+def _BuildHostInfo(hostname, vsanConfig, vmDict):
    out = {
       'vsan_cluster_uuid': vsanConfig.clusterInfo.uuid,
       'host_uuid': vsanConfig.clusterInfo.nodeUuid,
       'hostname': hostname,
       'vmDict': vmDict,
-      'disks': dict([(d['VSAN UUID'], d) for d in disks])
+      'disks': GetDisksInfo(vsanConfig.storageInfo),
+      # bumped when the disks change, see prometheus.topologyVersion
+      'version': 0,
+      'labelCache': prometheus.LabelCache(),
+      'schemaCache': prometheus.StatsSchemaCache(hostname),
    }
    return out
 
-# Connect to every host and get their SoapStubAdapter so can call VMODL API later
-def GetHostMos(hostRefList):
+# Return {disk vsan uuid: disk info} of the disk mappings in vsan storageInfo
+def GetDisksInfo(storageInfo):
+   disks = []
+   for dg in (storageInfo.diskMapping if storageInfo else None) or []:
+      disks.extend(_GetDGInfo(dg))
+   return dict([(d['VSAN UUID'], d) for d in disks])
+
+# Connect to every host and get their SoapStubAdapter so can call VMODL API later.
+# The host properties are taken from inventory if given, see
+# inventory.RetrieveHostInventory, otherwise read from every hostRef. If vmIndex
+# is given, it's used as the vmDict of every host. The hosts are connected on
+# pool, the shared worker pool by default.
+def GetHostMos(hostRefList, inventory=None, vmIndex=None, pool=None):
    hostMos = {}
-   def _ConnectToHostThread(hostRef):
-      vsanStub = ConnectToHost(hostRef)
-      if vsanStub is None:
-         return
-      vis = vim.cluster.VsanInternalStatsProvider(
-         'vsan-internal-statsprovider', vsanStub)
+   inventory = inventory or {}
+   def _ConnectToHostTask(hostRef):
       hostId = hostRef._moId
-      hostInfo = GetHostInfo(hostRef)
+      hostProps = inventory.get(hostId)
+      if hostProps is not None and 'config.vsanHostConfig' in hostProps:
+         hostname = hostProps['name']
+         vsanSystem = hostProps['configManager.vsanSystem']
+      else:
+         hostProps = hostname = vsanSystem = None
+      if ASYNC_COLLECTOR:
+         vis = ConnectToHostAsync(hostRef, hostname, vsanSystem)
+      else:
+         vsanStub = ConnectToHost(hostRef, hostname, vsanSystem)
+         if vsanStub is None:
+            return
+         vis = vim.cluster.VsanInternalStatsProvider(
+            'vsan-internal-statsprovider', vsanStub)
+      if hostProps is not None:
+         hostInfo = GetHostInfoFromInventory(hostProps)
+      else:
+         hostInfo = GetHostInfo(hostRef)
+      if vmIndex is not None:
+         hostInfo['vmDict'] = vmIndex
       hostMos[hostId] = (vis, hostInfo)
 
-   threads = []
-   for hostRef in hostRefList:
-      threads.append(threading.Thread(
-         target=_ConnectToHostThread, args=(hostRef,)))
-
+   pool = pool or GetSharedWorkerPool()
    logging.info('Connecting to hosts')
-   [t.start() for t in threads]
-   [t.join() for t in threads]
+   futures = []
+   for hostRef in hostRefList:
+      hostId = hostRef._moId
+      futures.append((hostId, pool.submit(_ConnectToHostTask, hostRef,
+         taskName='connect %s' % hostId)))
+   for hostId, future in futures:
+      try:
+         future.result()
+      except:
+         logging.exception('Failed to connect to host %s', hostId)
    logging.info('Connected to all hosts')
    return hostMos
 
@@ -162,87 +282,1012 @@ def GetHostMos(hostRefList):
 def FetchVsanStats(vis):
    return vis.CaptureInternalStats(None, None, False)
 
-# Retrieve vsan metrics stats for one host
-def RetrieveStatsForHost(hostId, hostMoInfo):
-   vis, hostInfo = hostMoInfo
+# Fetch and decode the raw vsan metrics stats for one host, None on failure
+def _FetchStatsForHost(hostId, vis):
    t1 = time.time()
    try:
-      stats = json.loads(FetchVsanStats(vis))
+      stats = LoadStats(FetchVsanStats(vis))
    except:
       logging.exception('Failed to retrieve stats for host %s', hostId)
       stats = None
    t2 = time.time()
    logging.info('Fetching stats for %s took %.2fs', hostId, t2 - t1)
-   if stats is not None:
-      out = ConvertStats(hostInfo, stats)
-   else:
-      out = []
-   return out
+   return stats
 
-# Retrieve vsan metrics stats for all hosts
-#
-# Sample:
-# result = {
-#    'host1': [
-#       ['h1-metrics1-stats-line1', 'h1-metrics1-stats-line2', '...'],
-#       ['h1-metrics2-stats-line1', 'h1-metrics2-stats-line2', '...'],
-#    ],
-#    'host2': [
-#       ['h2-metrics1-stats-line1', 'h2-metrics1-stats-line2', '...'],
-#       ['h2-metrics2-stats-line1', 'h2-metrics2-stats-line2', '...'],
-#    ],
-#    '...': [],
-# }
-#
-def RetrieveStatsForHosts(hostMos):
-   result = {}
+# Retrieve vsan metrics stats for one host and convert them right away, so the
+# result can be kept and served more than once. Return the capture time along
+# with the converted stats, which are None if the fetch failed.
+def CaptureStatsForHost(hostId, hostMoInfo):
+   vis, hostInfo = hostMoInfo
+   stats = _FetchStatsForHost(hostId, vis)
+   captureTime = time.time()
+   if stats is None:
+      return captureTime, None
+   return captureTime, list(ConvertStats(hostInfo, stats))
+
+# Same as CaptureStatsForHost for hosts connected by the asyncio collector, all
+# fetches are in flight at the same time on the collector's event loop.
+# Yield (hostId, captureTime, converted stats) in the order fetches complete.
+def CaptureStatsForHostsAsync(hostMos):
+   clients = dict([(hostId, vis) for hostId, (vis, _) in hostMos.items()])
+   for hostId, rawStats in GetAsyncCollector().fetchAsCompleted(clients):
+      stats = None
+      try:
+         if isinstance(rawStats, BaseException):
+            raise rawStats
+         stats = LoadStats(rawStats)
+      except:
+         logging.exception('Failed to retrieve stats for host %s', hostId)
+      captureTime = time.time()
+      if stats is not None:
+         out = list(ConvertStats(hostMos[hostId][1], stats))
+      else:
+         out = None
+      yield hostId, captureTime, out
+
+def _IterHostResults(result):
+   items = result.items() if isinstance(result, dict) else result
+   for hostId, hostResult in items:
+      yield hostResult
 
-   def _RetrieveStatsForHostThread(hostId, hostMoInfo):
-      result[hostId] = RetrieveStatsForHost(hostId, hostMoInfo)
+# Format one metric family about the exporter itself in prometheus format,
+# samples is a list of (labels, value)
+def FormatExporterMetric(metric, metricType, helpStr, samples):
+   out = ['# HELP %s %s' % (metric, helpStr),
+          '# TYPE %s %s' % (metric, metricType)]
+   for labels, value in samples:
+      if labels:
+         labelsStr = ','.join(['%s="%s"' % (k, v) for k, v in labels.items()])
+         out.append('%s{%s} %f' % (metric, labelsStr, value))
+      else:
+         out.append('%s %f' % (metric, value))
+   out.append('')
+   return out
 
-   threads = []
-   for hostId, hostMoInfo in hostMos.items():
-      threads.append(threading.Thread(
-         target=_RetrieveStatsForHostThread, args=(hostId, hostMoInfo)))
-   [t.start() for t in threads]
-   [t.join() for t in threads]
-   return result
+# Generate the up metric of a host, which tells whether its stats in the
+# same response were fetched successfully
+def GenerateHostUpStats(hostInfo, up):
+   labels = {
+      'host_uuid': hostInfo['host_uuid'],
+      'hostname': hostInfo['hostname'],
+      'vsan_cluster_uuid': hostInfo['vsan_cluster_uuid'],
+   }
+   return FormatExporterMetric(
+      'vmware_vsan_exporter_host_up', 'gauge',
+      '1 if the stats of the host were fetched successfully, 0 if the fetch '
+      'failed, timed out or was skipped since the host is known to be bad.',
+      [(labels, 1 if up else 0)])
 
 def GenerateStatsAsStream(hostResultList):
    for hostResult in hostResultList:
       for pathStats in hostResult:
-         for line in pathStats:
-            yield line + '\n'
+         yield ''.join([line + '\n' for line in pathStats])
 
 def GenerateStatsAsString(hostResultList):
   return ''.join(GenerateStatsAsStream(hostResultList))
 
 
-class VsanPrometheusStats:
-   # The interval used to check current connected hosts and the whole hosts in
-   # the cluster.
-   HOST_CONSISTENCY_CHECK_INTERVAL = int(
-      os.environ.get('HOST_CONSISTENCY_CHECK_INTERVAL', 300))
+# Share one in-flight call per key between concurrent callers. The first caller
+# of a key becomes the leader, which must run the call and resolve the future;
+# the others just wait for the same future.
+class SingleFlight:
+   def __init__(self):
+      self.lock = threading.Lock()
+      self.flights = {}
+      self.coalesced = 0
+
+   # Return the future of the in-flight call of the key, and whether the caller
+   # is the leader of the call
+   def join(self, key):
+      with self.lock:
+         future = self.flights.get(key)
+         if future is not None:
+            self.coalesced += 1
+            return future, False
+         future = Future()
+         self.flights[key] = future
+         return future, True
+
+   def resolve(self, key, future, result=None, exception=None):
+      with self.lock:
+         if self.flights.get(key) is future:
+            del self.flights[key]
+      if exception is not None:
+         future.set_exception(exception)
+      else:
+         future.set_result(result)
+
+   # Drop the in-flight call of the key if it's still future, so the next
+   # caller starts a new call instead of joining one given up on
+   def abandon(self, key, future):
+      with self.lock:
+         if self.flights.get(key) is future:
+            del self.flights[key]
+
+   # Run fn(*args) as the leader of the key and resolve its future
+   def run(self, key, future, fn, *args):
+      try:
+         result = fn(*args)
+      except BaseException as ex:
+         self.resolve(key, future, exception=ex)
+      else:
+         self.resolve(key, future, result)
+
+   def do(self, key, fn, *args):
+      future, isLeader = self.join(key)
+      if isLeader:
+         self.run(key, future, fn, *args)
+      return future.result()
+
 
+# Per-host circuit breaker. The circuit of a host opens after a number of
+# consecutive failed fetches, so the host is skipped right away instead of
+# stalling scrapes. Once the backoff expires the circuit is half-open and a
+# single probe fetch is allowed, which closes the circuit if it succeeds or
+# opens it again with doubled backoff if it fails.
+class HostCircuitBreaker:
+   CLOSED = 'closed'
+   OPEN = 'open'
+   HALF_OPEN = 'half-open'
+
+   def __init__(self, threshold, backoff, maxBackoff):
+      self.threshold = threshold
+      self.backoff = backoff
+      self.maxBackoff = maxBackoff
+      self.lock = threading.Lock()
+      # hostId -> {'state', 'failures', 'backoff', 'retryTime'}
+      self.hosts = {}
+
+   def _getHost(self, hostId):
+      return self.hosts.setdefault(hostId, {
+         'state': self.CLOSED, 'failures': 0, 'backoff': 0, 'retryTime': 0})
+
+   # Whether the stats of the host may be fetched now
+   def allowRequest(self, hostId):
+      with self.lock:
+         host = self._getHost(hostId)
+         if host['state'] == self.CLOSED:
+            return True
+         if host['state'] == self.OPEN and time.time() >= host['retryTime']:
+            logging.info('Circuit of host %s half-open, probing', hostId)
+            host['state'] = self.HALF_OPEN
+            return True
+         return False
+
+   def recordSuccess(self, hostId):
+      with self.lock:
+         host = self._getHost(hostId)
+         if host['state'] != self.CLOSED:
+            logging.info('Circuit of host %s closed', hostId)
+         host.update(state=self.CLOSED, failures=0, backoff=0, retryTime=0)
+
+   def recordFailure(self, hostId):
+      with self.lock:
+         host = self._getHost(hostId)
+         host['failures'] += 1
+         if (host['state'] == self.HALF_OPEN or
+               host['failures'] >= self.threshold):
+            if host['state'] == self.HALF_OPEN:
+               backoff = min(host['backoff'] * 2, self.maxBackoff)
+            else:
+               backoff = host['backoff'] or self.backoff
+            host.update(state=self.OPEN, backoff=backoff,
+                        retryTime=time.time() + backoff)
+            logging.warning('Circuit of host %s open after %d failures, '
+               'retry in %ds', hostId, host['failures'], backoff)
+
+   def getState(self, hostId):
+      with self.lock:
+         host = self.hosts.get(hostId)
+         return host['state'] if host else self.CLOSED
+
+   def forget(self, hostId):
+      with self.lock:
+         self.hosts.pop(hostId, None)
+
+
+# Background collector refreshing the stats of every connected host on a
+# schedule with jitter. It keeps the latest converted snapshot of each host
+# together with its capture time, so scrapes don't wait on CaptureInternalStats.
+class HostStatsPrefetcher:
+   # Max seconds the scheduler sleeps before checking for due hosts again
+   SCHEDULE_TICK = 1.0
+
+   def __init__(self, getHostMos, captureStats, interval, jitter, pool=None):
+      self.getHostMos = getHostMos
+      self.pool = pool or GetSharedWorkerPool()
+      # captureStats(hostId, hostMoInfo) refreshes the snapshot of the host
+      self.captureStats = captureStats
+      self.interval = interval
+      self.jitter = min(jitter, interval)
+      self.lock = threading.Lock()
+      # hostId -> (captureTime, converted stats)
+      self.snapshots = {}
+      # hostId -> time of the next scheduled refresh
+      self.nextRefreshTime = {}
+      self.refreshing = set()
+      self.stopEvent = threading.Event()
+      self.thread = None
+
+   def start(self):
+      if self.thread is not None:
+         return
+      logging.info('Start prefetching stats every %ds (jitter %ds)',
+         self.interval, self.jitter)
+      self.thread = threading.Thread(
+         target=self._run, name='stats-prefetcher', daemon=True)
+      self.thread.start()
+
+   def stop(self):
+      self.stopEvent.set()
+
+   # Return the converted stats of the host if captured within maxAge seconds
+   def getSnapshot(self, hostId, maxAge):
+      with self.lock:
+         snapshot = self.snapshots.get(hostId)
+      if snapshot is None:
+         return None
+      captureTime, out = snapshot
+      if time.time() - captureTime > maxAge:
+         return None
+      return out
+
+   def putSnapshot(self, hostId, captureTime, out):
+      with self.lock:
+         current = self.snapshots.get(hostId)
+         if current is None or current[0] < captureTime:
+            self.snapshots[hostId] = (captureTime, out)
+
+   def _nextDelay(self):
+      return self.interval + random.uniform(-self.jitter, self.jitter)
+
+   def _reschedule(self, hostId, delay):
+      with self.lock:
+         self.refreshing.discard(hostId)
+         if hostId in self.nextRefreshTime:
+            self.nextRefreshTime[hostId] = time.time() + delay
+
+   def _refresh(self, hostId, hostMoInfo):
+      try:
+         self.captureStats(hostId, hostMoInfo)
+      except:
+         logging.exception('Failed to prefetch stats for host %s', hostId)
+      finally:
+         self._reschedule(hostId, self._nextDelay())
+
+   def _scheduleDueHosts(self):
+      now = time.time()
+      hostMos = self.getHostMos()
+      dueHosts = []
+      with self.lock:
+         for hostId in list(self.nextRefreshTime.keys()):
+            if hostId not in hostMos:
+               del self.nextRefreshTime[hostId]
+               self.snapshots.pop(hostId, None)
+         for hostId in list(hostMos.keys()):
+            # spread the first refresh of new hosts over the jitter window
+            nextTime = self.nextRefreshTime.setdefault(
+               hostId, now + random.uniform(0, self.jitter))
+            if nextTime <= now and hostId not in self.refreshing:
+               self.refreshing.add(hostId)
+               dueHosts.append((hostId, hostMos[hostId]))
+         nextWakeup = min(self.nextRefreshTime.values(),
+                          default=now + self.SCHEDULE_TICK)
+      return dueHosts, nextWakeup
+
+   def _run(self):
+      while not self.stopEvent.is_set():
+         try:
+            dueHosts, nextWakeup = self._scheduleDueHosts()
+            for hostId, hostMoInfo in dueHosts:
+               try:
+                  self.pool.submit(self._refresh, hostId, hostMoInfo,
+                     taskName='prefetch %s' % hostId, block=False)
+               except queue.Full:
+                  # retry later instead of blocking the other hosts' schedule
+                  logging.warning('Worker queue full, delay prefetch of %s',
+                     hostId)
+                  self._reschedule(hostId, self.SCHEDULE_TICK)
+         except:
+            logging.exception('Failed to schedule stats prefetch')
+            nextWakeup = time.time() + self.SCHEDULE_TICK
+         delay = min(max(nextWakeup - time.time(), 0), self.SCHEDULE_TICK)
+         self.stopEvent.wait(delay)
+
+
+# One monitored cluster: its connected hosts and VM index, kept current by the
+# handlers of the inventory watch of the cluster. All clusters of a vCenter
+# share the session si, the worker pool and the inventory watch.
+class VsanCluster:
+   def __init__(self, si, clusterRef, clusterName, onHostsRemoved, pool=None):
+      self.si = si
+      self.pool = pool
+      self.clusterRef = clusterRef
+      self.clusterId = clusterRef._moId
+      self.clusterName = clusterName
+      # onHostsRemoved(hostIds) is called after hosts left the cluster
+      self.onHostsRemoved = onHostsRemoved
+      self.hostMos = {}
+      # hostId -> hostRef of the hosts in the cluster, kept current by the
+      # watch of the cluster property "host"
+      self.clusterHostRefs = {}
+      self.hostMembershipLock = threading.Lock()
+      # VM instanceUuid -> VM name of the VMs in the cluster
+      self.vmIndex = VmNameIndex()
+
+   # Return the filters of the inventory watch of the cluster
+   def createFilters(self, si):
+      return [
+         (CreateClusterVmsFilterSpec(si, self.clusterRef),
+          self.vmIndex.onUpdate, self.vmIndex.load),
+         (CreateClusterHostsFilterSpec(self.clusterRef),
+          self._onClusterUpdate, None),
+         (CreateClusterStorageFilterSpec(si, self.clusterRef),
+          self._onHostStorageUpdate, None),
+      ]
+
+   def connectHosts(self):
+      clusterHostRefs = self.clusterRef.host
+      self.clusterHostRefs = dict(
+         [(hostRef._moId, hostRef) for hostRef in clusterHostRefs])
+      self._updateHostMos(self._connectHosts(clusterHostRefs), [])
+
+   # Return the hostMoInfo of the host, connect to it if it's in the cluster
+   # but failed to connect before. None if the host is not in the cluster.
+   def getHostMoInfo(self, hostId):
+      hostMoInfo = self.hostMos.get(hostId)
+      if hostMoInfo is None:
+         targetHostRef = self.clusterHostRefs.get(hostId)
+         if targetHostRef is None:
+            return None
+         logging.warning('Host %s not connected, trying to connect', hostId)
+         self._updateHostMos(self._connectHosts([targetHostRef]), [])
+         hostMoInfo = self.hostMos.get(hostId)
+      return hostMoInfo
+
+   # Connect to the hosts, with their VMs resolved from the cluster VM index
+   def _connectHosts(self, hostRefs):
+      return GetHostMos(hostRefs, self._retrieveHostInventory(), self.vmIndex,
+         self.pool)
+
+   # Bulk load the inventory of the cluster hosts, on failure return an empty
+   # inventory so host properties are read host by host as fallback
+   def _retrieveHostInventory(self):
+      t1 = time.time()
+      try:
+         inventory = RetrieveHostInventory(
+            self.si, self.clusterRef, withVms=False)
+      except:
+         logging.exception('Failed to retrieve inventory of cluster %s',
+            self.clusterName)
+         return {}
+      logging.info('Retrieved inventory of %d hosts in %.2fs',
+         len(inventory), time.time() - t1)
+      return inventory
+
+   # Called by the inventory watch with the changes of the cluster properties
+   def _onClusterUpdate(self, objUpdate):
+      for change in objUpdate.changeSet or []:
+         if change.name == 'host':
+            self._onClusterHostsChanged(change.val or [])
+
+   # Called by the inventory watch with the disk mappings of a host. The disks
+   # of the host info are replaced by a new dict as a whole, so concurrent
+   # conversions see either the old or the new topology.
+   def _onHostStorageUpdate(self, objUpdate):
+      hostMoInfo = self.hostMos.get(objUpdate.obj._moId)
+      if hostMoInfo is None:
+         return
+      for change in objUpdate.changeSet or []:
+         if change.name == HOST_STORAGE_PROPERTY:
+            hostInfo = hostMoInfo[1]
+            disks = GetDisksInfo(change.val if change.op == 'assign' else None)
+            if disks.keys() != hostInfo['disks'].keys():
+               logging.info('Disks of host %s changed, %d disks now',
+                  hostInfo['hostname'], len(disks))
+            hostInfo['disks'] = disks
+            hostInfo['version'] += 1
+
+   # Connect the hosts joined the cluster and drop the hosts left, hosts
+   # staying in the cluster are left untouched
+   def _onClusterHostsChanged(self, hostRefs):
+      self.clusterHostRefs = dict(
+         [(hostRef._moId, hostRef) for hostRef in hostRefs])
+      hostMos = self.hostMos
+      missingHostRefs = [hostRef for hostId, hostRef in
+                         self.clusterHostRefs.items() if hostId not in hostMos]
+      obsoleteHostIds = [hostId for hostId in hostMos
+                         if hostId not in self.clusterHostRefs]
+      newHostMos = {}
+      if missingHostRefs:
+         logging.info('Hosts %s joined cluster %s, connecting',
+            [hostRef._moId for hostRef in missingHostRefs], self.clusterName)
+         newHostMos = self._connectHosts(missingHostRefs)
+      if obsoleteHostIds:
+         logging.info('Hosts %s left cluster %s, removing',
+            obsoleteHostIds, self.clusterName)
+      self._updateHostMos(newHostMos, obsoleteHostIds)
+
+   # Replace hostMos with an updated copy, so readers iterating the current
+   # dict are never affected
+   def _updateHostMos(self, newHostMos, obsoleteHostIds):
+      if not newHostMos and not obsoleteHostIds:
+         return
+      with self.hostMembershipLock:
+         hostMos = dict(self.hostMos)
+         hostMos.update(newHostMos)
+         for hostId in obsoleteHostIds:
+            hostMos.pop(hostId, None)
+         self.hostMos = hostMos
+      if obsoleteHostIds:
+         self.onHostsRemoved(obsoleteHostIds)
+
+
+# One vCenter: its session, the monitored clusters and everything needed to
+# serve the stats of their hosts. Every vCenter has its own worker pool,
+# circuit breaker and stats snapshots, so that in a federation a slow or
+# failing vCenter doesn't hold up the hosts behind the others.
+class VsanVCenter:
+   # The interval to refresh the stats of every host in the background, scrapes
+   # are then served from the latest snapshot. Prefetching is disabled if 0.
+   PREFETCH_INTERVAL = int(os.environ.get('PREFETCH_INTERVAL', 0))
+   # The max random deviation applied to each host's prefetch schedule
+   PREFETCH_JITTER = int(os.environ.get('PREFETCH_JITTER', 5))
+   # The max age of a prefetched snapshot to be served, older snapshots make
+   # the scrape fetch the stats from the host directly
+   STATS_MAX_AGE = int(os.environ.get('STATS_MAX_AGE', 120))
+
+   # The max seconds a scrape waits for the stats of a host
+   HOST_FETCH_TIMEOUT = HOST_FETCH_TIMEOUT
+   # The number of consecutive failed fetches to skip a host
+   CIRCUIT_BREAKER_THRESHOLD = int(
+      os.environ.get('CIRCUIT_BREAKER_THRESHOLD', 3))
+   # The seconds to skip a failing host before probing it again, doubled after
+   # every failed probe up to CIRCUIT_BREAKER_MAX_BACKOFF
+   CIRCUIT_BREAKER_BACKOFF = int(os.environ.get('CIRCUIT_BREAKER_BACKOFF', 30))
+   CIRCUIT_BREAKER_MAX_BACKOFF = int(
+      os.environ.get('CIRCUIT_BREAKER_MAX_BACKOFF', 600))
+   # The max seconds to wait for the VM names of the cluster to be loaded
+   # when connecting
+   VM_INDEX_LOAD_TIMEOUT = int(os.environ.get('VM_INDEX_LOAD_TIMEOUT', 30))
+   # The interval to check the session of the vCenter, so it doesn't expire
+   # when idle and a dropped session is logged in again in the background
+   VC_KEEPALIVE_INTERVAL = int(os.environ.get('VC_KEEPALIVE_INTERVAL', 300))
+
+   # clusterName is the name of the cluster to monitor, or a list or comma
+   # separated names of several clusters. Hosts are connected and fetched on
+   # pool, the shared worker pool by default. If shards is given, only the
+   # hosts owned by this replica are prefetched and served in all hosts stats.
+   # All hosts are still connected, to be listed in service discovery and
+   # served right away when the ring changes.
+   def __init__(self, vcip, vcport, vcuser, vcpassword, clusterName,
+                pool=None, shards=None):
+      self.si = None
+      self.vcip = vcip
+      self.vcport = vcport
+      self.vcuser = vcuser
+      self.vcpassword = vcpassword
+      if isinstance(clusterName, str):
+         self.clusterNames = [name.strip() for name in clusterName.split(',')]
+      else:
+         self.clusterNames = list(clusterName)
+      self.pool = pool or GetSharedWorkerPool()
+      self.shards = shards
+      # clusterId -> VsanCluster of the monitored clusters
+      self.clusters = {}
+      self.inventoryWatcher = None
+      self.sessionUp = False
+      self.prefetcher = None
+      self.sessionRefresher = None
+      self.statsFlights = SingleFlight()
+      self.outcomeLock = threading.Lock()
+      self.breaker = HostCircuitBreaker(self.CIRCUIT_BREAKER_THRESHOLD,
+         self.CIRCUIT_BREAKER_BACKOFF, self.CIRCUIT_BREAKER_MAX_BACKOFF)
+      self.stopEvent = threading.Event()
+      self.keepAliveThread = None
+
+   def connect(self):
+      try:
+         self.si = ConnectToVC(
+            self.vcip, self.vcport, self.vcuser, self.vcpassword)
+      except vim.fault.InvalidLogin as ex:
+         logging.error(ex.msg)
+         raise Exception(ex.msg)
+      except:
+         msg = 'Exception when connecting to VC {}'.format(self.vcip)
+         logging.exception(msg)
+         raise Exception(msg)
+
+      clusters = {}
+      for name in self.clusterNames:
+         clusterRef = GetClusterInstance(name, self.si)
+         if clusterRef is None:
+            msg = 'Cluster {} not found'.format(name)
+            logging.error(msg)
+            raise Exception(msg)
+         clusters[clusterRef._moId] = VsanCluster(
+            self.si, clusterRef, name, self._onHostsRemoved, self.pool)
+
+      logging.info('Connected to VC %s successfully', self.vcip)
+      self.sessionUp = True
+      for cluster in clusters.values():
+         cluster.connectHosts()
+      self.clusters = clusters
+      if self.inventoryWatcher is not None:
+         self.inventoryWatcher.stop()
+      # one watch of the inventory of all clusters in the shared VC session
+      self.inventoryWatcher = PropertyWatcher(
+         self.si, 'inventory-%s' % self.vcip,
+         lambda si: [f for cluster in clusters.values()
+                     for f in cluster.createFilters(si)])
+      self.inventoryWatcher.start()
+      deadline = time.time() + self.VM_INDEX_LOAD_TIMEOUT
+      for cluster in clusters.values():
+         if not cluster.vmIndex.loaded.wait(max(deadline - time.time(), 0)):
+            logging.warning('VM names of cluster %s not loaded in %ds, VMs '
+               'are labeled with unknown-vmName until loaded',
+               cluster.clusterName, self.VM_INDEX_LOAD_TIMEOUT)
+
+      if self.PREFETCH_INTERVAL > 0 and self.prefetcher is None:
+         self.prefetcher = HostStatsPrefetcher(
+            self._getOwnedHostMos, self._prefetchStats,
+            self.PREFETCH_INTERVAL, self.PREFETCH_JITTER, self.pool)
+         self.prefetcher.start()
+      if HOST_SESSION_REFRESH_INTERVAL > 0 and self.sessionRefresher is None:
+         self.sessionRefresher = HostSessionRefresher(
+            self._getOwnedHostSessions, HOST_SESSION_REFRESH_INTERVAL,
+            self.pool)
+         self.sessionRefresher.start()
+
+   # Keep the session alive in the background. If reconnect is True, connect
+   # first and keep connecting until it succeeds.
+   def startKeepAlive(self, reconnect=False):
+      if self.keepAliveThread is not None:
+         return
+      self.keepAliveThread = threading.Thread(target=self._keepAlive,
+         args=(reconnect,), name='keepalive-%s' % self.vcip, daemon=True)
+      self.keepAliveThread.start()
+
+   def stop(self):
+      self.stopEvent.set()
+      for task in (self.inventoryWatcher, self.prefetcher,
+                   self.sessionRefresher):
+         if task is not None:
+            task.stop()
+
+   def isConnected(self):
+      return bool(self.clusters)
+
+   def _keepAlive(self, reconnect):
+      interval = 0 if reconnect else self.VC_KEEPALIVE_INTERVAL
+      while not self.stopEvent.wait(interval):
+         interval = self.VC_KEEPALIVE_INTERVAL
+         if not self.isConnected():
+            if reconnect:
+               try:
+                  self.connect()
+               except:
+                  logging.error('Failed to connect to VC %s, retry in %ds',
+                     self.vcip, interval)
+            continue
+         try:
+            # the session oriented stub logs in again if the session is gone
+            self.si.CurrentTime()
+            self.sessionUp = True
+         except:
+            logging.exception('Keep-alive of VC %s failed', self.vcip)
+            self.sessionUp = False
+
+   # Service discovery entries of the hosts of all clusters. If federated, the
+   # entries are qualified with the vCenter. If the exporter monitors a single
+   # cluster, the paths are /vsan/metrics/<hostId> as before several clusters
+   # could be monitored, so the targets of existing deployments don't change.
+   def serviceDiscovery(self, serverHost, federated=False,
+                        singleCluster=False):
+      result = []
+      for clusterId, cluster in list(self.clusters.items()):
+         for hostId in list(cluster.hostMos.keys()):
+            if singleCluster:
+               path = '/vsan/metrics/{}'.format(hostId)
+            elif federated:
+               path = '/vsan/metrics/{}/{}/{}'.format(
+                  self.vcip, clusterId, hostId)
+            else:
+               path = '/vsan/metrics/{}/{}'.format(clusterId, hostId)
+            labels = {
+               '__metrics_path__': path,
+               'cluster_name': cluster.clusterName,
+               'cluster_id': clusterId,
+               '__scheme__': 'http',
+            }
+            if federated:
+               labels['vcenter'] = self.vcip
+            target = serverHost
+            if self.shards is not None:
+               target = self.shards.ownerOf(self._getShardKey(hostId))
+            result.append({'targets': [target], 'labels': labels})
+      return result
+
+   # The key of the host on the hash ring of the exporter replicas
+   def _getShardKey(self, hostId):
+      return '{}/{}'.format(self.vcip, hostId)
+
+   # Return hostId -> hostMoInfo of the connected hosts owned by this replica
+   def _getOwnedHostMos(self):
+      hostMos = self._getAllHostMos()
+      if self.shards is None:
+         return hostMos
+      return dict([(hostId, hostMoInfo)
+                   for hostId, hostMoInfo in hostMos.items()
+                   if self.shards.owns(self._getShardKey(hostId))])
+
+   # Return hostId -> session of the connected hosts owned by this replica
+   def _getOwnedHostSessions(self):
+      return dict([(hostId, GetHostSession(hostMoInfo[0]))
+                   for hostId, hostMoInfo in self._getOwnedHostMos().items()])
+
+   # Return hostId -> hostMoInfo of the connected hosts of all clusters
+   def _getAllHostMos(self):
+      hostMos = {}
+      for cluster in list(self.clusters.values()):
+         hostMos.update(cluster.hostMos)
+      return hostMos
+
+   # Get the converted stats of all connected hosts owned by this replica
+   #
+   # Sample:
+   # result = {
+   #    'host1': [
+   #       ['h1-metrics1-stats-line1', 'h1-metrics1-stats-line2', '...'],
+   #       ['h1-metrics2-stats-line1', 'h1-metrics2-stats-line2', '...'],
+   #    ],
+   #    'host2': [
+   #       ['h2-metrics1-stats-line1', 'h2-metrics1-stats-line2', '...'],
+   #       ['h2-metrics2-stats-line1', 'h2-metrics2-stats-line2', '...'],
+   #    ],
+   #    '...': [],
+   # }
+   #
+   def getStatsForAllHosts(self):
+      result = None
+      if not self.clusters:
+         logging.error('Cluster of VC %s not connected', self.vcip)
+         return result
+
+      return self._iterStatsForHosts(self._getOwnedHostMos())
+
+   # Same as getStatsForAllHosts, but yield (vcip, clusterId, hostId,
+   # converted stats)
+   def iterStatsByHost(self):
+      hostClusters = {}
+      hostMos = self._getOwnedHostMos()
+      for clusterId, cluster in list(self.clusters.items()):
+         for hostId in cluster.hostMos:
+            hostClusters[hostId] = clusterId
+      for hostId, stats in self._iterStatsForHosts(hostMos):
+         # skip hosts removed from the cluster in between
+         if hostId in hostClusters:
+            yield self.vcip, hostClusters[hostId], hostId, stats
+
+   # Get the converted stats of the host, in the cluster clusterId if given,
+   # otherwise in any monitored cluster
+   def getStatsForHost(self, hostId, clusterId=None):
+      result = None
+      if not self.clusters:
+         logging.error('Cluster of VC %s not connected', self.vcip)
+         return result
+
+      if clusterId is None:
+         clusters = list(self.clusters.values())
+      elif clusterId in self.clusters:
+         clusters = [self.clusters[clusterId]]
+      else:
+         logging.error('Cluster %s not monitored', clusterId)
+         return result
+      hostMoInfo = None
+      for cluster in clusters:
+         hostMoInfo = cluster.getHostMoInfo(hostId)
+         if hostMoInfo is not None:
+            break
+      if hostMoInfo is None:
+         return result
+
+      result = dict(self._iterStatsForHosts({hostId: hostMoInfo}))
+      return result
+
+   # Yield (hostId, converted stats) of the hosts in the order they complete.
+   # Fresh snapshots are served right away, hosts with open circuit are
+   # skipped, and a host not done within HOST_FETCH_TIMEOUT is given up.
+   # Either way the host up metric is appended to the stats of every host.
+   def _iterStatsForHosts(self, hostMos):
+      staleHostMos = {}
+      for hostId, hostMoInfo in hostMos.items():
+         out = self._getFreshSnapshot(hostId)
+         if out is not None:
+            yield hostId, self._withHostUpStats(hostMoInfo, out, True)
+         elif self.breaker.allowRequest(hostId):
+            staleHostMos[hostId] = hostMoInfo
+         else:
+            logging.info('Skip host %s with open circuit', hostId)
+            yield hostId, self._withHostUpStats(hostMoInfo, [], False)
+      if not staleHostMos:
+         return
+      if self.prefetcher is not None:
+         logging.info('No fresh snapshot for hosts %s, fetching directly',
+            list(staleHostMos.keys()))
+
+      deadline = time.time() + self.HOST_FETCH_TIMEOUT
+      futures = self._captureStatsForHosts(staleHostMos)
+      done = queue.Queue()
+      for hostId, future in futures.items():
+         future.add_done_callback(lambda f, hostId=hostId: done.put(hostId))
+      while futures:
+         try:
+            hostId = done.get(timeout=max(deadline - time.time(), 0))
+         except queue.Empty:
+            break
+         out = None
+         try:
+            captureTime, out = futures.pop(hostId).result()
+         except:
+            logging.exception('Failed to retrieve stats for host %s', hostId)
+         yield hostId, self._withHostUpStats(
+            staleHostMos[hostId], out or [], out is not None)
+
+      for hostId, future in futures.items():
+         logging.warning('Timeout retrieving stats for host %s', hostId)
+         # the next scrape starts a new capture instead of waiting on this
+         self.statsFlights.abandon(hostId, future)
+         self._recordTimeout(hostId, future)
+         yield hostId, self._withHostUpStats(staleHostMos[hostId], [], False)
+
+   def _withHostUpStats(self, hostMoInfo, out, up):
+      return list(out) + [GenerateHostUpStats(hostMoInfo[1], up)]
+
+   # Return the prefetched snapshot of the host if it's fresh enough
+   def _getFreshSnapshot(self, hostId):
+      if self.prefetcher is None:
+         return None
+      return self.prefetcher.getSnapshot(hostId, self.STATS_MAX_AGE)
+
+   def _captureStats(self, hostId, hostMoInfo):
+      captureTime, out = CaptureStatsForHost(hostId, hostMoInfo)
+      self._onStatsCaptured(hostId, captureTime, out)
+      return captureTime, out
+
+   def _captureStatsAsync(self, leaders):
+      hostMos = dict([(hostId, hostMoInfo)
+         for hostId, (future, hostMoInfo) in leaders.items()])
+      try:
+         for hostId, captureTime, out in CaptureStatsForHostsAsync(hostMos):
+            self._onStatsCaptured(hostId, captureTime, out)
+            self.statsFlights.resolve(
+               hostId, leaders.pop(hostId)[0], (captureTime, out))
+      except BaseException as ex:
+         logging.exception('Failed to retrieve stats for hosts %s',
+            list(leaders.keys()))
+         for hostId, (future, hostMoInfo) in leaders.items():
+            self.statsFlights.resolve(hostId, future, exception=ex)
+
+   def _onStatsCaptured(self, hostId, captureTime, out):
+      if out is not None and self.prefetcher is not None:
+         self.prefetcher.putSnapshot(hostId, captureTime, out)
+
+   # Done callback of the future of a capture led by this exporter
+   def _onCaptureDone(self, hostId, future):
+      try:
+         captureTime, out = future.result()
+      except queue.Full:
+         # not submitted since the worker pool is full, not the host's fault
+         return
+      except BaseException:
+         out = None
+      self._recordOutcome(hostId, future, out is not None)
+
+   # Record the outcome of the capture of future in the circuit breaker,
+   # unless the capture was given up at the deadline of a scrape already
+   def _recordOutcome(self, hostId, future, success):
+      with self.outcomeLock:
+         if getattr(future, 'outcomeRecorded', False):
+            return
+         future.outcomeRecorded = True
+      if success:
+         self.breaker.recordSuccess(hostId)
+      else:
+         self.breaker.recordFailure(hostId)
+
+   # Record a capture given up at the deadline of a scrape as a failure, once
+   # for every scrape giving up on it. Its late outcome isn't recorded.
+   def _recordTimeout(self, hostId, future):
+      with self.outcomeLock:
+         future.outcomeRecorded = True
+      self.breaker.recordFailure(hostId)
+
+   # Capture the stats of the hosts on the worker pool. A host being captured
+   # already for another caller is not fetched again, the caller shares the
+   # in-flight capture instead. The captures are not queued if the pool is
+   # full, their futures fail with queue.Full right away.
+   # Return hostId -> future of (captureTime, converted stats).
+   def _captureStatsForHosts(self, hostMos):
+      futures = {}
+      asyncLeaders = {}
+      pool = self.pool
+      for hostId, hostMoInfo in hostMos.items():
+         future, isLeader = self.statsFlights.join(hostId)
+         futures[hostId] = future
+         if not isLeader:
+            continue
+         future.add_done_callback(
+            lambda f, hostId=hostId: self._onCaptureDone(hostId, f))
+         if isinstance(hostMoInfo[0], VsanHostAsyncClient):
+            asyncLeaders[hostId] = (future, hostMoInfo)
+         else:
+            try:
+               pool.submit(self.statsFlights.run, hostId, future,
+                  self._captureStats, hostId, hostMoInfo,
+                  taskName='fetch %s' % hostId, block=False)
+            except queue.Full as ex:
+               logging.warning('Worker pool full, not fetching host %s',
+                  hostId)
+               self.statsFlights.resolve(hostId, future, exception=ex)
+      if asyncLeaders:
+         try:
+            pool.submit(self._captureStatsAsync, asyncLeaders,
+               taskName='fetch %d hosts' % len(asyncLeaders), block=False)
+         except queue.Full as ex:
+            logging.warning('Worker pool full, not fetching hosts %s',
+               list(asyncLeaders.keys()))
+            for hostId, (future, hostMoInfo) in asyncLeaders.items():
+               self.statsFlights.resolve(hostId, future, exception=ex)
+      return futures
+
+   # Refresh the snapshot of the host for the prefetcher. Don't wait if the
+   # host is being captured for another caller already, the snapshot is
+   # refreshed by that capture.
+   def _prefetchStats(self, hostId, hostMoInfo):
+      if not self.breaker.allowRequest(hostId):
+         return
+      future, isLeader = self.statsFlights.join(hostId)
+      if isLeader:
+         future.add_done_callback(
+            lambda f: self._onCaptureDone(hostId, f))
+         self.statsFlights.run(
+            hostId, future, self._captureStats, hostId, hostMoInfo)
+
+   def _onHostsRemoved(self, hostIds):
+      for hostId in hostIds:
+         self.breaker.forget(hostId)
+
+   # Return exporter metric name -> samples of the vCenter, see
+   # EXPORTER_METRICS
+   def getExporterSamples(self):
+      labels = {'vcenter': self.vcip}
+      poolStats = self.pool.getStats()
+      circuitStates = {
+         HostCircuitBreaker.OPEN: 1, HostCircuitBreaker.HALF_OPEN: 0.5}
+      hostMos = self._getAllHostMos()
+      # hostId -> (wire bytes, decompressed bytes)
+      transferStats = dict([
+         (hostId, GetHostTransferStats(hostMoInfo[1]['hostname']))
+         for hostId, hostMoInfo in hostMos.items()])
+      return {
+         'vmware_vsan_exporter_vcenter_up': [
+            (labels, 1 if self.isConnected() and self.sessionUp else 0)],
+         'vmware_vsan_exporter_owned_hosts': [
+            (labels, len(self._getOwnedHostMos()))],
+         'vmware_vsan_exporter_coalesced_requests_total': [
+            (labels, self.statsFlights.coalesced)],
+         'vmware_vsan_exporter_host_circuit_open': [
+            (dict(labels, host_id=hostId),
+             circuitStates.get(self.breaker.getState(hostId), 0))
+            for hostId in hostMos],
+         'vmware_vsan_exporter_host_response_bytes_total': [
+            (dict(labels, host_id=hostId), stats[0])
+            for hostId, stats in transferStats.items()],
+         'vmware_vsan_exporter_host_response_decoded_bytes_total': [
+            (dict(labels, host_id=hostId), stats[1])
+            for hostId, stats in transferStats.items()],
+         'vmware_vsan_exporter_worker_tasks_total': [
+            (labels, poolStats['started'])],
+         'vmware_vsan_exporter_worker_queue_wait_seconds_total': [
+            (labels, poolStats['queueWaitSum'])],
+         'vmware_vsan_exporter_worker_queue_wait_max_seconds': [
+            (labels, poolStats['queueWaitMax'])],
+         'vmware_vsan_exporter_worker_queue_tasks': [
+            (labels, poolStats['queued'])],
+      }
+
+
+# (name, type, help) of the metrics about the exporter itself
+EXPORTER_METRICS = [
+   ('vmware_vsan_exporter_vcenter_up', 'gauge',
+    '1 if the vCenter is connected and its session is alive, 0 otherwise.'),
+   ('vmware_vsan_exporter_owned_hosts', 'gauge',
+    'Point in time. Connected hosts served by this exporter replica.'),
+   ('vmware_vsan_exporter_coalesced_requests_total', 'counter',
+    'Total requests for host stats served by sharing the in-flight fetch '
+    'and conversion of a concurrent request.'),
+   ('vmware_vsan_exporter_host_circuit_open', 'gauge',
+    'Point in time. 1 if the host is skipped since its fetches kept '
+    'failing, 0.5 if a probe fetch is allowed, 0 otherwise.'),
+   ('vmware_vsan_exporter_unknown_stats_nodes_total', 'counter',
+    'Total stats nodes received from hosts without a converter, which are '
+    'not parsed.'),
+   ('vmware_vsan_exporter_entity_labels_cache_hits_total', 'counter',
+    'Total lookups of the labels parsed out of the name of an entity found '
+    'in the cache.'),
+   ('vmware_vsan_exporter_entity_labels_cache_misses_total', 'counter',
+    'Total lookups of the labels parsed out of the name of an entity not '
+    'found in the cache, the name is parsed.'),
+   ('vmware_vsan_exporter_entity_labels_cache_entries', 'gauge',
+    'Point in time. Entities whose labels parsed out of their names are '
+    'cached.'),
+   ('vmware_vsan_exporter_host_response_bytes_total', 'counter',
+    'Total bytes of the response bodies received from the host, compressed '
+    'as sent on the wire.'),
+   ('vmware_vsan_exporter_host_response_decoded_bytes_total', 'counter',
+    'Total bytes of the response bodies received from the host after '
+    'decompression.'),
+   ('vmware_vsan_exporter_worker_tasks_total', 'counter',
+    'Total tasks started by the host worker pool.'),
+   ('vmware_vsan_exporter_worker_queue_wait_seconds_total', 'counter',
+    'Sum total of the time tasks waited in the host worker pool queue.'),
+   ('vmware_vsan_exporter_worker_queue_wait_max_seconds', 'gauge',
+    'Max time a task waited in the host worker pool queue.'),
+   ('vmware_vsan_exporter_worker_queue_tasks', 'gauge',
+    'Point in time. Tasks waiting in the host worker pool queue.'),
+]
+
+# Yield the items of all iterators in the order they are produced, consuming
+# every iterator on its own thread
+def _MergeAsCompleted(iterators):
+   done = queue.Queue()
+   end = object()
+   def _Consume(iterator):
+      try:
+         for item in iterator:
+            done.put(item)
+      except:
+         logging.exception('Failed to retrieve stats')
+      finally:
+         done.put(end)
+
+   for iterator in iterators:
+      threading.Thread(target=_Consume, args=(iterator,), daemon=True).start()
+   remaining = len(iterators)
+   while remaining:
+      item = done.get()
+      if item is end:
+         remaining -= 1
+      else:
+         yield item
+
+
+class VsanPrometheusStats:
    # If env variable "VCENTER" is set, will connect to it automatically on start
    VCENTER = os.environ.get('VCENTER')
+   # If env variable "VCENTERS_CONFIG" is set to the path of a JSON file
+   # listing several vCenters, will connect to all of them on start
+   VCENTERS_CONFIG = os.environ.get('VCENTERS_CONFIG')
    # The bearer token used for authorization, will be generated automatically
    # if not set
    BEARER_TOKEN = os.environ.get('BEARER_TOKEN')
 
    def __init__(self):
-      self.si = None
-      self.vcip = None
-      self.vcport = None
-      self.vcuser = None
-      self.clusterName = None
-      self.clusterRef = None
-      self.hostMos = {}
-      self.lastUpdateTime = None
+      # vcip -> VsanVCenter
+      self.vcenters = {}
+      # True if the vCenters are loaded from VCENTERS_CONFIG
+      self.federated = False
       self.authToken = None
+      # the replicas of a sharded exporter fleet, None if not sharded
+      self.shards = CreateShardMembership()
 
+      if self.VCENTERS_CONFIG:
+         logging.info('Env "VCENTERS_CONFIG" is set, connecting to VCs in %s',
+            self.VCENTERS_CONFIG)
+         self.connectFromConfig(self.VCENTERS_CONFIG)
       # connect to VC automatically once start if env variable "VCENTER" is set
-      if self.VCENTER:
+      elif self.VCENTER:
          logging.info('Env "VCENTER" is set, connecting to VC automatically')
          self.connectOnStart(self.VCENTER)
 
@@ -250,6 +1295,7 @@ class VsanPrometheusStats:
       vcport = os.environ.get('VCPORT', '443')
       vcuser = os.environ.get('VCUSER', '')
       vcpassword = os.environ.get('VCPASSWORD', '')
+      # comma separated names of the clusters to monitor
       clusterName = os.environ.get('CLUSTERNAME', '')
       logging.info('vcip: %s, vcport: %s, vcuser: %s, clusterName: %s',
          vcip, vcport, vcuser, clusterName)
@@ -258,30 +1304,47 @@ class VsanPrometheusStats:
       except:
          logging.error('Failed to connect to VC')
 
+   # clusterName is the name of the cluster to monitor, or a list or comma
+   # separated names of several clusters
    def connect(self, vcip, vcport, vcuser, vcpassword, clusterName):
-      try:
-         self.si = ConnectToVC(vcip, vcport, vcuser, vcpassword)
-      except vim.fault.InvalidLogin as ex:
-         logging.error(ex.msg)
-         raise Exception(ex.msg)
-      except:
-         msg = 'Exception when connecting to VC {}'.format(vcip)
-         logging.exception(msg)
-         raise Exception(msg)
+      vcenter = VsanVCenter(
+         vcip, vcport, vcuser, vcpassword, clusterName, shards=self.shards)
+      vcenter.connect()
+      if vcip in self.vcenters:
+         self.vcenters[vcip].stop()
+      self.vcenters[vcip] = vcenter
+      vcenter.startKeepAlive()
+      self._loadAuthToken()
 
-      self.clusterRef = GetClusterInstance(clusterName, self.si)
-      if self.clusterRef is None:
-         msg = 'Cluster {} not found'.format(clusterName)
-         logging.error(msg)
-         raise Exception(msg)
+   # Connect to all vCenters listed in the JSON file configPath, e.g.
+   # [{"vcenter": "vc1", "port": 443, "user": "...", "password": "...",
+   #   "clusters": ["cluster1", "cluster2"]}, ...]
+   # Every vCenter gets its own worker pool and is connected in the
+   # background, a vCenter failing to connect is retried without affecting
+   # the others.
+   def connectFromConfig(self, configPath):
+      with open(configPath) as f:
+         config = json.load(f)
+      vcenters = {}
+      for vcConfig in config:
+         vcip = vcConfig['vcenter']
+         logging.info('vcip: %s, vcport: %s, vcuser: %s, clusters: %s', vcip,
+            vcConfig.get('port', 443), vcConfig.get('user', ''),
+            vcConfig.get('clusters', []))
+         vcenters[vcip] = VsanVCenter(vcip, str(vcConfig.get('port', 443)),
+            vcConfig.get('user', ''), vcConfig.get('password', ''),
+            vcConfig.get('clusters', []),
+            WorkerPool(WORKER_POOL_SIZE, WORKER_QUEUE_SIZE, 'vc-%s' % vcip),
+            self.shards)
+      self.vcenters = vcenters
+      self.federated = True
+      self._loadAuthToken()
+      for vcenter in vcenters.values():
+         vcenter.startKeepAlive(reconnect=True)
 
-      logging.info('Connected to VC %s successfully', vcip)
-      self.vcip = vcip
-      self.vcport = vcport
-      self.vcuser = vcuser
-      self.clusterName = clusterName
-      self.hostMos = GetHostMos(self.clusterRef.host)
-      self.lastUpdateTime = time.time()
+   def _loadAuthToken(self):
+      if self.authToken is not None:
+         return
       if self.BEARER_TOKEN is not None:
          logging.info('Load auth token from env "BEARER_TOKEN"')
          self.authToken = self.BEARER_TOKEN
@@ -290,99 +1353,89 @@ class VsanPrometheusStats:
       logging.info('Auth token is %s', self.authToken)
 
    def serviceDiscovery(self, serverHost):
+      vcenters = list(self.vcenters.values())
+      singleCluster = sum(
+         [len(vcenter.clusterNames) for vcenter in vcenters]) == 1
       result = []
-      if self.clusterRef is None:
-         return result
-
-      self._hostConsistencyCheck()
-      clusterName = self.clusterRef.name
-      clusterId = self.clusterRef._moId
-      for hostId in self.hostMos:
-         result.append({
-            'targets': [serverHost],
-            'labels': {
-               '__metrics_path__': '/vsan/metrics/{}'.format(hostId),
-               'cluster_name': clusterName,
-               'cluster_id': clusterId,
-               '__scheme__': 'http',
-            },
-         })
+      for vcenter in vcenters:
+         result.extend(vcenter.serviceDiscovery(
+            serverHost, self.federated, singleCluster))
       return result
 
    def isAuthorized(self, authToken):
      return self.authToken is not None and self.authToken == authToken
 
+   # Get the converted stats of all connected hosts of all vCenters, see
+   # VsanVCenter.getStatsForAllHosts. The stats of several vCenters are
+   # fetched concurrently and yielded in the order they complete.
    def getStatsForAllHosts(self):
       logging.info('Get stats for all hosts')
-      result = None
-      if self.clusterRef is None:
-         logging.error('Cluster not connected')
-         return result
+      results = []
+      for vcenter in list(self.vcenters.values()):
+         result = vcenter.getStatsForAllHosts()
+         if result is not None:
+            results.append(result)
+      if not results:
+         return None
+      if len(results) == 1:
+         return results[0]
+      return _MergeAsCompleted(results)
 
-      result = RetrieveStatsForHosts(self.hostMos)
-      return result
+   # Yield (vcip, clusterId, hostId, converted stats) of the owned hosts of
+   # all vCenters in the order they complete
+   def iterStatsByHost(self):
+      vcenters = [vcenter for vcenter in list(self.vcenters.values())
+                  if vcenter.isConnected()]
+      if len(vcenters) == 1:
+         return vcenters[0].iterStatsByHost()
+      return _MergeAsCompleted(
+         [vcenter.iterStatsByHost() for vcenter in vcenters])
 
-   def getStatsForHost(self, hostId):
+   # Get the converted stats of the host, in the vCenter vcip and the cluster
+   # clusterId if given, otherwise in any monitored vCenter or cluster
+   def getStatsForHost(self, hostId, clusterId=None, vcip=None):
       logging.info('Get stats for host %s', hostId)
-      result = None
-      if self.clusterRef is None:
-         logging.error('Cluster not connected')
-         return result
-
-      if hostId not in self.hostMos:
-         logging.warning('Host %s not connected, trying to connect', hostId)
-         targetHostRef = None
-         for hostRef in self.clusterRef.host:
-            if hostRef._moId == hostId:
-               targetHostRef = hostRef
-               break
-         if targetHostRef is None:
-            logging.error('Host %s not found in cluster', hostId)
-         else:
-            self.hostMos.update(GetHostMos([targetHostRef]))
-
-      if hostId in self.hostMos:
-         result = {}
-         result[hostId] = RetrieveStatsForHost(
-            hostId, self.hostMos[hostId])
-      return result
-
-   # Check whether connected hosts are consistent with all hosts in the cluster
-   def _hostConsistencyCheck(self):
-      if self.clusterRef is None:
-         return
-      if (time.time() - self.lastUpdateTime <
-            self.HOST_CONSISTENCY_CHECK_INTERVAL):
-         return
-
-      logging.info(
-         'Check consistency of connected hosts against cluster hosts, '
-         'last check time %s', time.strftime('%Y-%m-%d %H:%M:%S+0000',
-         time.gmtime(self.lastUpdateTime)))
-
-      allHostIds = []
-      missingHostRefs = []
-      for hostRef in self.clusterRef.host:
-         allHostIds.append(hostRef._moId)
-         if hostRef._moId not in self.hostMos:
-            missingHostRefs.append(hostRef)
-      if missingHostRefs:
-         logging.info('Hosts %s not connected, trying to connect',
-            [hostRef._moId for hostRef in missingHostRefs])
-         self.hostMos.update(GetHostMos(missingHostRefs))
-
-      for hostId in list(self.hostMos.keys()):
-         if hostId not in allHostIds:
-            logging.info('Host %s obsolete in the connection list, remove it')
-            del self.hostMos[hostId]
+      if vcip is None:
+         vcenters = list(self.vcenters.values())
+      elif vcip in self.vcenters:
+         vcenters = [self.vcenters[vcip]]
+      else:
+         logging.error('VC %s not monitored', vcip)
+         return None
+      for vcenter in vcenters:
+         result = vcenter.getStatsForHost(hostId, clusterId)
+         if result is not None:
+            return result
+      logging.error('Host %s not found in cluster', hostId)
+      return None
 
-      self.lastUpdateTime = time.time()
+   # Generate the stats about the exporter itself in prometheus format
+   def generateExporterStats(self):
+      samples = {}
+      for vcenter in list(self.vcenters.values()):
+         for metric, metricSamples in vcenter.getExporterSamples().items():
+            samples.setdefault(metric, []).extend(metricSamples)
+      samples['vmware_vsan_exporter_unknown_stats_nodes_total'] = [
+         ({}, unknownStats.count)]
+      hits, misses, entries = prometheus.entityLabelsCache.getStats()
+      samples['vmware_vsan_exporter_entity_labels_cache_hits_total'] = [
+         ({}, hits)]
+      samples['vmware_vsan_exporter_entity_labels_cache_misses_total'] = [
+         ({}, misses)]
+      samples['vmware_vsan_exporter_entity_labels_cache_entries'] = [
+         ({}, entries)]
+      out = []
+      for metric, metricType, helpStr in EXPORTER_METRICS:
+         out.extend(FormatExporterMetric(
+            metric, metricType, helpStr, samples.get(metric, [])))
+      return out
 
+   # result is either a dict or an iterable of (hostId, converted stats)
    def generateStatsAsStream(self, result):
-      return GenerateStatsAsStream(result.values())
+      return GenerateStatsAsStream(_IterHostResults(result))
 
    def generateStatsAsString(self, result):
-      return GenerateStatsAsString(result.values())
+      return GenerateStatsAsString(_IterHostResults(result))
 
 
 if __name__ == '__main__':
@@ -408,7 +1461,8 @@ if __name__ == '__main__':
       f.write(resultStr)
    logging.info('Stats for all hosts saved')
 
-   hostRef = vps.clusterRef.host[0]
+   vcenter = vps.vcenters[vcip]
+   hostRef = list(vcenter.clusters.values())[0].clusterRef.host[0]
    hostId = hostRef._moId
    result = vps.getStatsForHost(hostId)
    resultStr = vps.generateStatsAsString(result)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Copyright 2020-2021 VMware, Inc.
+# SPDX-License-Identifier: BSD-2-Clause
+#
+
+import os
+import queue
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+# The max number of tasks running at the same time in the shared worker pool
+WORKER_POOL_SIZE = int(os.environ.get('WORKER_POOL_SIZE', 16))
+# The max number of tasks waiting in the queue of the shared worker pool
+WORKER_QUEUE_SIZE = int(os.environ.get('WORKER_QUEUE_SIZE', 256))
+
+# A long-lived pool of a fixed number of worker threads fed by a bounded queue.
+# Submitting a task returns a concurrent.futures.Future, which carries the time
+# the task waited in the queue as attribute "queueWaitTime" once it started.
+class WorkerPool:
+   def __init__(self, maxWorkers, maxQueueSize, name='worker'):
+      self.name = name
+      self.maxWorkers = maxWorkers
+      self.tasks = queue.Queue(maxQueueSize)
+      self.lock = threading.Lock()
+      self.startedTasks = 0
+      self.queueWaitSum = 0.0
+      self.queueWaitMax = 0.0
+      self.workers = []
+      for i in range(maxWorkers):
+         t = threading.Thread(
+            target=self._worker, name='%s-%d' % (name, i), daemon=True)
+         t.start()
+         self.workers.append(t)
+
+   # Queue fn(*args) to run on a worker thread. If the queue is full, wait for
+   # a free slot when block is True, otherwise raise queue.Full right away.
+   def submit(self, fn, *args, taskName=None, block=True):
+      future = Future()
+      future.queueWaitTime = None
+      self.tasks.put((future, fn, args, taskName, time.time()), block=block)
+      return future
+
+   def getStats(self):
+      with self.lock:
+         return {
+            'workers': self.maxWorkers,
+            'queued': self.tasks.qsize(),
+            'started': self.startedTasks,
+            'queueWaitSum': self.queueWaitSum,
+            'queueWaitMax': self.queueWaitMax,
+         }
+
+   def _worker(self):
+      while True:
+         future, fn, args, taskName, submitTime = self.tasks.get()
+         try:
+            if not future.set_running_or_notify_cancel():
+               continue
+            waitTime = time.time() - submitTime
+            future.queueWaitTime = waitTime
+            with self.lock:
+               self.startedTasks += 1
+               self.queueWaitSum += waitTime
+               self.queueWaitMax = max(self.queueWaitMax, waitTime)
+            logging.debug('Task %s waited %.3fs in %s queue',
+               taskName or fn.__name__, waitTime, self.name)
+            try:
+               result = fn(*args)
+            except BaseException as ex:
+               future.set_exception(ex)
+            else:
+               future.set_result(result)
+         finally:
+            self.tasks.task_done()
+
+
+_sharedPool = None
+_sharedPoolLock = threading.Lock()
+
+# Return the worker pool shared by host connect, reconnect and fetch tasks
+def GetSharedWorkerPool():
+   global _sharedPool
+   with _sharedPoolLock:
+      if _sharedPool is None:
+         logging.info('Start worker pool with %d workers, queue size %d',
+            WORKER_POOL_SIZE, WORKER_QUEUE_SIZE)
+         _sharedPool = WorkerPool(
+            WORKER_POOL_SIZE, WORKER_QUEUE_SIZE, 'host-worker')
+      return _sharedPool